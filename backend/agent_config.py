@@ -0,0 +1,151 @@
+import os
+import time
+import threading
+from sqlalchemy import event, select
+from models import Agent
+from model_client import build_headers
+from metrics import bind_agent
+
+# 智能体配置缓存配置
+AGENT_CONFIG_CHECK_INTERVAL = float(os.getenv('AGENT_CONFIG_CHECK_INTERVAL', '5'))  # 缓存的配置超过该时间（秒）后查询版本号确认是否被其他进程修改，0 表示每次都确认
+
+class AgentConfig:
+    """对话调用使用的智能体配置快照（不绑定数据库会话，可在线程间共享）
+
+    标量字段与 Agent 模型同名，另外预先构建好请求头、采样参数和停止序列列表。
+    """
+
+    __slots__ = (
+        'id', 'name', 'status', 'config_version', 'model_name', 'model_provider', 'base_url', 'headers',
+        'model_temperature', 'model_max_tokens', 'sampling', 'stop', 'model_context_window',
+        'model_system_prompt', 'max_concurrency', 'completion_cache_enabled'
+    )
+
+    def __init__(self, agent):
+        self.id = agent.id
+        self.name = agent.name
+        self.status = agent.status
+        self.config_version = agent.config_version
+        self.model_name = agent.model_name
+        self.model_provider = agent.model_provider
+        self.base_url = agent.model_api_url.rstrip('/')
+        self.headers = build_headers(agent)
+        self.model_temperature = agent.model_temperature
+        self.model_max_tokens = agent.model_max_tokens
+        self.sampling = {
+            'temperature': agent.model_temperature,
+            'max_tokens': agent.model_max_tokens,
+            'top_p': agent.model_top_p,
+            'top_k': agent.model_top_k,
+            'presence_penalty': agent.model_presence_penalty,
+            'frequency_penalty': agent.model_frequency_penalty
+        }
+        self.stop = tuple(agent.model_stop_sequences.split(',')) if agent.model_stop_sequences else ()
+        self.model_context_window = agent.model_context_window
+        self.model_system_prompt = agent.model_system_prompt
+        self.max_concurrency = agent.max_concurrency
+        self.completion_cache_enabled = agent.completion_cache_enabled
+
+class AgentConfigCache:
+    """进程内智能体配置缓存
+
+    本进程修改或删除智能体时立即失效；其他进程的修改通过 Agent.config_version 发现，
+    超过检查间隔的配置在使用前查询一次版本号，因此最多有 AGENT_CONFIG_CHECK_INTERVAL 秒的延迟。
+    """
+
+    def __init__(self, check_interval=AGENT_CONFIG_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._entries = {}  # agent_id -> (配置, 上次确认时间)
+        self._lock = threading.Lock()
+
+    def lookup(self, agent_id):
+        """返回 (缓存的配置, 是否需要确认版本)，未缓存时返回 (None, False)"""
+        entry = self._entries.get(agent_id)
+        if entry is None:
+            return None, False
+        config, checked_at = entry
+        return config, time.monotonic() - checked_at >= self.check_interval
+
+    def store(self, config):
+        with self._lock:
+            self._entries[config.id] = (config, time.monotonic())
+
+    def invalidate(self, agent_id):
+        with self._lock:
+            self._entries.pop(agent_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# 进程内共享的智能体配置缓存
+agent_config_cache = AgentConfigCache()
+
+def agent_version_query(agent_id):
+    """查询智能体配置版本号"""
+    return select(Agent.config_version).where(Agent.id == agent_id)
+
+def get_agent_config(session, agent_id):
+    """获取智能体配置，不存在时返回 None（同时为当前请求的指标标记智能体和模型提供商）"""
+    config = load_agent_config(session, agent_id)
+    if config is not None:
+        bind_agent(config)
+    return config
+
+def load_agent_config(session, agent_id):
+    """从缓存或数据库获取智能体配置"""
+    config, stale = agent_config_cache.lookup(agent_id)
+    if config is not None and not stale:
+        return config
+    if config is not None:
+        # 只查询版本号，未变化时继续使用缓存
+        version = session.execute(agent_version_query(agent_id)).scalar()
+        if version == config.config_version:
+            agent_config_cache.store(config)
+            return config
+
+    agent = session.get(Agent, agent_id)
+    if agent is None:
+        agent_config_cache.invalidate(agent_id)
+        return None
+    config = AgentConfig(agent)
+    agent_config_cache.store(config)
+    return config
+
+async def get_agent_config_async(session, agent_id):
+    """获取智能体配置（异步数据库会话），不存在时返回 None（同时为当前请求的指标标记智能体和模型提供商）"""
+    config = await load_agent_config_async(session, agent_id)
+    if config is not None:
+        bind_agent(config)
+    return config
+
+async def load_agent_config_async(session, agent_id):
+    """从缓存或数据库获取智能体配置（异步数据库会话）"""
+    config, stale = agent_config_cache.lookup(agent_id)
+    if config is not None and not stale:
+        return config
+    if config is not None:
+        # 只查询版本号，未变化时继续使用缓存
+        version = (await session.execute(agent_version_query(agent_id))).scalar()
+        if version == config.config_version:
+            agent_config_cache.store(config)
+            return config
+
+    agent = await session.get(Agent, agent_id)
+    if agent is None:
+        agent_config_cache.invalidate(agent_id)
+        return None
+    config = AgentConfig(agent)
+    agent_config_cache.store(config)
+    return config
+
+@event.listens_for(Agent, 'before_update')
+def bump_agent_config_version(mapper, connection, target):
+    """智能体被修改时递增配置版本号，其他进程据此发现缓存的配置已过期"""
+    target.config_version = (target.config_version or 0) + 1
+
+@event.listens_for(Agent, 'after_update')
+@event.listens_for(Agent, 'after_delete')
+def invalidate_agent_config(mapper, connection, target):
+    """智能体被修改或删除时使本进程缓存的配置失效"""
+    agent_config_cache.invalidate(target.id)
@@ -1,10 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_restx import Api, Resource, fields
-from models import db, Agent, AgentLog, Conversation, Message, User, Role
-from datetime import datetime
+from sqlalchemy import create_engine, update
+from sqlalchemy.exc import IntegrityError
+from models import db, Agent, Conversation, Message, User, Role
+from model_client import model_client
+from agent_config import get_agent_config
+from model_scheduler import ModelCallRejected, model_scheduler
+from migrations import upgrade_schema
+from db_engine import engine_options, configure_engine
+from db_replica import read_replica, replica_database_uris, replica_router, recent_writes, use_primary, client_wrote_recently, init_app as init_write_markers
+from pagination import InvalidCursor, page_size, paginate_query
+from serializers import InvalidFields, json_response, user_serializer, role_serializer, agent_serializer, log_serializer
+from role_membership import InvalidIds, parse_ids, add_role_users, remove_role_users, sync_role_users, set_user_roles
+from user_import import InvalidImport, import_format, parse_import, validate_import, insert_users
+from log_writer import log_writer
+from log_store import InvalidArchiveMonth, log_store
+from model_warmup import model_warmup
+from query_profiler import query_profiler
+from metrics import registry, init_app as init_metrics, instrument_engine, record_model_call
+from context_cache import context_cache, context_rows_query
+from history_export import MESSAGE_WINDOW_MAX_LIMIT, iter_messages_ndjson, message_row_to_dict, message_window_query
+from chat_pipeline import ConversationNotFound, InvalidBatch, TurnBatch, StreamRelay, conversations_query, requested_conversation_ids, message_rows, assistant_messages, remember_replies, chat_log_message, invoke_log_message, plan_turn_request, apply_summary, cached_completion, store_completion, enable_stream, record_completion_stats, extract_completion_content, attach_timings, build_invoke_result, stream_done_events, stream_error_event, parse_invoke_batch, build_batch_error, batch_failure, batch_should_save, batch_replies, batch_results, batch_save_errors
 import os
+import json
+import time
+import contextvars
 import requests
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -27,6 +50,7 @@ ns_conversations = api.namespace('conversations', description='会话管理')
 ns_logs = api.namespace('logs', description='日志管理')
 ns_users = api.namespace('users', description='用户管理')
 ns_roles = api.namespace('roles', description='角色管理')
+ns_admin = api.namespace('admin', description='系统管理')
 
 # 定义数据模型
 agent_model = api.model('Agent', {
@@ -47,6 +71,11 @@ agent_model = api.model('Agent', {
     'model_stop_sequences': fields.List(fields.String, description='停止序列'),
     'model_context_window': fields.Integer(description='上下文窗口大小'),
     'model_system_prompt': fields.String(description='系统提示词'),
+    'max_concurrency': fields.Integer(description='最多同时进行的模型调用数（为空时使用默认配置，0 表示不限制）'),
+    'completion_cache_enabled': fields.Boolean(description='temperature 为 0 时是否缓存模型补全结果'),
+    'warmup_status': fields.String(readonly=True, description='模型预热状态', enum=['cold', 'warming', 'ready', 'failed']),
+    'warmup_error': fields.String(readonly=True, description='最近一次预热失败的原因'),
+    'warmed_at': fields.DateTime(readonly=True, description='最近一次成功加载模型的时间'),
     'created_at': fields.DateTime(readonly=True, description='创建时间'),
     'updated_at': fields.DateTime(readonly=True, description='更新时间')
 })
@@ -136,6 +165,11 @@ update_role_model = api.model('UpdateRole', {
     'description': fields.String(description='角色描述')
 })
 
+# 角色用户请求模型
+role_users_model = api.model('RoleUsers', {
+    'user_ids': fields.List(fields.Integer, required=True, description='用户ID列表')
+})
+
 # 创建智能体请求模型
 create_agent_model = api.model('CreateAgent', {
     'name': fields.String(required=True, description='智能体名称'),
@@ -153,7 +187,9 @@ create_agent_model = api.model('CreateAgent', {
     'model_frequency_penalty': fields.Float(description='频率惩罚'),
     'model_stop_sequences': fields.List(fields.String, description='停止序列'),
     'model_context_window': fields.Integer(description='上下文窗口大小'),
-    'model_system_prompt': fields.String(description='系统提示词')
+    'model_system_prompt': fields.String(description='系统提示词'),
+    'max_concurrency': fields.Integer(description='最多同时进行的模型调用数（为空时使用默认配置，0 表示不限制）'),
+    'completion_cache_enabled': fields.Boolean(description='temperature 为 0 时是否缓存模型补全结果')
 })
 
 # 更新智能体请求模型
@@ -173,7 +209,9 @@ update_agent_model = api.model('UpdateAgent', {
     'model_frequency_penalty': fields.Float(description='频率惩罚'),
     'model_stop_sequences': fields.List(fields.String, description='停止序列'),
     'model_context_window': fields.Integer(description='上下文窗口大小'),
-    'model_system_prompt': fields.String(description='系统提示词')
+    'model_system_prompt': fields.String(description='系统提示词'),
+    'max_concurrency': fields.Integer(description='最多同时进行的模型调用数（为空时使用默认配置，0 表示不限制）'),
+    'completion_cache_enabled': fields.Boolean(description='temperature 为 0 时是否缓存模型补全结果')
 })
 
 # 更新智能体状态请求模型
@@ -201,6 +239,50 @@ invoke_agent_model = api.model('InvokeAgent', {
     'max_tokens': fields.Integer(description='最大tokens（覆盖智能体配置）')
 })
 
+# 批量调用请求模型
+invoke_batch_item_model = api.model('InvokeBatchItem', {
+    'input': fields.String(required=True, description='输入内容'),
+    'conversation_id': fields.String(description='会话ID（可选，同一批次中不能重复）'),
+    'temperature': fields.Float(description='温度参数（覆盖智能体配置）'),
+    'max_tokens': fields.Integer(description='最大tokens（覆盖智能体配置）')
+})
+
+invoke_batch_model = api.model('InvokeAgentBatch', {
+    'inputs': fields.List(fields.Nested(invoke_batch_item_model), required=True, description='输入列表（每项也可以直接是字符串）'),
+    'parallelism': fields.Integer(description='同时进行的模型调用数'),
+    'stream': fields.Boolean(description='是否按完成顺序逐行返回结果（NDJSON）', default=False)
+})
+
+# 分页查询参数
+pagination_params = {
+    'page': '页码（页码分页，默认: 1）',
+    'per_page': '每页数量',
+    'cursor': '分页游标（游标分页，首页传空值，之后传上一页返回的 next_cursor）',
+    'with_total': '游标分页时是否返回总数（true/false，默认: false）',
+    'fields': '返回的字段（逗号分隔，如 id,name,status），不传时返回全部字段'
+}
+
+fields_params = {'fields': pagination_params['fields']}
+
+log_pagination_params = dict(pagination_params, archive='读取已归档的月份（YYYY-MM），不传时读取未过期的日志')
+
+# 分页响应模型
+def page_model(name, key, item_model):
+    """构建分页响应模型"""
+    return api.model(name, {
+        key: fields.List(fields.Nested(item_model)),
+        'total': fields.Integer(description='总数（游标分页时仅在 with_total=true 时返回）'),
+        'pages': fields.Integer(description='总页数（页码分页）'),
+        'current_page': fields.Integer(description='当前页码（页码分页）'),
+        'per_page': fields.Integer(description='每页数量'),
+        'next_cursor': fields.String(description='下一页游标（游标分页，没有下一页时为 null）')
+    })
+
+user_page_model = page_model('UserPage', 'users', user_model)
+agent_page_model = page_model('AgentPage', 'agents', agent_model)
+log_page_model = page_model('AgentLogPage', 'logs', log_model)
+role_page_model = page_model('RolePage', 'roles', role_model)
+
 # 配置数据库
 DB_TYPE = os.getenv('DB_TYPE', 'sqlite')
 
@@ -211,84 +293,105 @@ if DB_TYPE == 'mysql':
     DB_USER = os.getenv('DB_USER', 'root')
     DB_PASSWORD = os.getenv('DB_PASSWORD', '')
     app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+    # 只读副本（DB_REPLICA_HOSTS 为空时不启用）
+    REPLICA_DATABASE_URIS = replica_database_uris(DB_USER, DB_PASSWORD, DB_NAME)
 else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.path.dirname(__file__), 'db.sqlite3')
+    REPLICA_DATABASE_URIS = []
+    SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(__file__), 'db.sqlite3'))  # SQLite 数据库文件路径
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + SQLITE_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite 使用 WAL 等连接参数，MySQL 使用连接池参数（见 db_engine.py）
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(DB_TYPE)
 
 # 初始化数据库
 db.init_app(app)
 
-# 创建数据库表
-with app.app_context():
-    db.create_all()
-    # 创建默认角色和管理员用户
-    try:
-        # 创建管理员角色
-        admin_role = Role.query.filter_by(name='admin').first()
-        if not admin_role:
-            admin_role = Role(name='admin', description='系统管理员')
-            db.session.add(admin_role)
-            db.session.commit()
+# 记录请求耗时分解
+init_metrics(app)
+
+# 写入会话的响应带上写入标记（多进程部署时的读己之写）
+init_write_markers(app)
+
+# 创建数据库表并启动后台线程
+# python app.py 启动时，multiprocessing 的子进程（密码哈希进程池）会以 __mp_main__ 重新导入本模块，子进程中不需要这些初始化
+if __name__ != '__mp_main__':
+    with app.app_context():
+        configure_engine(db.engine)
+        db.create_all()
+        upgrade_schema(db.engine, db.metadata)
+        log_store.init_engine(db.engine)
+        log_writer.init_engine(db.engine)
+        model_warmup.init_engine(db.engine)
+        query_profiler.init_engine(db.engine)
+        instrument_engine(db.engine)
+        replica_router.init_engines([create_engine(uri, **engine_options(DB_TYPE)) for uri in REPLICA_DATABASE_URIS])
+        for replica in replica_router.replicas:
+            instrument_engine(replica.engine)
+        # 创建默认角色和管理员用户
+        try:
+            # 创建管理员角色
+            admin_role = Role.query.filter_by(name='admin').first()
+            if not admin_role:
+                admin_role = Role(name='admin', description='系统管理员')
+                db.session.add(admin_role)
+                db.session.commit()
         
-        # 创建普通用户角色
-        user_role = Role.query.filter_by(name='user').first()
-        if not user_role:
-            user_role = Role(name='user', description='普通用户')
-            db.session.add(user_role)
-            db.session.commit()
+            # 创建普通用户角色
+            user_role = Role.query.filter_by(name='user').first()
+            if not user_role:
+                user_role = Role(name='user', description='普通用户')
+                db.session.add(user_role)
+                db.session.commit()
         
-        # 创建默认管理员用户
-        admin_user = User.query.filter_by(username='admin').first()
-        if not admin_user:
-            admin_user = User(
-                username='admin',
-                email='admin@example.com',
-                full_name='系统管理员',
-                is_active=True,
-                is_admin=True
-            )
-            admin_user.set_password('admin123')
-            admin_user.roles.append(admin_role)
-            db.session.add(admin_user)
-            db.session.commit()
-            print('默认管理员用户创建成功: admin/admin123')
-    except Exception as e:
-        print(f'创建默认数据失败: {e}')
-        db.session.rollback()
+            # 创建默认管理员用户
+            admin_user = User.query.filter_by(username='admin').first()
+            if not admin_user:
+                admin_user = User(
+                    username='admin',
+                    email='admin@example.com',
+                    full_name='系统管理员',
+                    is_active=True,
+                    is_admin=True
+                )
+                admin_user.set_password('admin123')
+                admin_user.roles.append(admin_role)
+                db.session.add(admin_user)
+                db.session.commit()
+                print('默认管理员用户创建成功: admin/admin123')
+        except Exception as e:
+            print(f'创建默认数据失败: {e}')
+            db.session.rollback()
 
 @app.route('/')
 def index():
     """根路由"""
     return jsonify({'message': 'Agent Management Platform API', 'docs_url': '/docs'})
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus 指标"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 # 用户管理接口
 @ns_users.route('/')
 class UserList(Resource):
-    @ns_users.doc('list_users')
-    @ns_users.marshal_list_with(user_model)
+    @ns_users.doc('list_users', params=pagination_params)
+    @ns_users.response(200, 'Success', user_page_model)
+    @read_replica
     def get(self):
         """获取用户列表"""
         try:
-            # 分页参数
-            page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 10, type=int)
+            # 查询用户（支持页码分页和游标分页）
+            response = paginate_query(User.query, User, 'users', user_serializer.from_request())
             
-            # 查询用户
-            users = User.query.order_by(User.created_at.desc()).paginate(page=page, per_page=per_page)
-            
-            # 构建响应
-            response = {
-                'users': [user.to_dict() for user in users.items],
-                'total': users.total,
-                'pages': users.pages,
-                'current_page': users.page,
-                'per_page': users.per_page
-            }
-            
-            return response, 200
+            return json_response(response)
             
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_users.doc('create_user')
     @ns_users.expect(create_user_model)
@@ -332,20 +435,59 @@ class UserList(Resource):
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+@ns_users.route('/import')
+class UserImport(Resource):
+    @ns_users.doc('import_users', params={
+        'format': '导入格式（csv 或 ndjson），不传时按 Content-Type（text/csv 或 application/x-ndjson）判断',
+        'atomic': '是否有任一行出错时不导入任何用户（true/false，默认: false，跳过出错的行）'
+    })
+    def post(self):
+        """批量导入用户（CSV 或 NDJSON，每行一个用户，字段与创建用户相同）"""
+        try:
+            try:
+                fmt = import_format(request.content_type, request.args.get('format'))
+                rows = parse_import(request.get_data(cache=False, as_text=True), fmt)
+            except InvalidImport as e:
+                return {'error': str(e)}, 400
+            
+            # 校验格式，并用按批的 IN 查询检查用户名和邮箱是否已存在
+            users, errors = validate_import(db.session, rows)
+            if errors and request.args.get('atomic', 'false').lower() == 'true':
+                return {'error': 'Import contains invalid users', 'created': 0, 'failed': len(errors), 'errors': errors}, 400
+            
+            # 在进程池中计算密码哈希，按批写入，所有批次一起提交
+            created = insert_users(db.session, [user for _, user in users]) if users else 0
+            db.session.commit()
+            
+            return {'created': created, 'failed': len(errors), 'errors': errors}, 200
+            
+        except IntegrityError:
+            # 校验后其他请求写入了相同的用户名或邮箱
+            db.session.rollback()
+            return {'error': 'User already exists'}, 409
+        except Exception as e:
+            db.session.rollback()
+            return {'error': str(e)}, 500
+
 @ns_users.route('/<int:user_id>')
 @ns_users.response(404, 'User not found')
 @ns_users.param('user_id', '用户ID')
 class UserResource(Resource):
-    @ns_users.doc('get_user')
-    @ns_users.marshal_with(user_model)
+    @ns_users.doc('get_user', params=fields_params)
+    @ns_users.response(200, 'Success', user_model)
     def get(self, user_id):
         """获取单个用户信息"""
         try:
-            user = User.query.get_or_404(user_id)
-            return user.to_dict(), 200
-            
+            # 只查询需要的列，不构建 ORM 对象
+            user = user_serializer.from_request().one(user_id)
+            if user is None:
+                return {'error': 'User not found'}, 404
+            return json_response(user)
+            
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_users.doc('update_user')
     @ns_users.expect(update_user_model)
@@ -372,11 +514,9 @@ class UserResource(Resource):
             if 'is_admin' in data:
                 user.is_admin = data['is_admin']
             
-            # 更新角色
+            # 更新角色（只写入新增和删除的关联）
             if 'role_ids' in data:
-                user.roles = []
-                roles = Role.query.filter(Role.id.in_(data['role_ids'])).all()
-                user.roles.extend(roles)
+                set_user_roles(db.session, user, parse_ids(data['role_ids']))
             
             db.session.commit()
             
@@ -401,31 +541,35 @@ class UserResource(Resource):
 # 角色管理接口
 @ns_roles.route('/')
 class RoleList(Resource):
-    @ns_roles.doc('list_roles')
-    @ns_roles.marshal_list_with(role_model)
+    @ns_roles.doc('list_roles', params=dict(page='页码（默认: 1）', per_page='每页数量', **fields_params))
+    @ns_roles.response(200, 'Success', role_page_model)
+    @read_replica
     def get(self):
         """获取角色列表"""
         try:
             # 分页参数
             page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 10, type=int)
+            per_page = page_size(10)
             
-            # 查询角色
-            roles = Role.query.order_by(Role.created_at.desc()).paginate(page=page, per_page=per_page)
+            # 只查询需要的列（本页所有角色的用户数量由一条分组查询统计）
+            serializer = role_serializer.from_request()
+            roles = Role.query.with_entities(*serializer.columns).order_by(Role.created_at.desc()).paginate(page=page, per_page=per_page)
             
             # 构建响应
             response = {
-                'roles': [role.to_dict() for role in roles.items],
+                'roles': serializer(roles.items),
                 'total': roles.total,
                 'pages': roles.pages,
                 'current_page': roles.page,
                 'per_page': roles.per_page
             }
             
-            return response, 200
+            return json_response(response)
             
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_roles.doc('create_role')
     @ns_roles.expect(create_role_model)
@@ -463,16 +607,21 @@ class RoleList(Resource):
 @ns_roles.response(404, 'Role not found')
 @ns_roles.param('role_id', '角色ID')
 class RoleResource(Resource):
-    @ns_roles.doc('get_role')
-    @ns_roles.marshal_with(role_model)
+    @ns_roles.doc('get_role', params=fields_params)
+    @ns_roles.response(200, 'Success', role_model)
     def get(self, role_id):
         """获取单个角色信息"""
         try:
-            role = Role.query.get_or_404(role_id)
-            return role.to_dict(), 200
-            
+            # 只查询需要的列，不构建 ORM 对象
+            role = role_serializer.from_request().one(role_id)
+            if role is None:
+                return {'error': 'Role not found'}, 404
+            return json_response(role)
+            
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_roles.doc('update_role')
     @ns_roles.expect(update_role_model)
@@ -504,8 +653,8 @@ class RoleResource(Resource):
             role = Role.query.get_or_404(role_id)
             
             # 检查角色是否有用户关联
-            if role.users:
-                return jsonify({'error': 'Role has associated users, cannot delete'}), 400
+            if role.has_users():
+                return {'error': 'Role has associated users, cannot delete'}, 400
             
             db.session.delete(role)
             db.session.commit()
@@ -518,114 +667,113 @@ class RoleResource(Resource):
 @ns_roles.response(404, 'Role not found')
 @ns_roles.param('role_id', '角色ID')
 class RoleUsers(Resource):
-    @ns_roles.doc('get_role_users')
-    @ns_roles.marshal_list_with(user_model)
+    @ns_roles.doc('get_role_users', params=pagination_params)
+    @ns_roles.response(200, 'Success', user_page_model)
     def get(self, role_id):
         """获取角色下的用户列表"""
         try:
             role = Role.query.get_or_404(role_id)
             
-            # 分页参数
-            page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 10, type=int)
-            
-            # 查询角色下的用户
-            users = User.query.filter(User.roles.any(id=role_id)).order_by(User.created_at.desc()).paginate(page=page, per_page=per_page)
-            
-            # 构建响应
-            response = {
-                'users': [user.to_dict() for user in users.items],
-                'total': users.total,
-                'pages': users.pages,
-                'current_page': users.page,
-                'per_page': users.per_page
-            }
+            # 查询角色下的用户（支持页码分页和游标分页）
+            response = paginate_query(User.query.filter(User.roles.any(id=role_id)), User, 'users', user_serializer.from_request())
             
-            return response, 200
+            return json_response(response)
             
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_roles.doc('assign_users_to_role')
-    @ns_roles.expect({'user_ids': fields.List(fields.Integer, description='用户ID列表')})
+    @ns_roles.expect(role_users_model)
     def post(self, role_id):
-        """为角色分配用户"""
+        """为角色分配用户（已在角色中的用户保持不变），返回分配数量"""
         try:
             role = Role.query.get_or_404(role_id)
             data = request.get_json()
             
             if not data or 'user_ids' not in data:
-                return jsonify({'error': 'User IDs are required'}), 400
+                return {'error': 'User IDs are required'}, 400
+            
+            # INSERT ... SELECT 批量写入关联，不加载用户对象
+            result = add_role_users(db.session, role.id, parse_ids(data['user_ids']))
+            db.session.commit()
+            
+            return dict(result, message=f'{result["added"]} users assigned to role successfully'), 200
             
-            # 获取要分配的用户
-            users = User.query.filter(User.id.in_(data['user_ids'])).all()
+        except InvalidIds:
+            return {'error': 'User IDs must be a list of integers'}, 400
+        except Exception as e:
+            db.session.rollback()
+            return {'error': str(e)}, 500
+
+    @ns_roles.doc('sync_role_users')
+    @ns_roles.expect(role_users_model)
+    def put(self, role_id):
+        """把角色的用户替换为指定的用户列表（只写入新增和删除的差异），返回变更数量"""
+        try:
+            role = Role.query.get_or_404(role_id)
+            data = request.get_json()
             
-            # 分配用户到角色
-            for user in users:
-                if role not in user.roles:
-                    user.roles.append(role)
+            if not data or 'user_ids' not in data:
+                return {'error': 'User IDs are required'}, 400
             
+            result = sync_role_users(db.session, role.id, parse_ids(data['user_ids']))
             db.session.commit()
             
-            return jsonify({'message': f'{len(users)} users assigned to role successfully'}), 200
+            return dict(result, message=f'{result["added"]} users added to and {result["removed"]} users removed from role successfully'), 200
             
+        except InvalidIds:
+            return {'error': 'User IDs must be a list of integers'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            db.session.rollback()
+            return {'error': str(e)}, 500
 
     @ns_roles.doc('remove_users_from_role')
-    @ns_roles.expect({'user_ids': fields.List(fields.Integer, description='用户ID列表')})
+    @ns_roles.expect(role_users_model)
     def delete(self, role_id):
-        """从角色中移除用户"""
+        """从角色中移除用户，返回移除数量"""
         try:
             role = Role.query.get_or_404(role_id)
             data = request.get_json()
             
             if not data or 'user_ids' not in data:
-                return jsonify({'error': 'User IDs are required'}), 400
-            
-            # 获取要移除的用户
-            users = User.query.filter(User.id.in_(data['user_ids'])).all()
-            
-            # 从角色中移除用户
-            for user in users:
-                if role in user.roles:
-                    user.roles.remove(role)
+                return {'error': 'User IDs are required'}, 400
             
+            # 按批 DELETE 关联，不加载用户对象
+            result = remove_role_users(db.session, role.id, parse_ids(data['user_ids']))
             db.session.commit()
             
-            return jsonify({'message': f'{len(users)} users removed from role successfully'}), 200
+            return dict(result, message=f'{result["removed"]} users removed from role successfully'), 200
             
+        except InvalidIds:
+            return {'error': 'User IDs must be a list of integers'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            db.session.rollback()
+            return {'error': str(e)}, 500
 
 # 智能体管理接口
 @ns_agents.route('/')
 class AgentList(Resource):
-    @ns_agents.doc('list_agents')
-    @ns_agents.marshal_list_with(agent_model)
+    @ns_agents.doc('list_agents', params=pagination_params)
+    @ns_agents.response(200, 'Success', agent_page_model)
+    @read_replica
     def get(self):
         """获取智能体列表"""
         try:
-            # 分页参数
-            page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 10, type=int)
-            
-            # 查询智能体
-            agents = Agent.query.order_by(Agent.created_at.desc()).paginate(page=page, per_page=per_page)
-            
-            # 构建响应
-            response = {
-                'agents': [agent.to_dict() for agent in agents.items],
-                'total': agents.total,
-                'pages': agents.pages,
-                'current_page': agents.page,
-                'per_page': agents.per_page
-            }
+            # 查询智能体（支持页码分页和游标分页）
+            response = paginate_query(Agent.query, Agent, 'agents', agent_serializer.from_request())
             
-            return response, 200
+            return json_response(response)
             
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_agents.doc('create_agent')
     @ns_agents.expect(create_agent_model)
@@ -661,7 +809,9 @@ class AgentList(Resource):
                 model_frequency_penalty=data.get('model_frequency_penalty', 0.0),
                 model_stop_sequences=','.join(data.get('model_stop_sequences', [])) if data.get('model_stop_sequences') else None,
                 model_context_window=data.get('model_context_window', 4096),
-                model_system_prompt=data.get('model_system_prompt')
+                model_system_prompt=data.get('model_system_prompt'),
+                max_concurrency=data.get('max_concurrency'),
+                completion_cache_enabled=bool(data.get('completion_cache_enabled', False))
             )
             
             # 添加到数据库
@@ -669,13 +819,7 @@ class AgentList(Resource):
             db.session.commit()
             
             # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Agent "{agent.name}" created with status "{agent.status}"' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            log_writer.write(agent.id, 'info', f'Agent "{agent.name}" created with status "{agent.status}"')
             
             return agent.to_dict(), 201
             
@@ -686,16 +830,21 @@ class AgentList(Resource):
 @ns_agents.response(404, 'Agent not found')
 @ns_agents.param('agent_id', '智能体ID')
 class AgentResource(Resource):
-    @ns_agents.doc('get_agent')
-    @ns_agents.marshal_with(agent_model)
+    @ns_agents.doc('get_agent', params=fields_params)
+    @ns_agents.response(200, 'Success', agent_model)
     def get(self, agent_id):
         """获取单个智能体信息"""
         try:
-            agent = Agent.query.get_or_404(agent_id)
-            return agent.to_dict(), 200
-            
+            # 只查询需要的列，不构建 ORM 对象
+            agent = agent_serializer.from_request().one(agent_id)
+            if agent is None:
+                return {'error': 'Agent not found'}, 404
+            return json_response(agent)
+            
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
     @ns_agents.doc('update_agent')
     @ns_agents.expect(update_agent_model)
@@ -743,18 +892,16 @@ class AgentResource(Resource):
                 agent.model_context_window = data['model_context_window']
             if 'model_system_prompt' in data:
                 agent.model_system_prompt = data['model_system_prompt']
+            if 'max_concurrency' in data:
+                agent.max_concurrency = data['max_concurrency']
+            if 'completion_cache_enabled' in data:
+                agent.completion_cache_enabled = bool(data['completion_cache_enabled'])
             
             # 提交更新
             db.session.commit()
             
             # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Agent "{agent.name}" updated'
-            )
-            db.session.add(log)
-            db.session.commit()
+            log_writer.write(agent.id, 'info', f'Agent "{agent.name}" updated')
             
             return agent.to_dict(), 200
             
@@ -769,13 +916,7 @@ class AgentResource(Resource):
             agent = Agent.query.get_or_404(agent_id)
             
             # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Agent "{agent.name}" deleted'
-            )
-            db.session.add(log)
-            db.session.commit()
+            log_writer.write(agent.id, 'info', f'Agent "{agent.name}" deleted')
             
             # 删除智能体
             db.session.delete(agent)
@@ -813,19 +954,96 @@ class AgentStatus(Resource):
             db.session.commit()
             
             # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Agent "{agent.name}" status changed from "{old_status}" to "{agent.status}"' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            log_writer.write(agent.id, 'info', f'Agent "{agent.name}" status changed from "{old_status}" to "{agent.status}"')
             
             return agent.to_dict(), 200
             
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+def prepare_turns(agent, turns, source, ensure_system_prompt=True):
+    """批量准备多轮对话：获取或创建会话并写入用户消息（单次提交）
+
+    turns 为 (会话ID, 用户消息) 列表，会话ID为空时创建新会话。返回与 turns 对应的
+    (会话主键, 会话ID, 包含本轮消息的上下文)，会话不存在的项为 None。
+    """
+    # 一次查询所有已有会话，再读取各会话的上下文（缓存命中时只加载新增的消息）
+    requested_ids = requested_conversation_ids(turns)
+    conversations = {}
+    if requested_ids:
+        conversations = {conversation.conversation_id: conversation for conversation in db.session.execute(conversations_query(agent.id, requested_ids)).scalars()}
+    loaded = {}
+    for conversation in conversations.values():
+        cached = context_cache.get(conversation.id)
+        loaded[conversation.id] = (cached, db.session.execute(context_rows_query(conversation.id, cached)).all())
+    
+    batch = TurnBatch(agent, turns, conversations, loaded, ensure_system_prompt)
+    if batch.backfill:
+        db.session.execute(update(Message), batch.backfill)
+    if batch.created:
+        db.session.add_all(batch.created)
+        db.session.flush()
+    db.session.add_all(batch.build_messages())
+    db.session.flush()
+    saved = batch.saved()
+    db.session.commit()
+    return batch.remember(agent, source, saved)
+
+def prepare_turn(agent, conversation_id, content, source, ensure_system_prompt=True):
+    """准备一轮对话：获取或创建会话并写入用户消息（单次提交），返回会话和包含本轮消息的上下文"""
+    prepared = prepare_turns(agent, [(conversation_id, content)], source, ensure_system_prompt)[0]
+    if prepared is None:
+        raise ConversationNotFound(conversation_id)
+    return prepared
+
+def save_turns(agent_id, turns):
+    """批量保存助手消息（单次提交）并记录日志，并追加到会话上下文缓存
+
+    turns 为 (会话主键, 上下文, 回复内容, 日志内容) 列表。
+    """
+    messages = assistant_messages(turns)
+    db.session.add_all(messages)
+    db.session.flush()
+    rows = message_rows(messages)
+    db.session.commit()
+    remember_replies(agent_id, turns, rows)
+
+def save_turn(agent_id, conversation_pk, context, content, log_message):
+    """保存助手消息（单次提交）并记录日志，并追加到会话上下文缓存"""
+    save_turns(agent_id, [(conversation_pk, context, content, log_message)])
+
+def call_model(agent, request_data, slot):
+    """占用 slot 的并发名额调用模型并记录调用指标，返回响应数据"""
+    with slot:
+        started = time.perf_counter()
+        response_data = model_client.chat_completions(agent, request_data).json()
+        record_model_call(time.perf_counter() - started, response_data.get('usage'))
+    return response_data
+
+def build_turn_request(agent, conversation_pk, context, slot, temperature=None, max_tokens=None):
+    """按上下文窗口截断历史（可选为截断部分生成摘要）并构建模型请求参数，返回请求参数和上下文统计
+
+    生成摘要需要调用模型，此时占用 slot 的并发名额。
+    """
+    request_data, context_stats, summary_request = plan_turn_request(agent, conversation_pk, context, temperature, max_tokens)
+    if summary_request is not None:
+        key, summary_data = summary_request
+        try:
+            apply_summary(request_data, key, call_model(agent, summary_data, slot))
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError):
+            # 摘要失败时只做截断，不影响本轮对话
+            pass
+    return request_data, context_stats
+
+def request_completion(agent, request_data, slot):
+    """获取模型回复，返回 (响应数据, 是否命中补全缓存)；未命中时占用 slot 的并发名额调用模型"""
+    key, response_data = cached_completion(agent, request_data)
+    if response_data is not None:
+        return response_data, True
+    response_data = call_model(agent, request_data, slot)
+    store_completion(key, response_data)
+    return response_data, False
+
 @ns_agents.route('/<int:agent_id>/chat')
 @ns_agents.response(404, 'Agent not found')
 @ns_agents.param('agent_id', '智能体ID')
@@ -835,123 +1053,81 @@ class AgentChat(Resource):
     def post(self, agent_id):
         """直接与智能体对话（自动管理会话）"""
         try:
-            agent = Agent.query.get_or_404(agent_id)
+            # 智能体配置优先使用进程内缓存
+            agent = get_agent_config(db.session, agent_id)
+            if agent is None:
+                return {'error': 'Agent not found'}, 404
             
             data = request.get_json()
             if not data or 'content' not in data:
-                return jsonify({'error': 'Content is required'}), 400
-            
-            # 获取或创建会话
-            conversation_id = data.get('conversation_id')
-            if conversation_id:
-                conversation = Conversation.query.filter_by(agent_id=agent.id, conversation_id=conversation_id).first()
-                if not conversation:
-                    return jsonify({'error': 'Conversation not found'}), 404
-            else:
-                # 创建新会话
-                conversation_id = str(uuid.uuid4())
-                conversation = Conversation(
-                    agent_id=agent.id,
-                    conversation_id=conversation_id
-                )
-                db.session.add(conversation)
-                db.session.commit()
-                
-                # 添加日志
-                log = AgentLog(
-                    agent_id=agent.id,
-                    level='info',
-                    message=f'Conversation "{conversation_id}" created for agent "{agent.name}" via chat API' 
-                )
-                db.session.add(log)
-                db.session.commit()
+                return {'error': 'Content is required'}, 400
             
-            # 添加用户消息
-            user_message = Message(
-                conversation_id=conversation.id,
-                role='user',
-                content=data['content']
-            )
-            db.session.add(user_message)
-            db.session.commit()
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = model_scheduler.slot(agent)
             
-            # 获取会话历史
-            messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
-            
-            # 如果有系统提示词，确保它是第一条消息
-            if agent.model_system_prompt:
-                # 检查是否已经有系统消息
-                has_system_message = any(msg.role == 'system' for msg in messages)
-                if not has_system_message:
-                    # 在消息列表开头插入系统提示词
-                    system_message = Message(
-                        conversation_id=conversation.id,
-                        role='system',
-                        content=agent.model_system_prompt
-                    )
-                    db.session.add(system_message)
-                    db.session.commit()
-                    # 重新获取消息列表
-                    messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+            # 获取或创建会话并添加用户消息
+            try:
+                conversation_pk, conversation_id, context = prepare_turn(agent, data.get('conversation_id'), data['content'], 'chat')
+            except ConversationNotFound:
+                return {'error': 'Conversation not found'}, 404
             
             # 构建请求参数
-            request_data = {
-                'model': agent.model_name,
-                'messages': [{'role': msg.role, 'content': msg.content} for msg in messages],
-                'temperature': agent.model_temperature,
-                'max_tokens': agent.model_max_tokens,
-                'top_p': agent.model_top_p,
-                'top_k': agent.model_top_k,
-                'presence_penalty': agent.model_presence_penalty,
-                'frequency_penalty': agent.model_frequency_penalty
-            }
-            
-            # 添加停止序列（如果有的话）
-            if agent.model_stop_sequences:
-                request_data['stop'] = agent.model_stop_sequences.split(',')
-            
-            # 发送请求到模型API
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            if agent.model_provider == 'openai' and agent.model_api_key:
-                headers['Authorization'] = f'Bearer {agent.model_api_key}'
+            request_data, context_stats = build_turn_request(agent, conversation_pk, context, slot)
             
-            response = requests.post(f'{agent.model_api_url}/chat/completions', json=request_data, headers=headers)
-            response.raise_for_status()
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            response_data, _ = request_completion(agent, request_data, slot)
             
             # 解析模型响应
-            response_data = response.json()
-            assistant_message_content = response_data['choices'][0]['message']['content']
-            
-            # 添加助手消息
-            assistant_message = Message(
-                conversation_id=conversation.id,
-                role='assistant',
-                content=assistant_message_content
-            )
-            db.session.add(assistant_message)
-            db.session.commit()
+            assistant_message_content = extract_completion_content(response_data)
             
-            # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Message exchanged in conversation "{conversation_id}" for agent "{agent.name}" via chat API' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            # 添加助手消息和日志
+            save_turn(agent.id, conversation_pk, context, assistant_message_content, chat_log_message(agent, conversation_id, 'chat'))
             
-            return jsonify({
+            return {
                 'message': 'Message sent successfully',
                 'response': assistant_message_content,
                 'conversation_id': conversation_id
-            }), 200
+            }, 200
             
+        except ModelCallRejected as e:
+            return {'error': str(e)}, e.status_code
         except requests.exceptions.RequestException as e:
-            return jsonify({'error': f'Model API error: {str(e)}'}), 500
+            return {'error': f'Model API error: {str(e)}'}, 500
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            db.session.rollback()
+            return {'error': str(e)}, 500
+
+def stream_invoke_events(agent, conversation_pk, context, conversation_id, user_input, request_data, context_stats, response, model_started):
+    """逐块转发上游模型的 SSE 响应，流结束后保存完整的助手消息
+
+    model_started 为发起模型请求的时间，用于计算首字时间和模型调用耗时。
+    """
+    relay = StreamRelay(model_started)
+    try:
+        # 按字节逐行读取再按 UTF-8 解码：Ollama 的 text/event-stream 不带 charset，requests 会按 ISO-8859-1 解码
+        for line in response.iter_lines():
+            event = relay.feed(line.decode('utf-8', errors='replace'))
+            if relay.done:
+                break
+            if event:
+                yield event
+    except requests.exceptions.RequestException as e:
+        yield stream_error_event(f'Model API error: {str(e)}')
+        return
+    finally:
+        response.close()
+    assistant_message_content = relay.finish()
+    
+    try:
+        # 添加助手消息和日志
+        save_turn(agent.id, conversation_pk, context, assistant_message_content, invoke_log_message(agent, user_input, 'stream'))
+    except Exception as e:
+        db.session.rollback()
+        yield stream_error_event(str(e))
+        return
+    
+    # 发送最终结果，格式与非流式响应一致
+    yield from stream_done_events(agent, conversation_id, assistant_message_content, request_data, context_stats)
 
 @ns_agents.route('/<int:agent_id>/invoke')
 @ns_agents.response(404, 'Agent not found')
@@ -962,167 +1138,204 @@ class AgentInvoke(Resource):
     def post(self, agent_id):
         """调用智能体（支持灵活的会话管理和参数配置）"""
         try:
-            agent = Agent.query.get_or_404(agent_id)
+            # 智能体配置优先使用进程内缓存
+            agent = get_agent_config(db.session, agent_id)
+            if agent is None:
+                return {'error': 'Agent not found'}, 404
             
             data = request.get_json()
             if not data or 'input' not in data:
-                return jsonify({'error': 'Input is required'}), 400
-            
-            # 获取或创建会话
-            conversation_id = data.get('conversation_id')
-            if conversation_id:
-                conversation = Conversation.query.filter_by(agent_id=agent.id, conversation_id=conversation_id).first()
-                if not conversation:
-                    return jsonify({'error': 'Conversation not found'}), 404
-            else:
-                # 创建新会话
-                conversation_id = str(uuid.uuid4())
-                conversation = Conversation(
-                    agent_id=agent.id,
-                    conversation_id=conversation_id
-                )
-                db.session.add(conversation)
-                db.session.commit()
-                
-                # 添加日志
-                log = AgentLog(
-                    agent_id=agent.id,
-                    level='info',
-                    message=f'Conversation "{conversation_id}" created for agent "{agent.name}" via invoke API' 
-                )
-                db.session.add(log)
-                db.session.commit()
+                return {'error': 'Input is required'}, 400
             
-            # 添加用户消息
-            user_message = Message(
-                conversation_id=conversation.id,
-                role='user',
-                content=data['input']
-            )
-            db.session.add(user_message)
-            db.session.commit()
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = model_scheduler.slot(agent)
             
-            # 获取会话历史
-            messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
-            
-            # 如果有系统提示词，确保它是第一条消息
-            if agent.model_system_prompt:
-                # 检查是否已经有系统消息
-                has_system_message = any(msg.role == 'system' for msg in messages)
-                if not has_system_message:
-                    # 在消息列表开头插入系统提示词
-                    system_message = Message(
-                        conversation_id=conversation.id,
-                        role='system',
-                        content=agent.model_system_prompt
-                    )
-                    db.session.add(system_message)
-                    db.session.commit()
-                    # 重新获取消息列表
-                    messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+            # 获取或创建会话并添加用户消息
+            try:
+                conversation_pk, conversation_id, context = prepare_turn(agent, data.get('conversation_id'), data['input'], 'invoke')
+            except ConversationNotFound:
+                return {'error': 'Conversation not found'}, 404
             
             # 构建请求参数，支持覆盖智能体配置
-            request_data = {
-                'model': agent.model_name,
-                'messages': [{'role': msg.role, 'content': msg.content} for msg in messages],
-                'temperature': data.get('temperature', agent.model_temperature),
-                'max_tokens': data.get('max_tokens', agent.model_max_tokens),
-                'top_p': agent.model_top_p,
-                'top_k': agent.model_top_k,
-                'presence_penalty': agent.model_presence_penalty,
-                'frequency_penalty': agent.model_frequency_penalty
-            }
-            
-            # 添加停止序列（如果有的话）
-            if agent.model_stop_sequences:
-                request_data['stop'] = agent.model_stop_sequences.split(',')
-            
-            # 发送请求到模型API
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            if agent.model_provider == 'openai' and agent.model_api_key:
-                headers['Authorization'] = f'Bearer {agent.model_api_key}'
+            request_data, context_stats = build_turn_request(agent, conversation_pk, context, slot, temperature=data.get('temperature'), max_tokens=data.get('max_tokens'))
+            
+            # 流式响应：转发上游 SSE 数据块，结束后再保存助手消息（并发名额在响应结束后释放）
+            if data.get('stream'):
+                enable_stream(request_data)
+                with slot:
+                    model_started = time.perf_counter()
+                    response = model_client.chat_completions(agent, request_data, stream=True)
+                    context_stats['queue_wait'] = round(slot.wait_time, 3)
+                    events = Response(
+                        stream_with_context(stream_invoke_events(agent, conversation_pk, context, conversation_id, data['input'], request_data, context_stats, response, model_started)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                    )
+                    events.call_on_close(slot.detach())
+                    return events
             
-            response = requests.post(f'{agent.model_api_url}/chat/completions', json=request_data, headers=headers)
-            response.raise_for_status()
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            response_data, cache_hit = request_completion(agent, request_data, slot)
+            record_completion_stats(context_stats, slot, cache_hit)
             
             # 解析模型响应
-            response_data = response.json()
-            assistant_message_content = response_data['choices'][0]['message']['content']
-            
-            # 添加助手消息
-            assistant_message = Message(
-                conversation_id=conversation.id,
-                role='assistant',
-                content=assistant_message_content
-            )
-            db.session.add(assistant_message)
-            db.session.commit()
+            assistant_message_content = extract_completion_content(response_data)
             
-            # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Agent "{agent.name}" invoked with input: {data["input"]}' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            # 添加助手消息和日志
+            save_turn(agent.id, conversation_pk, context, assistant_message_content, invoke_log_message(agent, data['input']))
             
-            # 构建响应
-            result = {
-                'success': True,
-                'output': assistant_message_content,
-                'conversation_id': conversation_id,
-                'metadata': {
-                    'agent_id': agent.id,
-                    'agent_name': agent.name,
-                    'model_name': agent.model_name,
-                    'temperature': request_data['temperature'],
-                    'max_tokens': request_data['max_tokens'],
-                    'created_at': datetime.utcnow().isoformat()
-                }
-            }
+            # 构建响应（附带耗时分解：数据库、模型调用、排队和其余处理时间）
+            result = build_invoke_result(agent, conversation_id, assistant_message_content, request_data, attach_timings(context_stats))
             
-            return jsonify(result), 200
+            return result, 200
             
+        except ModelCallRejected as e:
+            return {'error': str(e)}, e.status_code
         except requests.exceptions.RequestException as e:
-            return jsonify({'error': f'Model API error: {str(e)}'}), 500
+            return {'error': f'Model API error: {str(e)}'}, 500
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            db.session.rollback()
+            return {'error': str(e)}, 500
+
+def run_batch_item(agent, prepared, item, slot):
+    """在工作线程中完成批量调用的一项：构建请求并获取模型回复（不访问数据库）"""
+    conversation_pk, conversation_id, context = prepared
+    request_data, context_stats = build_turn_request(agent, conversation_pk, context, slot, temperature=item['temperature'], max_tokens=item['max_tokens'])
+    response_data, cache_hit = request_completion(agent, request_data, slot)
+    record_completion_stats(context_stats, slot, cache_hit)
+    return extract_completion_content(response_data), request_data, context_stats
+
+def run_invoke_batch(agent, items, prepared, slots, parallelism):
+    """并发执行批量调用，按完成顺序逐项产出结果
+
+    已完成的回复攒成一批后统一保存（单次提交），没有更多立即可用的结果或达到 INVOKE_BATCH_COMMIT_SIZE 时提交。
+    """
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='invoke-batch')
+    try:
+        futures = {}
+        for index, (item, turn, slot) in enumerate(zip(items, prepared, slots)):
+            if turn is None:
+                yield build_batch_error(index, item['conversation_id'], 'Conversation not found')
+                continue
+            # 工作线程继承请求上下文，模型调用计入本次请求的指标
+            futures[executor.submit(contextvars.copy_context().run, run_batch_item, agent, turn, item, slot)] = index
+        
+        pending = set(futures)
+        completed = []
+        while pending or completed:
+            done, pending = wait(pending, timeout=0 if completed else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                try:
+                    completed.append((index,) + future.result())
+                except Exception as e:
+                    failure = batch_failure(index, prepared[index][1], e, requests.exceptions.RequestException)
+                    if failure is None:
+                        raise
+                    yield failure
+            
+            if batch_should_save(completed, done, pending):
+                # 添加助手消息和日志
+                try:
+                    save_turns(agent.id, batch_replies(agent, items, prepared, completed))
+                except Exception as e:
+                    db.session.rollback()
+                    yield from batch_save_errors(prepared, completed, e)
+                else:
+                    yield from batch_results(agent, prepared, completed)
+                completed = []
+    finally:
+        # 客户端中断流式响应时不再发起新的模型调用
+        executor.shutdown(wait=False, cancel_futures=True)
+
+@ns_agents.route('/<int:agent_id>/invoke/batch')
+@ns_agents.response(404, 'Agent not found')
+@ns_agents.param('agent_id', '智能体ID')
+class AgentInvokeBatch(Resource):
+    @ns_agents.doc('invoke_agent_batch')
+    @ns_agents.expect(invoke_batch_model)
+    def post(self, agent_id):
+        """批量调用智能体（并发调用模型，批量保存消息）"""
+        try:
+            # 智能体配置优先使用进程内缓存
+            agent = get_agent_config(db.session, agent_id)
+            if agent is None:
+                return {'error': 'Agent not found'}, 404
+            
+            # 请求体缺失、不是 JSON 或不是对象时由 parse_invoke_batch 返回 400
+            data = request.get_json(silent=True)
+            try:
+                items, parallelism = parse_invoke_batch(data)
+            except InvalidBatch as e:
+                return {'error': str(e)}, 400
+            
+            # 检查智能体状态，每项调用各自占用并发名额
+            slots = [model_scheduler.slot(agent) for _ in items]
+            
+            # 一次提交写入所有新会话和用户消息
+            prepared = prepare_turns(agent, [(item['conversation_id'], item['input']) for item in items], 'invoke')
+            
+            results = run_invoke_batch(agent, items, prepared, slots, parallelism)
+            
+            # 流式响应：按完成顺序每行返回一项结果
+            if data.get('stream'):
+                return Response(
+                    stream_with_context(json.dumps(result, ensure_ascii=False) + '\n' for result in results),
+                    mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'}
+                )
+            
+            results = sorted(results, key=lambda result: result['index'])
+            succeeded = sum(1 for result in results if result['success'])
+            return {
+                'results': results,
+                'succeeded': succeeded,
+                'failed': len(results) - succeeded
+            }, 200
+            
+        except ModelCallRejected as e:
+            return {'error': str(e)}, e.status_code
+        except Exception as e:
+            db.session.rollback()
+            return {'error': str(e)}, 500
+
+@ns_agents.route('/scheduler')
+class ModelSchedulerStats(Resource):
+    @ns_agents.doc('get_model_scheduler_stats')
+    def get(self):
+        """获取模型调用调度状态（各模型API地址和智能体的并发数、队列深度、等待时间）"""
+        return model_scheduler.stats(), 200
 
 @ns_agents.route('/<int:agent_id>/logs')
 @ns_agents.response(404, 'Agent not found')
 @ns_agents.param('agent_id', '智能体ID')
 class AgentLogs(Resource):
-    @ns_agents.doc('get_agent_logs')
-    @ns_agents.marshal_list_with(log_model)
+    @ns_agents.doc('get_agent_logs', params=log_pagination_params)
+    @ns_agents.response(200, 'Success', log_page_model)
+    @read_replica
     def get(self, agent_id):
         """获取智能体日志"""
         try:
             # 验证智能体是否存在
             agent = Agent.query.get_or_404(agent_id)
             
-            # 分页参数
-            page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 20, type=int)
-            
-            # 查询日志
-            logs = AgentLog.query.filter_by(agent_id=agent_id).order_by(AgentLog.created_at.desc()).paginate(page=page, per_page=per_page)
-            
-            # 构建响应
-            response = {
-                'logs': [log.to_dict() for log in logs.items],
-                'total': logs.total,
-                'pages': logs.pages,
-                'current_page': logs.page,
-                'per_page': logs.per_page
-            }
+            # 查询日志（支持页码分页和游标分页，开启分区时跨月份的分桶读取）
+            serializer = log_serializer.from_request()
+            if request.args.get('archive'):
+                response = log_store.paginate_archive(request.args['archive'], agent_id, 'logs', default_per_page=20, serializer=serializer)
+            else:
+                response = log_store.paginate(db.session, agent_id, 'logs', default_per_page=20, serializer=serializer)
             
-            return response, 200
+            return json_response(response)
             
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
+        except InvalidArchiveMonth:
+            return {'error': 'Invalid archive month, expected YYYY-MM'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
 # 会话管理接口
 @ns_conversations.route('/agents/<int:agent_id>/conversations')
@@ -1149,13 +1362,7 @@ class ConversationList(Resource):
             db.session.commit()
             
             # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Conversation "{conversation_id}" created for agent "{agent.name}"' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            log_writer.write(agent.id, 'info', f'Conversation "{conversation_id}" created for agent "{agent.name}"')
             
             return conversation.to_dict(), 201
             
@@ -1172,124 +1379,146 @@ class MessageList(Resource):
     def post(self, agent_id, conversation_id):
         """发送消息并获取智能体响应"""
         try:
-            agent = Agent.query.get_or_404(agent_id)
-            conversation = Conversation.query.filter_by(agent_id=agent.id, conversation_id=conversation_id).first_or_404()
+            # 智能体配置优先使用进程内缓存
+            agent = get_agent_config(db.session, agent_id)
+            if agent is None:
+                return {'error': 'Agent not found'}, 404
             
             data = request.get_json()
             if not data or 'content' not in data:
-                return jsonify({'error': 'Content is required'}), 400
+                return {'error': 'Content is required'}, 400
             
-            # 添加用户消息
-            user_message = Message(
-                conversation_id=conversation.id,
-                role='user',
-                content=data['content']
-            )
-            db.session.add(user_message)
-            db.session.commit()
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = model_scheduler.slot(agent)
             
-            # 获取会话历史
-            messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+            # 添加用户消息
+            try:
+                conversation_pk, conversation_id, context = prepare_turn(agent, conversation_id, data['content'], 'message', ensure_system_prompt=False)
+            except ConversationNotFound:
+                return {'error': 'Conversation not found'}, 404
             
             # 构建请求参数
-            request_data = {
-                'model': agent.model_name,
-                'messages': [{'role': msg.role, 'content': msg.content} for msg in messages],
-                'temperature': agent.model_temperature,
-                'max_tokens': agent.model_max_tokens,
-                'top_p': agent.model_top_p,
-                'top_k': agent.model_top_k,
-                'presence_penalty': agent.model_presence_penalty,
-                'frequency_penalty': agent.model_frequency_penalty
-            }
+            request_data, context_stats = build_turn_request(agent, conversation_pk, context, slot)
             
-            # 添加停止序列（如果有的话）
-            if agent.model_stop_sequences:
-                request_data['stop'] = agent.model_stop_sequences.split(',')
-            
-            # 发送请求到模型API
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            if agent.model_provider == 'openai' and agent.model_api_key:
-                headers['Authorization'] = f'Bearer {agent.model_api_key}'
-            
-            response = requests.post(f'{agent.model_api_url}/chat/completions', json=request_data, headers=headers)
-            response.raise_for_status()
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            response_data, _ = request_completion(agent, request_data, slot)
             
             # 解析模型响应
-            response_data = response.json()
-            assistant_message_content = response_data['choices'][0]['message']['content']
-            
-            # 添加助手消息
-            assistant_message = Message(
-                conversation_id=conversation.id,
-                role='assistant',
-                content=assistant_message_content
-            )
-            db.session.add(assistant_message)
-            db.session.commit()
+            assistant_message_content = extract_completion_content(response_data)
             
-            # 添加日志
-            log = AgentLog(
-                agent_id=agent.id,
-                level='info',
-                message=f'Message exchanged in conversation "{conversation_id}" for agent "{agent.name}"' 
-            )
-            db.session.add(log)
-            db.session.commit()
+            # 添加助手消息和日志
+            save_turn(agent.id, conversation_pk, context, assistant_message_content, chat_log_message(agent, conversation_id))
             
-            return jsonify({'message': 'Message sent successfully', 'response': assistant_message_content}), 200
+            return {'message': 'Message sent successfully', 'response': assistant_message_content}, 200
             
+        except ModelCallRejected as e:
+            return {'error': str(e)}, e.status_code
         except requests.exceptions.RequestException as e:
-            return jsonify({'error': f'Model API error: {str(e)}'}), 500
+            return {'error': f'Model API error: {str(e)}'}, 500
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            db.session.rollback()
+            return {'error': str(e)}, 500
 
-    @ns_conversations.doc('get_conversation_messages')
-    @ns_conversations.marshal_list_with(message_model)
+    @ns_conversations.doc('get_conversation_messages', params={
+        'after_id': '只返回消息ID大于该值的消息（分段获取时传上一段最后一条消息的ID）',
+        'limit': f'最多返回的消息条数（最大 {MESSAGE_WINDOW_MAX_LIMIT}，不传时返回全部）',
+        'format': '返回格式：json（默认）或 ndjson（流式导出，每行一条消息，可与 after_id、limit 一起使用）'
+    })
+    @ns_conversations.response(200, 'Success', [message_model])
+    @read_replica
     def get(self, agent_id, conversation_id):
         """获取会话历史消息"""
         try:
+            # 刚写入过的会话从主库读取，避免副本延迟导致看不到刚发送的消息
+            # （本进程的写入记录，或客户端带回的写入标记：写入可能发生在其他进程）
+            if recent_writes.is_recent(agent_id, conversation_id) or client_wrote_recently(request.headers, request.cookies):
+                use_primary()
             agent = Agent.query.get_or_404(agent_id)
             conversation = Conversation.query.filter_by(agent_id=agent.id, conversation_id=conversation_id).first_or_404()
             
-            # 获取会话历史
-            messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+            after_id = request.args.get('after_id', type=int)
+            limit = request.args.get('limit', type=int)
+            
+            if limit is not None and limit <= 0:
+                return {'error': 'limit must be a positive integer'}, 400
+            
+            # 流式导出：分块读取并逐行写出，不在内存中构建完整历史（limit 不受 MESSAGE_WINDOW_MAX_LIMIT 限制）
+            if request.args.get('format') == 'ndjson':
+                return Response(
+                    stream_with_context(iter_messages_ndjson(db.session, conversation.id, after_id, limit)),
+                    mimetype='application/x-ndjson',
+                    headers={'X-Accel-Buffering': 'no'}
+                )
+            
+            if limit is not None:
+                limit = min(limit, MESSAGE_WINDOW_MAX_LIMIT)
+            
+            # 获取会话历史（按消息ID升序，支持 after_id/limit 分段获取）
+            rows = db.session.execute(message_window_query(conversation.id, after_id, limit)).all()
             
-            return [msg.to_dict() for msg in messages], 200
+            return [message_row_to_dict(row) for row in rows], 200
             
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
 
 # 日志管理接口
 @ns_logs.route('/')
 class LogList(Resource):
-    @ns_logs.doc('get_all_logs')
-    @ns_logs.marshal_list_with(log_model)
+    @ns_logs.doc('get_all_logs', params=log_pagination_params)
+    @ns_logs.response(200, 'Success', log_page_model)
+    @read_replica
     def get(self):
         """获取所有智能体日志"""
         try:
-            # 分页参数
-            page = request.args.get('page', 1, type=int)
-            per_page = request.args.get('per_page', 20, type=int)
-            
-            # 查询日志
-            logs = AgentLog.query.order_by(AgentLog.created_at.desc()).paginate(page=page, per_page=per_page)
-            
-            # 构建响应
-            response = {
-                'logs': [log.to_dict() for log in logs.items],
-                'total': logs.total,
-                'pages': logs.pages,
-                'current_page': logs.page,
-                'per_page': logs.per_page
-            }
+            # 查询日志（支持页码分页和游标分页，archive 参数读取已归档的月份）
+            serializer = log_serializer.from_request()
+            if request.args.get('archive'):
+                response = log_store.paginate_archive(request.args['archive'], None, 'logs', default_per_page=20, serializer=serializer)
+            else:
+                response = log_store.paginate(db.session, None, 'logs', default_per_page=20, serializer=serializer)
             
-            return response, 200
+            return json_response(response)
             
+        except InvalidCursor:
+            return {'error': 'Invalid cursor'}, 400
+        except InvalidFields as e:
+            return {'error': f'Unknown fields: {e}'}, 400
+        except InvalidArchiveMonth:
+            return {'error': 'Invalid archive month, expected YYYY-MM'}, 400
         except Exception as e:
-            return jsonify({'error': str(e)}), 500
+            return {'error': str(e)}, 500
+
+@ns_logs.route('/archives')
+class LogArchiveList(Resource):
+    @ns_logs.doc('list_log_archives')
+    def get(self):
+        """获取日志归档文件列表和保留策略"""
+        archives = [{
+            'month': month.strftime('%Y-%m'),
+            'retention_days': days,
+            'size': os.path.getsize(path)
+        } for month, days, path in log_store.archives()]
+        return dict(log_store.stats(), archives=archives), 200
+
+# 系统管理接口
+@ns_admin.route('/query-profile')
+class QueryProfile(Resource):
+    @ns_admin.doc('get_query_profile', params={
+        'sort': '接口排序方式：db_time 平均数据库耗时（默认），queries 平均语句数，time 最大请求耗时',
+        'limit': '返回的接口、语句和慢请求条数（默认 20）'
+    })
+    def get(self):
+        """获取查询分析结果（数据库耗时最多的接口和语句、最近的慢请求），需设置 QUERY_PROFILER_ENABLED=true"""
+        limit = request.args.get('limit', 20, type=int)
+        if limit <= 0:
+            return {'error': 'Limit must be positive'}, 400
+        return query_profiler.report(request.args.get('sort', 'db_time'), limit), 200
+    
+    @ns_admin.doc('reset_query_profile')
+    def delete(self):
+        """清空查询分析统计"""
+        query_profiler.reset()
+        return {'message': 'Query profile reset successfully'}, 200
 
 if __name__ == '__main__':
     # 启动应用
@@ -0,0 +1,471 @@
+"""异步（ASGI）服务入口
+
+对话类接口（chat、invoke、发送消息）在事件循环中使用异步 HTTP 客户端和异步数据库会话处理，
+等待模型响应时不占用工作线程；其余 CRUD 接口仍交给 Flask 应用处理。
+
+启动方式：uvicorn asgi:application --host 0.0.0.0 --port 5001
+"""
+import json
+import time
+import asyncio
+import contextlib
+import contextvars
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.requests import Request
+from starlette.routing import Mount, Route
+from app import app as flask_app
+from db_engine import configure_engine
+from db_replica import begin_request_writes, apply_write_marker
+from models import Message
+from agent_config import get_agent_config_async
+from log_writer import log_writer
+from metrics import instrument_engine, start_request, finish_request, record_model_call
+from model_client import async_model_client
+from model_scheduler import ModelCallRejected, async_model_scheduler
+from context_cache import context_cache, context_rows_query
+from chat_pipeline import ConversationNotFound, InvalidBatch, TurnBatch, StreamRelay, conversations_query, requested_conversation_ids, message_rows, assistant_messages, remember_replies, chat_log_message, invoke_log_message, plan_turn_request, apply_summary, cached_completion, store_completion, enable_stream, record_completion_stats, extract_completion_content, attach_timings, build_invoke_result, stream_done_events, stream_error_event, parse_invoke_batch, build_batch_error, batch_failure, batch_should_save, batch_replies, batch_results, batch_save_errors
+
+def to_async_database_uri(uri):
+    """将同步数据库连接串转换为对应的异步驱动"""
+    if uri.startswith('sqlite:'):
+        return 'sqlite+aiosqlite:' + uri[len('sqlite:'):]
+    if uri.startswith('mysql+pymysql:'):
+        return 'mysql+aiomysql:' + uri[len('mysql+pymysql:'):]
+    return uri
+
+# 异步数据库引擎和会话
+engine = create_async_engine(to_async_database_uri(flask_app.config['SQLALCHEMY_DATABASE_URI']), **flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+configure_engine(engine.sync_engine)
+async_session = async_sessionmaker(engine, expire_on_commit=False)
+instrument_engine(engine.sync_engine)
+
+class InstrumentedEndpoint:
+    """记录异步接口的请求耗时分解，endpoint 为与 Flask 路由规则相同格式的接口标签
+
+    以 ASGI 应用的形式包装处理函数，流式响应的总耗时包含整个流和后台任务。
+    """
+
+    def __init__(self, endpoint, handler):
+        self.endpoint = endpoint
+        self.handler = handler
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive, send)
+        timings, token = start_request(self.endpoint, request.method, request.path_params.get('agent_id', ''))
+        begin_request_writes()
+        try:
+            response = await self.handler(request)
+            if timings is not None:
+                timings.status = response.status_code
+            # 写入过会话时带上写入标记，客户端之后读取历史时走主库
+            apply_write_marker(response)
+            await response(scope, receive, send)
+        finally:
+            finish_request(timings, token)
+
+async def read_json(request):
+    """读取请求体 JSON，格式错误时返回 None"""
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+async def prepare_turns(session, agent, turns, source, ensure_system_prompt=True):
+    """批量准备多轮对话：获取或创建会话并写入用户消息（单次提交）
+
+    turns 为 (会话ID, 用户消息) 列表，会话ID为空时创建新会话。返回与 turns 对应的
+    (会话主键, 会话ID, 包含本轮消息的上下文)，会话不存在的项为 None。
+    """
+    # 一次查询所有已有会话，再读取各会话的上下文（缓存命中时只加载新增的消息）
+    requested_ids = requested_conversation_ids(turns)
+    conversations = {}
+    if requested_ids:
+        result = await session.execute(conversations_query(agent.id, requested_ids))
+        conversations = {conversation.conversation_id: conversation for conversation in result.scalars()}
+    loaded = {}
+    for conversation in conversations.values():
+        cached = context_cache.get(conversation.id)
+        result = await session.execute(context_rows_query(conversation.id, cached))
+        loaded[conversation.id] = (cached, result.all())
+
+    batch = TurnBatch(agent, turns, conversations, loaded, ensure_system_prompt)
+    if batch.backfill:
+        await session.execute(update(Message), batch.backfill)
+    if batch.created:
+        session.add_all(batch.created)
+        await session.flush()
+    session.add_all(batch.build_messages())
+    await session.flush()
+    saved = batch.saved()
+    await session.commit()
+    return batch.remember(agent, source, saved)
+
+async def prepare_turn(session, agent, conversation_id, content, source, ensure_system_prompt=True):
+    """准备一轮对话：获取或创建会话并写入用户消息（单次提交），返回会话和包含本轮消息的上下文"""
+    prepared = (await prepare_turns(session, agent, [(conversation_id, content)], source, ensure_system_prompt))[0]
+    if prepared is None:
+        raise ConversationNotFound(conversation_id)
+    return prepared
+
+async def save_turns(session, agent_id, turns):
+    """批量保存助手消息（单次提交）并记录日志，并追加到会话上下文缓存
+
+    turns 为 (会话主键, 上下文, 回复内容, 日志内容) 列表。
+    """
+    messages = assistant_messages(turns)
+    session.add_all(messages)
+    await session.flush()
+    rows = message_rows(messages)
+    await session.commit()
+    remember_replies(agent_id, turns, rows)
+
+async def save_turn(session, agent_id, conversation_pk, context, content, log_message):
+    """保存助手消息（单次提交）并记录日志，并追加到会话上下文缓存"""
+    await save_turns(session, agent_id, [(conversation_pk, context, content, log_message)])
+
+async def call_model(agent, request_data, slot):
+    """占用 slot 的并发名额调用模型并记录调用指标，返回响应数据"""
+    async with slot:
+        started = time.perf_counter()
+        response_data = (await async_model_client.chat_completions(agent, request_data)).json()
+        record_model_call(time.perf_counter() - started, response_data.get('usage'))
+    return response_data
+
+async def build_turn_request(agent, conversation_pk, context, slot, temperature=None, max_tokens=None):
+    """按上下文窗口截断历史（可选为截断部分生成摘要）并构建模型请求参数，返回请求参数和上下文统计
+
+    生成摘要需要调用模型，此时占用 slot 的并发名额。
+    """
+    request_data, context_stats, summary_request = plan_turn_request(agent, conversation_pk, context, temperature, max_tokens)
+    if summary_request is not None:
+        key, summary_data = summary_request
+        try:
+            apply_summary(request_data, key, await call_model(agent, summary_data, slot))
+        except (httpx.HTTPError, KeyError, IndexError, ValueError):
+            # 摘要失败时只做截断，不影响本轮对话
+            pass
+    return request_data, context_stats
+
+async def request_completion(agent, request_data, slot):
+    """获取模型回复，返回 (响应数据, 是否命中补全缓存)；未命中时占用 slot 的并发名额调用模型"""
+    key, response_data = cached_completion(agent, request_data)
+    if response_data is not None:
+        return response_data, True
+    response_data = await call_model(agent, request_data, slot)
+    store_completion(key, response_data)
+    return response_data, False
+
+async def agent_chat(request):
+    """直接与智能体对话（自动管理会话）"""
+    agent_id = request.path_params['agent_id']
+    try:
+        async with async_session() as session:
+            agent = await get_agent_config_async(session, agent_id)
+            if agent is None:
+                return JSONResponse({'error': 'Agent not found'}, status_code=404)
+
+            data = await read_json(request)
+            if not data or 'content' not in data:
+                return JSONResponse({'error': 'Content is required'}, status_code=400)
+
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = async_model_scheduler.slot(agent)
+
+            # 获取或创建会话并添加用户消息
+            try:
+                conversation_pk, conversation_id, context = await prepare_turn(session, agent, data.get('conversation_id'), data['content'], 'chat')
+            except ConversationNotFound:
+                return JSONResponse({'error': 'Conversation not found'}, status_code=404)
+
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            request_data, context_stats = await build_turn_request(agent, conversation_pk, context, slot)
+            response_data, _ = await request_completion(agent, request_data, slot)
+            assistant_message_content = extract_completion_content(response_data)
+
+            await save_turn(session, agent.id, conversation_pk, context, assistant_message_content, chat_log_message(agent, conversation_id, 'chat'))
+
+            return JSONResponse({
+                'message': 'Message sent successfully',
+                'response': assistant_message_content,
+                'conversation_id': conversation_id
+            })
+
+    except ModelCallRejected as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    except httpx.HTTPError as e:
+        return JSONResponse({'error': f'Model API error: {str(e)}'}, status_code=500)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def stream_invoke_events(agent, conversation_pk, context, conversation_id, user_input, request_data, context_stats, response, model_started):
+    """逐块转发上游模型的 SSE 响应，流结束后保存完整的助手消息
+
+    model_started 为发起模型请求的时间，用于计算首字时间和模型调用耗时。
+    """
+    relay = StreamRelay(model_started)
+    try:
+        async for line in response.aiter_lines():
+            event = relay.feed(line)
+            if relay.done:
+                break
+            if event:
+                yield event
+    except httpx.HTTPError as e:
+        yield stream_error_event(f'Model API error: {str(e)}')
+        return
+    finally:
+        await response.aclose()
+    assistant_message_content = relay.finish()
+
+    try:
+        async with async_session() as session:
+            await save_turn(session, agent.id, conversation_pk, context, assistant_message_content, invoke_log_message(agent, user_input, 'stream'))
+    except Exception as e:
+        yield stream_error_event(str(e))
+        return
+
+    # 发送最终结果，格式与非流式响应一致
+    for event in stream_done_events(agent, conversation_id, assistant_message_content, request_data, context_stats):
+        yield event
+
+async def agent_invoke(request):
+    """调用智能体（支持灵活的会话管理和参数配置）"""
+    agent_id = request.path_params['agent_id']
+    try:
+        async with async_session() as session:
+            agent = await get_agent_config_async(session, agent_id)
+            if agent is None:
+                return JSONResponse({'error': 'Agent not found'}, status_code=404)
+
+            data = await read_json(request)
+            if not data or 'input' not in data:
+                return JSONResponse({'error': 'Input is required'}, status_code=400)
+
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = async_model_scheduler.slot(agent)
+
+            # 获取或创建会话并添加用户消息
+            try:
+                conversation_pk, conversation_id, context = await prepare_turn(session, agent, data.get('conversation_id'), data['input'], 'invoke')
+            except ConversationNotFound:
+                return JSONResponse({'error': 'Conversation not found'}, status_code=404)
+
+            # 构建请求参数，支持覆盖智能体配置
+            request_data, context_stats = await build_turn_request(agent, conversation_pk, context, slot, temperature=data.get('temperature'), max_tokens=data.get('max_tokens'))
+
+            # 流式响应：转发上游 SSE 数据块，结束后再保存助手消息（并发名额在响应结束后释放）
+            if data.get('stream'):
+                enable_stream(request_data)
+                async with slot:
+                    model_started = time.perf_counter()
+                    response = await async_model_client.chat_completions(agent, request_data, stream=True)
+                    context_stats['queue_wait'] = round(slot.wait_time, 3)
+                    return StreamingResponse(
+                        stream_invoke_events(agent, conversation_pk, context, conversation_id, data['input'], request_data, context_stats, response, model_started),
+                        media_type='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+                        background=BackgroundTask(slot.detach())
+                    )
+
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            response_data, cache_hit = await request_completion(agent, request_data, slot)
+            record_completion_stats(context_stats, slot, cache_hit)
+            assistant_message_content = extract_completion_content(response_data)
+
+            await save_turn(session, agent.id, conversation_pk, context, assistant_message_content, invoke_log_message(agent, data['input']))
+
+            # 附带耗时分解：数据库、模型调用、排队和其余处理时间
+            return JSONResponse(build_invoke_result(agent, conversation_id, assistant_message_content, request_data, attach_timings(context_stats)))
+
+    except ModelCallRejected as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    except httpx.HTTPError as e:
+        return JSONResponse({'error': f'Model API error: {str(e)}'}, status_code=500)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def run_batch_item(agent, prepared, item, slot):
+    """完成批量调用的一项：构建请求并获取模型回复"""
+    conversation_pk, conversation_id, context = prepared
+    request_data, context_stats = await build_turn_request(agent, conversation_pk, context, slot, temperature=item['temperature'], max_tokens=item['max_tokens'])
+    response_data, cache_hit = await request_completion(agent, request_data, slot)
+    record_completion_stats(context_stats, slot, cache_hit)
+    return extract_completion_content(response_data), request_data, context_stats
+
+async def run_invoke_batch(agent, items, prepared, slots, parallelism):
+    """并发执行批量调用，按完成顺序逐项产出结果
+
+    已完成的回复攒成一批后统一保存（单次提交），没有更多立即可用的结果或达到 INVOKE_BATCH_COMMIT_SIZE 时提交。
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+
+    async def run(index):
+        async with semaphore:
+            return await run_batch_item(agent, prepared[index], items[index], slots[index])
+
+    tasks = {}
+    try:
+        for index, (item, turn) in enumerate(zip(items, prepared)):
+            if turn is None:
+                yield build_batch_error(index, item['conversation_id'], 'Conversation not found')
+                continue
+            tasks[asyncio.ensure_future(run(index))] = index
+
+        pending = set(tasks)
+        completed = []
+        async with async_session() as session:
+            while pending or completed:
+                done = set()
+                if pending:
+                    done, pending = await asyncio.wait(pending, timeout=0 if completed else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index = tasks[task]
+                    try:
+                        completed.append((index,) + task.result())
+                    except Exception as e:
+                        failure = batch_failure(index, prepared[index][1], e, httpx.HTTPError)
+                        if failure is None:
+                            raise
+                        yield failure
+
+                if batch_should_save(completed, done, pending):
+                    # 添加助手消息和日志
+                    try:
+                        await save_turns(session, agent.id, batch_replies(agent, items, prepared, completed))
+                    except Exception as e:
+                        await session.rollback()
+                        results = batch_save_errors(prepared, completed, e)
+                    else:
+                        results = batch_results(agent, prepared, completed)
+                    for result in results:
+                        yield result
+                    completed = []
+    finally:
+        # 客户端中断流式响应时取消未完成的模型调用
+        for task in tasks:
+            task.cancel()
+
+async def agent_invoke_batch(request):
+    """批量调用智能体（并发调用模型，批量保存消息）"""
+    agent_id = request.path_params['agent_id']
+    try:
+        async with async_session() as session:
+            agent = await get_agent_config_async(session, agent_id)
+            if agent is None:
+                return JSONResponse({'error': 'Agent not found'}, status_code=404)
+
+            data = await read_json(request)
+            try:
+                items, parallelism = parse_invoke_batch(data)
+            except InvalidBatch as e:
+                return JSONResponse({'error': str(e)}, status_code=400)
+
+            # 检查智能体状态，每项调用各自占用并发名额
+            slots = [async_model_scheduler.slot(agent) for _ in items]
+
+            # 一次提交写入所有新会话和用户消息
+            prepared = await prepare_turns(session, agent, [(item['conversation_id'], item['input']) for item in items], 'invoke')
+
+        results = run_invoke_batch(agent, items, prepared, slots, parallelism)
+
+        # 流式响应：按完成顺序每行返回一项结果
+        if data.get('stream'):
+            return StreamingResponse(
+                (json.dumps(result, ensure_ascii=False) + '\n' async for result in results),
+                media_type='application/x-ndjson',
+                headers={'X-Accel-Buffering': 'no'}
+            )
+
+        results = sorted([result async for result in results], key=lambda result: result['index'])
+        succeeded = sum(1 for result in results if result['success'])
+        return JSONResponse({
+            'results': results,
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded
+        })
+
+    except ModelCallRejected as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def send_message(request):
+    """发送消息并获取智能体响应"""
+    agent_id = request.path_params['agent_id']
+    conversation_id = request.path_params['conversation_id']
+    try:
+        async with async_session() as session:
+            agent = await get_agent_config_async(session, agent_id)
+            if agent is None:
+                return JSONResponse({'error': 'Agent not found'}, status_code=404)
+
+            data = await read_json(request)
+            if not data or 'content' not in data:
+                return JSONResponse({'error': 'Content is required'}, status_code=400)
+
+            # 检查智能体状态，在写入消息前拒绝不可调用的智能体
+            slot = async_model_scheduler.slot(agent)
+
+            # 添加用户消息
+            try:
+                conversation_pk, conversation_id, context = await prepare_turn(session, agent, conversation_id, data['content'], 'message', ensure_system_prompt=False)
+            except ConversationNotFound:
+                return JSONResponse({'error': 'Conversation not found'}, status_code=404)
+
+            # 发送请求到模型API（等待并发名额，命中补全缓存时直接返回）
+            request_data, context_stats = await build_turn_request(agent, conversation_pk, context, slot)
+            response_data, _ = await request_completion(agent, request_data, slot)
+            assistant_message_content = extract_completion_content(response_data)
+
+            await save_turn(session, agent.id, conversation_pk, context, assistant_message_content, chat_log_message(agent, conversation_id))
+
+            return JSONResponse({'message': 'Message sent successfully', 'response': assistant_message_content})
+
+    except ModelCallRejected as e:
+        return JSONResponse({'error': str(e)}, status_code=e.status_code)
+    except httpx.HTTPError as e:
+        return JSONResponse({'error': f'Model API error: {str(e)}'}, status_code=500)
+    except Exception as e:
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+async def scheduler_stats(request):
+    """获取模型调用调度状态（各模型API地址和智能体的并发数、队列深度、等待时间）"""
+    return JSONResponse(async_model_scheduler.stats())
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """应用生命周期：退出时关闭连接池"""
+    yield
+    await async_model_client.aclose()
+    await engine.dispose()
+    log_writer.stop()
+
+flask_asgi_app = WsgiToAsgi(flask_app)
+
+async def flask_mount(scope, receive, send):
+    """转发给 Flask 应用，每个请求在新的上下文中执行
+
+    asgiref 会在上下文变量中留下已结束的线程执行器，keep-alive 连接上的后续请求继承该上下文后会报
+    "CurrentThreadExecutor already quit or is broken"。
+    """
+    await contextvars.Context().run(asyncio.ensure_future, flask_asgi_app(scope, receive, send))
+
+# 对话类接口走异步处理，其余请求（含同一路径的 GET）转发给 Flask 应用
+application = Starlette(
+    routes=[
+        Route('/agents/scheduler', InstrumentedEndpoint('/agents/scheduler', scheduler_stats), methods=['GET']),
+        Route('/agents/{agent_id:int}/chat', InstrumentedEndpoint('/agents/<int:agent_id>/chat', agent_chat), methods=['POST']),
+        Route('/agents/{agent_id:int}/invoke', InstrumentedEndpoint('/agents/<int:agent_id>/invoke', agent_invoke), methods=['POST']),
+        Route('/agents/{agent_id:int}/invoke/batch', InstrumentedEndpoint('/agents/<int:agent_id>/invoke/batch', agent_invoke_batch), methods=['POST']),
+        Route('/conversations/agents/{agent_id:int}/conversations/{conversation_id:str}/messages',
+              InstrumentedEndpoint('/conversations/agents/<int:agent_id>/conversations/<string:conversation_id>/messages', send_message), methods=['POST']),
+        Mount('/', app=flask_mount)
+    ],
+    lifespan=lifespan
+)
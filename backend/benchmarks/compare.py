@@ -0,0 +1,56 @@
+import sys
+import json
+import argparse
+
+# 对比两次压测结果，按 场景+并发数 对齐
+
+METRICS = (
+    ('p50', lambda result: (result['latency_ms'] or {}).get('p50'), True),
+    ('p95', lambda result: (result['latency_ms'] or {}).get('p95'), True),
+    ('p99', lambda result: (result['latency_ms'] or {}).get('p99'), True),
+    ('rps', lambda result: result['rps'], False),
+    ('queries/req', lambda result: result['db_queries_per_request'], True)
+)
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        report = json.load(f)
+    return report['meta'], {(result['scenario'], result['concurrency']): result for result in report['results']}
+
+def format_change(old, new, lower_is_better):
+    """格式化变化百分比，变好的前面标 +，变差的标 -"""
+    if old is None or new is None:
+        return f'{old} -> {new}'
+    if not old:
+        return f'{old} -> {new}'
+    change = (new - old) / old * 100
+    better = change < 0 if lower_is_better else change > 0
+    mark = '+' if better else ('-' if change else ' ')
+    return f'{old} -> {new} ({mark}{abs(change):.1f}%)'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='对比两次压测结果（+ 表示变好，- 表示变差）')
+    parser.add_argument('baseline', help='基准结果 JSON')
+    parser.add_argument('candidate', help='对比结果 JSON')
+    args = parser.parse_args(argv)
+
+    old_meta, old_results = load(args.baseline)
+    new_meta, new_results = load(args.candidate)
+    print(f"基准: {old_meta.get('git_commit')} {old_meta.get('db')} {old_meta.get('server')} {old_meta.get('created_at')}")
+    print(f"对比: {new_meta.get('git_commit')} {new_meta.get('db')} {new_meta.get('server')} {new_meta.get('created_at')}")
+    if old_meta.get('mock') != new_meta.get('mock'):
+        print(f"注意: 模拟模型参数不同 {old_meta.get('mock')} / {new_meta.get('mock')}")
+
+    for key in sorted(set(old_results) & set(new_results)):
+        old, new = old_results[key], new_results[key]
+        print(f'\n{key[0]} c={key[1]}  errors: {old["errors"]} -> {new["errors"]}')
+        for name, metric, lower_is_better in METRICS:
+            print(f'  {name:<12} {format_change(metric(old), metric(new), lower_is_better)}')
+
+    missing = sorted(set(old_results) ^ set(new_results))
+    if missing:
+        print('\n只在一次结果中出现: ' + ', '.join(f'{scenario} c={concurrency}' for scenario, concurrency in missing))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
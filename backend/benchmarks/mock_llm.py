@@ -0,0 +1,185 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 模拟的 OpenAI 兼容模型服务（Ollama 的 /v1 兼容接口格式相同），用于压测时排除真实模型的耗时波动
+
+# 回复使用的 token：最后一条用户消息包含非 ASCII 字符时用中文回复，用于检查流式响应的解码
+ASCII_TOKENS = ('token',)
+UNICODE_TOKENS = ('你好', '世界')
+
+def reply_tokens(messages):
+    """按最后一条用户消息选择回复使用的 token"""
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            return UNICODE_TOKENS if not str(message.get('content', '')).isascii() else ASCII_TOKENS
+    return ASCII_TOKENS
+
+def completion_text(tokens, count):
+    """生成 count 个 token 的回复内容（流式响应拼接后的内容相同）"""
+    return ' '.join(tokens[index % len(tokens)] for index in range(count))
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """处理 /chat/completions 请求：先等待首字延迟，再按 token 速率生成回复"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        # Ollama 兼容：/v1/models 和 /api/tags 返回一个模型
+        if self.path.rstrip('/').endswith(('/models', '/api/tags')):
+            self._send_json({'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}], 'models': [{'name': 'mock'}]})
+        else:
+            self._send_json({'error': 'Not found'}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json({'error': 'Invalid JSON'}, status=400)
+            return
+        if self.path.rstrip('/').endswith('/api/generate') and not body.get('prompt'):
+            # Ollama 原生接口：不带 prompt 时只加载或释放模型
+            self._send_json({'model': body.get('model', 'mock'), 'done': True, 'done_reason': 'unload' if body.get('keep_alive') == 0 else 'load'})
+            return
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json({'error': 'Not found'}, status=404)
+            return
+
+        server = self.server
+        server.record_call()
+        messages = body.get('messages') or []
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in messages) // 4 + 1
+        completion_tokens = server.completion_tokens
+        if body.get('max_tokens'):
+            completion_tokens = min(completion_tokens, body['max_tokens'])
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+
+        tokens = reply_tokens(messages)
+        time.sleep(server.latency)
+        if body.get('stream'):
+            self._stream(body, tokens, completion_tokens, usage)
+            return
+
+        if server.token_rate > 0:
+            time.sleep(completion_tokens / server.token_rate)
+        self._send_json({
+            'id': 'chatcmpl-mock',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'mock'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': completion_text(tokens, completion_tokens)},
+                'finish_reason': 'stop'
+            }],
+            'usage': usage
+        })
+
+    def _stream(self, body, tokens, completion_tokens, usage):
+        """按 token 速率逐个发送 SSE 增量块（与 Ollama 相同，Content-Type 不带 charset，内容为 UTF-8）"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        interval = 1 / self.server.token_rate if self.server.token_rate > 0 else 0
+        chunk = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'model': body.get('model', 'mock')}
+        try:
+            for index in range(completion_tokens):
+                token = tokens[index % len(tokens)]
+                content = token if index == 0 else ' ' + token
+                self._send_event(dict(chunk, choices=[{'index': 0, 'delta': {'content': content}, 'finish_reason': None}]))
+                if interval:
+                    time.sleep(interval)
+            self._send_event(dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+            if (body.get('stream_options') or {}).get('include_usage'):
+                self._send_event(dict(chunk, choices=[], usage=usage))
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def _send_event(self, data):
+        # 非 ASCII 字符不转义，直接以 UTF-8 字节发送
+        self.wfile.write(f'data: {json.dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8'))
+        self.wfile.flush()
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class MockLLMServer(ThreadingHTTPServer):
+    """模拟模型服务
+
+    latency 为首字延迟（秒），token_rate 为每秒生成的 token 数（0 表示不限速），
+    completion_tokens 为每次回复的 token 数。
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, token_rate=50.0, completion_tokens=32):
+        super().__init__((host, port), MockLLMHandler)
+        self.latency = latency
+        self.token_rate = token_rate
+        self.completion_tokens = completion_tokens
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def start(self):
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.serve_forever, name='mock-llm', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='模拟 OpenAI/Ollama 兼容模型服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=0.2, help='首字延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='每秒生成的 token 数，0 表示不限速')
+    parser.add_argument('--completion-tokens', type=int, default=32, help='每次回复的 token 数')
+    args = parser.parse_args(argv)
+
+    server = MockLLMServer(args.host, args.port, args.latency, args.token_rate, args.completion_tokens)
+    print(f'模拟模型服务已启动: {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
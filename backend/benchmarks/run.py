@@ -0,0 +1,429 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import requests
+from mock_llm import UNICODE_TOKENS, MockLLMServer
+
+# 压测场景：名称 -> (HTTP 方法, 说明)
+SCENARIOS = {
+    'chat': ('POST', '/agents/<id>/chat'),
+    'invoke': ('POST', '/agents/<id>/invoke'),
+    'invoke_stream': ('POST', '/agents/<id>/invoke (stream)'),
+    'invoke_stream_unicode': ('POST', '/agents/<id>/invoke (stream, non-ASCII)'),
+    'agent_logs': ('GET', '/agents/<id>/logs'),
+    'logs': ('GET', '/logs/'),
+    'users': ('GET', '/users/'),
+    'roles': ('GET', '/roles/')
+}
+
+def percentile(sorted_values, percent):
+    """最近秩法计算百分位数"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize_latencies(latencies):
+    """汇总延迟（秒）为毫秒统计"""
+    values = sorted(latencies)
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 50) * 1000, 2),
+        'p95': round(percentile(values, 95) * 1000, 2),
+        'p99': round(percentile(values, 99) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2)
+    }
+
+class QueryCounter:
+    """统计数据库引擎执行的语句数（包括后台日志写入线程）"""
+
+    def __init__(self, engines):
+        from sqlalchemy import event
+        self.count = 0
+        self._lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+class BenchmarkTarget:
+    """被压测的服务：进程内启动的 WSGI/ASGI 服务，或 --url 指定的外部服务"""
+
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/') if args.url else None
+        self.query_counter = None
+        self.log_writer = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if self.url:
+            return
+        configure_database(self.args)
+        # 必须在设置好环境变量后导入
+        from app import app, db
+        from log_writer import log_writer
+        self.log_writer = log_writer
+        with app.app_context():
+            engines = [db.engine]
+            seed_data(db, self.args)
+
+        if self.args.server == 'asgi':
+            import uvicorn
+            import asgi
+            engines.append(asgi.engine.sync_engine)
+            config = uvicorn.Config(asgi.application, host='127.0.0.1', port=self.args.port or free_port(), log_level='warning')
+            self._server = uvicorn.Server(config)
+            self._thread = threading.Thread(target=self._server.run, name='benchmark-asgi', daemon=True)
+            self._thread.start()
+            while not self._server.started:
+                time.sleep(0.05)
+            self.url = f'http://127.0.0.1:{config.port}'
+        else:
+            from werkzeug.serving import make_server
+            # 关闭逐请求的访问日志
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            self._server = make_server('127.0.0.1', self.args.port or 0, app, threaded=True)
+            self._thread = threading.Thread(target=self._server.serve_forever, name='benchmark-wsgi', daemon=True)
+            self._thread.start()
+            self.url = f'http://127.0.0.1:{self._server.server_port}'
+        self.query_counter = QueryCounter(engines)
+
+    def queries(self):
+        """当前累计的数据库语句数，外部服务无法统计时返回 None"""
+        if self.query_counter is None:
+            return None
+        # 先写入排队中的日志，使日志插入计入产生它的场景
+        if self.log_writer is not None:
+            self.log_writer.flush()
+        return self.query_counter.count
+
+    def stop(self):
+        if self._server is None:
+            return
+        if self.args.server == 'asgi':
+            self._server.should_exit = True
+            self._thread.join(timeout=10)
+        else:
+            self._server.shutdown()
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def configure_database(args):
+    """按 --db 设置数据库环境变量，SQLite 默认使用临时文件以免影响开发数据库"""
+    os.environ['DB_TYPE'] = args.db
+    if args.db == 'sqlite':
+        path = args.sqlite_path or os.path.join(tempfile.mkdtemp(prefix='agent-bench-'), 'bench.sqlite3')
+        os.environ['SQLITE_PATH'] = path
+        args.sqlite_path = path
+
+def seed_data(db, args):
+    """批量插入列表接口需要的用户、角色和日志（不经过接口，避免密码哈希拖慢准备阶段）"""
+    from sqlalchemy import insert, select, func
+    from werkzeug.security import generate_password_hash
+    from models import User, Role, user_roles
+
+    prefix = f'bench{int(time.time())}'
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        existing = connection.execute(select(func.count()).select_from(User)).scalar()
+        if existing < args.seed_users:
+            password_hash = generate_password_hash('bench-password')
+            connection.execute(insert(User.__table__), [{
+                'username': f'{prefix}_user{i}', 'email': f'{prefix}_user{i}@example.com', 'password_hash': password_hash,
+                'full_name': f'Bench User {i}', 'is_active': True, 'is_admin': False, 'created_at': now, 'updated_at': now
+            } for i in range(args.seed_users - existing)])
+
+        existing = connection.execute(select(func.count()).select_from(Role)).scalar()
+        if existing < args.seed_roles:
+            connection.execute(insert(Role.__table__), [{
+                'name': f'{prefix}_role{i}', 'description': 'benchmark role', 'created_at': now, 'updated_at': now
+            } for i in range(args.seed_roles - existing)])
+
+        # 每个用户随机分配最多 3 个角色
+        user_ids = connection.execute(select(User.id)).scalars().all()
+        role_ids = connection.execute(select(Role.id)).scalars().all()
+        assigned = set(connection.execute(select(user_roles.c.user_id, user_roles.c.role_id)).all())
+        rows = []
+        for user_id in user_ids:
+            for role_id in random.sample(role_ids, min(3, len(role_ids))):
+                if (user_id, role_id) not in assigned:
+                    assigned.add((user_id, role_id))
+                    rows.append({'user_id': user_id, 'role_id': role_id})
+        if rows:
+            connection.execute(insert(user_roles), rows)
+
+def seed_logs(agent_id, count):
+    """为压测智能体写入历史日志"""
+    from app import app, db
+    from log_store import log_store
+    levels = ['info', 'info', 'info', 'warning', 'error']
+    now = datetime.utcnow()
+    with app.app_context(), db.engine.begin() as connection:
+        for start in range(0, count, 1000):
+            log_store.insert(connection, [{
+                'agent_id': agent_id, 'level': levels[i % len(levels)], 'message': f'benchmark log {i}', 'created_at': now
+            } for i in range(start, min(start + 1000, count))])
+
+def create_agent(url, mock_url, args):
+    """通过接口创建指向模拟模型服务的运行中智能体"""
+    response = requests.post(f'{url}/agents/', json={
+        'name': f'bench-agent-{int(time.time() * 1000)}',
+        'description': 'benchmark agent',
+        'model_name': 'mock',
+        'model_provider': 'openai',
+        'model_api_url': mock_url,
+        'model_system_prompt': 'You are a benchmark agent.',
+        'model_max_tokens': args.completion_tokens,
+        'status': 'running'
+    }, timeout=30)
+    response.raise_for_status()
+    return response.json()['id']
+
+def stream_output_intact(body):
+    """检查流式调用结束时 done 事件中的回复只由模拟模型的中文 token 组成"""
+    event = None
+    for line in body.decode('utf-8').splitlines():
+        if line.startswith('event:'):
+            event = line[len('event:'):].strip()
+        elif line.startswith('data:') and event == 'done':
+            output = json.loads(line[len('data:'):]).get('output') or ''
+            return bool(output) and all(token in UNICODE_TOKENS for token in output.split(' '))
+    return False
+
+class ScenarioRunner:
+    """以固定并发数执行一个场景：每个工作线程使用自己的 HTTP 会话循环发送请求，直到总请求数用完"""
+
+    def __init__(self, url, agent_id, scenario, concurrency, total, timeout):
+        self.url = url
+        self.agent_id = agent_id
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.total = total
+        self.timeout = timeout
+        self.latencies = []
+        self.first_byte = []
+        self.errors = 0
+        self.status_codes = {}
+        self._issued = 0
+        self._lock = threading.Lock()
+
+    def _next(self):
+        with self._lock:
+            if self._issued >= self.total:
+                return False
+            self._issued += 1
+            return True
+
+    def _request(self, session, state):
+        """发送一次请求，返回 (状态码, 首字节时间)"""
+        agent_url = f'{self.url}/agents/{self.agent_id}'
+        if self.scenario == 'chat':
+            response = session.post(f'{agent_url}/chat', json={'content': 'Hello benchmark', 'conversation_id': state.get('conversation_id')}, timeout=self.timeout)
+        elif self.scenario in ('invoke', 'invoke_stream', 'invoke_stream_unicode'):
+            stream = self.scenario != 'invoke'
+            unicode = self.scenario == 'invoke_stream_unicode'
+            start = time.perf_counter()
+            response = session.post(f'{agent_url}/invoke', json={'input': '你好 benchmark' if unicode else 'Hello benchmark', 'conversation_id': state.get('conversation_id'), 'stream': stream},
+                                    timeout=self.timeout, stream=stream)
+            if stream:
+                first_byte = None
+                body = []
+                for chunk in response.iter_content(chunk_size=None):
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+                    body.append(chunk)
+                response.close()
+                # 模拟模型用中文回复，流结束时的结果必须是原样的中文，否则按错误统计
+                if unicode and response.ok and not stream_output_intact(b''.join(body)):
+                    return 'garbled', first_byte
+                return response.status_code, first_byte
+        elif self.scenario == 'agent_logs':
+            response = session.get(f'{agent_url}/logs', params={'per_page': 20}, timeout=self.timeout)
+        elif self.scenario == 'logs':
+            response = session.get(f'{self.url}/logs/', params={'per_page': 20}, timeout=self.timeout)
+        elif self.scenario == 'users':
+            response = session.get(f'{self.url}/users/', params={'per_page': 20}, timeout=self.timeout)
+        else:
+            response = session.get(f'{self.url}/roles/', timeout=self.timeout)
+
+        if self.scenario in ('chat', 'invoke') and response.ok:
+            # 同一工作线程后续请求继续同一会话，历史随请求增长
+            state['conversation_id'] = response.json().get('conversation_id')
+        return response.status_code, None
+
+    def _worker(self):
+        session = requests.Session()
+        state = {}
+        try:
+            while self._next():
+                start = time.perf_counter()
+                try:
+                    status, first_byte = self._request(session, state)
+                except requests.RequestException:
+                    status, first_byte = 'exception', None
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self.status_codes[str(status)] = self.status_codes.get(str(status), 0) + 1
+                    if isinstance(status, int) and status < 400:
+                        self.latencies.append(elapsed)
+                        if first_byte is not None:
+                            self.first_byte.append(first_byte)
+                    else:
+                        self.errors += 1
+        finally:
+            session.close()
+
+    def run(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(self._worker) for _ in range(self.concurrency)]:
+                future.result()
+        return time.perf_counter() - start
+
+def run_scenario(target, mock, agent_id, scenario, concurrency, args):
+    """预热后执行一个场景，返回结果字典"""
+    if args.warmup:
+        ScenarioRunner(target.url, agent_id, scenario, min(concurrency, args.warmup), args.warmup, args.timeout).run()
+
+    queries_before = target.queries()
+    calls_before = mock.calls
+    runner = ScenarioRunner(target.url, agent_id, scenario, concurrency, args.requests, args.timeout)
+    duration = runner.run()
+    queries_after = target.queries()
+
+    succeeded = len(runner.latencies)
+    result = {
+        'scenario': scenario,
+        'endpoint': ' '.join(SCENARIOS[scenario]),
+        'concurrency': concurrency,
+        'requests': args.requests,
+        'succeeded': succeeded,
+        'errors': runner.errors,
+        'status_codes': runner.status_codes,
+        'duration': round(duration, 3),
+        'rps': round(succeeded / duration, 2) if duration else None,
+        'latency_ms': summarize_latencies(runner.latencies),
+        'db_queries': None,
+        'db_queries_per_request': None,
+        'model_calls_per_request': round((mock.calls - calls_before) / args.requests, 2)
+    }
+    if runner.first_byte:
+        result['first_byte_ms'] = summarize_latencies(runner.first_byte)
+    if queries_before is not None:
+        result['db_queries'] = queries_after - queries_before
+        result['db_queries_per_request'] = round(result['db_queries'] / args.requests, 2)
+    return result
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_result(result):
+    latency = result['latency_ms'] or {}
+    print(f"{result['scenario']:<14} c={result['concurrency']:<4} "
+          f"p50={latency.get('p50', '-'):>9} p95={latency.get('p95', '-'):>9} p99={latency.get('p99', '-'):>9} ms  "
+          f"rps={result['rps']:>8}  errors={result['errors']:<4} queries/req={result['db_queries_per_request']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='智能体管理平台接口压测')
+    parser.add_argument('--db', choices=['sqlite', 'mysql'], default=os.getenv('DB_TYPE', 'sqlite'), help='数据库类型（mysql 使用 DB_HOST 等环境变量）')
+    parser.add_argument('--sqlite-path', help='SQLite 数据库文件路径，默认使用临时文件')
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi', help='进程内启动的服务类型')
+    parser.add_argument('--url', help='压测已运行的外部服务（不统计数据库语句数）')
+    parser.add_argument('--port', type=int, default=0, help='进程内服务端口，0 表示随机')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='逗号分隔的场景列表')
+    parser.add_argument('--concurrency', default='1,8,32', help='逗号分隔的并发数列表')
+    parser.add_argument('--requests', type=int, default=200, help='每个场景每个并发数的请求数')
+    parser.add_argument('--warmup', type=int, default=5, help='每轮正式压测前的预热请求数')
+    parser.add_argument('--timeout', type=float, default=60, help='单个请求超时（秒）')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟模型首字延迟（秒）')
+    parser.add_argument('--token-rate', type=float, default=500, help='模拟模型每秒生成的 token 数，0 表示不限速')
+    parser.add_argument('--completion-tokens', type=int, default=32, help='模拟模型每次回复的 token 数')
+    parser.add_argument('--seed-users', type=int, default=1000, help='准备的用户数')
+    parser.add_argument('--seed-roles', type=int, default=20, help='准备的角色数')
+    parser.add_argument('--seed-logs', type=int, default=20000, help='准备的压测智能体历史日志数')
+    parser.add_argument('--output', help='结果 JSON 文件路径，默认 benchmarks/results/<时间>-<数据库>.json')
+    args = parser.parse_args(argv)
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'Unknown scenarios: {", ".join(unknown)}')
+    args.concurrency = [int(value) for value in args.concurrency.split(',') if value.strip()]
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    mock = MockLLMServer(latency=args.latency, token_rate=args.token_rate, completion_tokens=args.completion_tokens).start()
+    target = BenchmarkTarget(args)
+    target.start()
+    try:
+        agent_id = create_agent(target.url, mock.base_url, args)
+        if not args.url and args.seed_logs:
+            seed_logs(agent_id, args.seed_logs)
+        print(f'压测服务: {target.url}  数据库: {args.db}  模拟模型: {mock.base_url}  智能体: {agent_id}')
+
+        results = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = run_scenario(target, mock, agent_id, scenario, concurrency, args)
+                print_result(result)
+                results.append(result)
+    finally:
+        target.stop()
+        mock.stop()
+
+    report = {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'db': args.db,
+            'server': 'external' if args.url else args.server,
+            'url': args.url,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'mock': {'latency': args.latency, 'token_rate': args.token_rate, 'completion_tokens': args.completion_tokens},
+            'seed': {'users': args.seed_users, 'roles': args.seed_roles, 'logs': args.seed_logs}
+        },
+        'results': results
+    }
+    output = args.output or os.path.join(BENCHMARK_DIR, 'results', f'{datetime.now():%Y%m%d-%H%M%S}-{args.db}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+from sqlalchemy import create_engine, insert, select, func
+from sqlalchemy.exc import OperationalError
+from models import db, Agent, AgentLog, Conversation, Message
+from db_engine import SQLITE_BUSY_TIMEOUT, configure_engine, sqlite_pragmas
+from run import summarize_latencies
+
+# 对比 SQLite 默认配置（回滚日志、synchronous=FULL）和 db_engine 中的连接参数在读写并发下的表现：
+# 写线程模拟对话轮次（写入用户和助手消息及日志并提交），读线程模拟日志和会话历史列表查询
+
+PROFILES = {
+    'default': [],
+    'tuned': None  # 使用 db_engine.sqlite_pragmas()
+}
+
+def create_profile_engine(path, profile):
+    engine = create_engine('sqlite:///' + path, connect_args={'timeout': SQLITE_BUSY_TIMEOUT / 1000})
+    configure_engine(engine, PROFILES[profile])
+    return engine
+
+def prepare(engine):
+    """建表并写入一个智能体、若干会话和历史日志"""
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        agent_id = connection.execute(insert(Agent.__table__).values(
+            name='bench', status='running', model_name='mock', model_provider='openai', model_api_url='http://127.0.0.1/v1',
+            model_temperature=0.7, model_max_tokens=64, model_top_p=0.9, model_top_k=40, model_presence_penalty=0.0,
+            model_frequency_penalty=0.0, model_context_window=4096, completion_cache_enabled=False, config_version=0,
+            created_at=now, updated_at=now
+        )).inserted_primary_key[0]
+        conversation_ids = [connection.execute(insert(Conversation.__table__).values(
+            agent_id=agent_id, conversation_id=f'bench-{i}', created_at=now, updated_at=now
+        )).inserted_primary_key[0] for i in range(32)]
+        connection.execute(insert(AgentLog.__table__), [
+            {'agent_id': agent_id, 'level': 'info', 'message': f'seed log {i}', 'created_at': now} for i in range(5000)
+        ])
+    return agent_id, conversation_ids
+
+class Worker(threading.Thread):
+    def __init__(self, engine, operation, deadline):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.operation = operation
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        index = 0
+        while time.perf_counter() < self.deadline:
+            start = time.perf_counter()
+            try:
+                self.operation(self.engine, index)
+                self.latencies.append(time.perf_counter() - start)
+            except OperationalError:
+                # database is locked
+                self.errors += 1
+            index += 1
+
+def run_profile(profile, writers, readers, duration):
+    directory = tempfile.mkdtemp(prefix='sqlite-bench-')
+    engine = create_profile_engine(os.path.join(directory, 'bench.sqlite3'), profile)
+    agent_id, conversation_ids = prepare(engine)
+
+    def write_turn(engine, index):
+        now = datetime.utcnow()
+        conversation_pk = conversation_ids[index % len(conversation_ids)]
+        with engine.begin() as connection:
+            connection.execute(insert(Message.__table__), [
+                {'conversation_id': conversation_pk, 'role': 'user', 'content': f'question {index}', 'token_count': 4, 'created_at': now},
+                {'conversation_id': conversation_pk, 'role': 'assistant', 'content': f'answer {index} ' * 20, 'token_count': 40, 'created_at': now}
+            ])
+            connection.execute(insert(AgentLog.__table__).values(agent_id=agent_id, level='info', message=f'turn {index}', created_at=now))
+
+    def read_lists(engine, index):
+        with engine.connect() as connection:
+            connection.execute(select(AgentLog).where(AgentLog.agent_id == agent_id).order_by(AgentLog.created_at.desc(), AgentLog.id.desc()).limit(20)).all()
+            connection.execute(select(func.count()).select_from(AgentLog).where(AgentLog.agent_id == agent_id)).scalar()
+            connection.execute(select(Message).where(Message.conversation_id == conversation_ids[index % len(conversation_ids)]).order_by(Message.id)).all()
+
+    deadline = time.perf_counter() + duration
+    write_workers = [Worker(engine, write_turn, deadline) for _ in range(writers)]
+    read_workers = [Worker(engine, read_lists, deadline) for _ in range(readers)]
+    for worker in write_workers + read_workers:
+        worker.start()
+    for worker in write_workers + read_workers:
+        worker.join()
+    with engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+    engine.dispose()
+
+    def summarize(workers):
+        latencies = [latency for worker in workers for latency in worker.latencies]
+        return {
+            'operations': len(latencies),
+            'per_second': round(len(latencies) / duration, 1),
+            'errors': sum(worker.errors for worker in workers),
+            'latency_ms': summarize_latencies(latencies)
+        }
+
+    return {
+        'profile': profile,
+        'journal_mode': journal_mode,
+        'pragmas': PROFILES[profile] if PROFILES[profile] is not None else sqlite_pragmas(),
+        'writes': summarize(write_workers),
+        'reads': summarize(read_workers)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SQLite 默认配置与调优配置的读写并发对比')
+    parser.add_argument('--writers', type=int, default=4, help='写线程数')
+    parser.add_argument('--readers', type=int, default=8, help='读线程数')
+    parser.add_argument('--duration', type=float, default=10, help='每种配置的运行时间（秒）')
+    parser.add_argument('--output', help='结果 JSON 文件路径')
+    args = parser.parse_args(argv)
+
+    results = []
+    for profile in PROFILES:
+        result = run_profile(profile, args.writers, args.readers, args.duration)
+        results.append(result)
+        for kind in ('writes', 'reads'):
+            stats = result[kind]
+            latency = stats['latency_ms'] or {}
+            print(f"{profile:<8} {kind:<6} {stats['per_second']:>8}/s  p50={latency.get('p50', '-'):>8} p95={latency.get('p95', '-'):>8} "
+                  f"p99={latency.get('p99', '-'):>8} ms  errors={stats['errors']}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {'created_at': datetime.utcnow().isoformat(), 'writers': args.writers, 'readers': args.readers, 'duration': args.duration},
+                'results': results
+            }, f, ensure_ascii=False, indent=2)
+        print(f'结果已保存: {args.output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
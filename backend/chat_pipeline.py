@@ -0,0 +1,416 @@
+"""对话流程中与同步（Flask）和异步（ASGI）实现无关的部分
+
+构建会话上下文和要写入的消息、构建模型请求参数、组装响应结果和 SSE 事件，以及提交后更新会话缓存。
+app.py 和 asgi.py 只负责各自的数据库读写和模型 HTTP 调用，调用这里的函数完成其余步骤。
+"""
+import os
+import json
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import select
+from models import Conversation, Message
+from log_writer import log_writer
+from db_replica import recent_writes
+from metrics import METRICS_STREAM_USAGE, record_model_call, timings_snapshot
+from model_scheduler import ModelCallRejected
+from completion_cache import completion_cache, completion_cache_key
+from context_cache import ConversationContext, context_cache, merge_context
+from token_budget import CONTEXT_SUMMARY_ENABLED, summary_cache, count_message_tokens, fill_token_counts, context_budget, select_context, build_summary_request, insert_summary
+
+# 上游流式响应结束标记
+STREAM_DONE = '[DONE]'
+
+# 批量调用配置
+INVOKE_BATCH_MAX_SIZE = int(os.getenv('INVOKE_BATCH_MAX_SIZE', '1000'))  # 单次批量调用最多的输入数量
+INVOKE_BATCH_PARALLELISM = int(os.getenv('INVOKE_BATCH_PARALLELISM', '4'))  # 默认同时进行的模型调用数
+INVOKE_BATCH_MAX_PARALLELISM = int(os.getenv('INVOKE_BATCH_MAX_PARALLELISM', '16'))  # 请求中 parallelism 的上限
+INVOKE_BATCH_COMMIT_SIZE = int(os.getenv('INVOKE_BATCH_COMMIT_SIZE', '100'))  # 每次提交最多保存的回复数量
+
+class ConversationNotFound(Exception):
+    """会话不存在"""
+
+class InvalidBatch(ValueError):
+    """批量调用请求格式错误"""
+
+# 写入会话
+
+def conversations_query(agent_id, conversation_ids):
+    """查询智能体的多个已有会话"""
+    return select(Conversation).where(Conversation.agent_id == agent_id, Conversation.conversation_id.in_(conversation_ids))
+
+def requested_conversation_ids(turns):
+    """turns 中引用的已有会话ID"""
+    return {conversation_id for conversation_id, _ in turns if conversation_id}
+
+def message_rows(messages):
+    """已 flush 的消息的 (id, role, content, token_count) 行，用于追加到会话上下文"""
+    return [(msg.id, msg.role, msg.content, msg.token_count) for msg in messages]
+
+class TurnBatch:
+    """一批对话轮次的写入计划（不访问数据库）
+
+    调用方先查询 turns 引用的会话（conversations 为 {会话ID: 会话}）及其消息行（loaded 为 {会话主键: (缓存的上下文, 新读取的消息行)}），
+    再依次回写 backfill、写入 created 并 flush、写入 build_messages() 的消息并 flush，提交前用 saved() 取出结果。
+    """
+
+    def __init__(self, agent, turns, conversations, loaded, ensure_system_prompt=True):
+        self.count = len(turns)
+        self.system_prompt = agent.model_system_prompt if ensure_system_prompt else None
+        self.prepared = []  # (下标, 会话, 写入前的上下文, 用户消息)，会话不存在的项不包含在内
+        self.backfill = []  # 旧消息缺失的 token 数，与本轮用户消息一起提交
+        self.created = []  # 新会话，与用户消息在同一事务中提交
+        self.messages = []
+        for index, (conversation_id, content) in enumerate(turns):
+            if conversation_id:
+                conversation = conversations.get(conversation_id)
+                if conversation is None:
+                    continue
+                rows, missing = fill_token_counts(loaded[conversation.id][1])
+                context = merge_context(conversation.id, loaded[conversation.id][0], rows)
+                self.backfill.extend(missing)
+            else:
+                conversation = Conversation(agent_id=agent.id, conversation_id=str(uuid.uuid4()))
+                self.created.append(conversation)
+                context = None
+            self.prepared.append((index, conversation, context, content))
+
+    def build_messages(self):
+        """构建每轮要写入的消息（新会话 flush 获取主键之后调用）
+
+        有系统提示词且会话中还没有系统消息时，在用户消息之前写入系统消息。
+        """
+        self.messages = []
+        for _, conversation, context, content in self.prepared:
+            new_messages = []
+            if self.system_prompt and not (context and context.has_system_message()):
+                new_messages.append(Message(
+                    conversation_id=conversation.id,
+                    role='system',
+                    content=self.system_prompt,
+                    token_count=count_message_tokens(self.system_prompt)
+                ))
+            new_messages.append(Message(
+                conversation_id=conversation.id,
+                role='user',
+                content=content,
+                token_count=count_message_tokens(content)
+            ))
+            self.messages.append(new_messages)
+        return [msg for new_messages in self.messages for msg in new_messages]
+
+    def saved(self):
+        """消息 flush 后取出 (下标, 会话主键, 会话ID, 写入前的上下文, 本轮消息行)，在提交前调用，避免提交后逐条刷新过期对象"""
+        return [
+            (index, conversation.id, conversation.conversation_id, context, message_rows(new_messages))
+            for (index, conversation, context, _), new_messages in zip(self.prepared, self.messages)
+        ]
+
+    def remember(self, agent, source, saved):
+        """提交后把本轮消息追加到会话上下文缓存并记录写入
+
+        返回与 turns 对应的 (会话主键, 会话ID, 包含本轮消息的上下文)，会话不存在的项为 None。
+        """
+        results = [None] * self.count
+        for index, conversation_pk, conversation_id, context, rows in saved:
+            if context is None:
+                log_writer.write(agent.id, 'info', f'Conversation "{conversation_id}" created for agent "{agent.name}" via {source} API')
+                context = ConversationContext().extend(rows)
+                context_cache.set(conversation_pk, context)
+            else:
+                context_cache.append(conversation_pk, context.last_message_id, rows)
+                context = context.extend(rows)
+            recent_writes.mark(conversation_pk, agent.id, conversation_id)
+            results[index] = (conversation_pk, conversation_id, context)
+        return results
+
+def assistant_messages(turns):
+    """构建要保存的助手消息，turns 为 (会话主键, 上下文, 回复内容, 日志内容) 列表"""
+    return [
+        Message(
+            conversation_id=conversation_pk,
+            role='assistant',
+            content=content,
+            token_count=count_message_tokens(content)
+        )
+        for conversation_pk, _, content, _ in turns
+    ]
+
+def remember_replies(agent_id, turns, rows):
+    """助手消息提交后记录日志、追加到会话上下文缓存并记录写入，rows 为与 turns 对应的消息行"""
+    for (conversation_pk, context, _, log_message), row in zip(turns, rows):
+        log_writer.write(agent_id, 'info', log_message)
+        context_cache.append(conversation_pk, context.last_message_id, [row])
+        recent_writes.mark(conversation_pk)
+
+def chat_log_message(agent, conversation_id, source=None):
+    """对话接口保存回复时的日志内容"""
+    via = f' via {source} API' if source else ''
+    return f'Message exchanged in conversation "{conversation_id}" for agent "{agent.name}"{via}'
+
+def invoke_log_message(agent, user_input, mode=None):
+    """invoke 接口保存回复时的日志内容，mode 为 stream 或 batch"""
+    suffix = f' ({mode})' if mode else ''
+    return f'Agent "{agent.name}" invoked with input: {user_input}{suffix}'
+
+# 模型请求
+
+def build_request_data(agent, messages, temperature=None, max_tokens=None):
+    """构建 chat/completions 请求参数，agent 为 AgentConfig，messages 为会话上下文中的消息数组，temperature/max_tokens 可覆盖智能体配置"""
+    request_data = {'model': agent.model_name, 'messages': messages}
+    request_data.update(agent.sampling)
+    if temperature is not None:
+        request_data['temperature'] = temperature
+    if max_tokens is not None:
+        request_data['max_tokens'] = max_tokens
+
+    # 添加停止序列（如果有的话）
+    if agent.stop:
+        request_data['stop'] = list(agent.stop)
+
+    return request_data
+
+def plan_turn_request(agent, conversation_pk, context, temperature=None, max_tokens=None):
+    """按上下文窗口截断历史并构建模型请求参数，返回 (请求参数, 上下文统计, 摘要请求)
+
+    开启 CONTEXT_SUMMARY_ENABLED 且截断了消息时，摘要已缓存则直接插入；未缓存时摘要请求为 (缓存键, 请求参数)，
+    调用方占用并发名额调用模型后用 apply_summary 插入摘要。其余情况摘要请求为 None。
+    """
+    request_data = build_request_data(agent, context.messages, temperature=temperature, max_tokens=max_tokens)
+
+    # 保留系统提示词和预算内最新的消息
+    budget = context_budget(agent, request_data['max_tokens'])
+    messages, dropped, context_tokens = select_context(context.messages, context.token_counts, budget, summarize=CONTEXT_SUMMARY_ENABLED)
+
+    summary_request = None
+    if dropped and CONTEXT_SUMMARY_ENABLED:
+        key = (conversation_pk, len(dropped))
+        summary = summary_cache.get(key)
+        if summary is None:
+            summary_request = (key, build_summary_request(agent, dropped))
+        elif summary:
+            messages = insert_summary(messages, summary)
+
+    request_data['messages'] = messages
+    return request_data, {'context_tokens': context_tokens, 'dropped_messages': len(dropped)}, summary_request
+
+def apply_summary(request_data, key, response_data):
+    """缓存模型生成的摘要并插入请求消息，响应格式错误时抛出 KeyError/IndexError"""
+    summary = extract_completion_content(response_data)
+    summary_cache.set(key, summary)
+    if summary:
+        request_data['messages'] = insert_summary(request_data['messages'], summary)
+
+def cached_completion(agent, request_data):
+    """查询补全缓存，返回 (缓存键, 缓存的响应数据)；不可缓存时缓存键为 None，未命中时响应数据为 None"""
+    key = completion_cache_key(agent, request_data)
+    if key is None:
+        return None, None
+    return key, completion_cache.get(key)
+
+def store_completion(key, response_data):
+    """保存模型回复到补全缓存（不可缓存的请求 key 为 None）"""
+    if key is not None:
+        completion_cache.set(key, response_data)
+
+def enable_stream(request_data):
+    """把请求改为流式，开启 METRICS_STREAM_USAGE 时要求上游在最后一块返回 usage"""
+    request_data['stream'] = True
+    if METRICS_STREAM_USAGE:
+        request_data['stream_options'] = {'include_usage': True}
+
+def record_completion_stats(context_stats, slot, cache_hit):
+    """把排队等待时间和是否命中补全缓存加入上下文统计"""
+    context_stats['queue_wait'] = round(slot.wait_time, 3)
+    context_stats['cached'] = cache_hit
+
+def extract_completion_content(response_data):
+    """从模型响应中取出助手回复内容"""
+    return response_data['choices'][0]['message']['content']
+
+def parse_stream_line(line):
+    """解析一行上游 SSE 数据，返回 (payload, 增量内容)；非 data 行返回 None"""
+    # 只处理 data 行，忽略心跳和注释
+    if not line or not line.startswith('data:'):
+        return None
+    payload = line[len('data:'):].strip()
+    if payload == STREAM_DONE:
+        return payload, None
+
+    try:
+        chunk = json.loads(payload)
+        delta = chunk['choices'][0].get('delta') or {}
+        return payload, delta.get('content')
+    except (ValueError, KeyError, IndexError, TypeError):
+        return payload, None
+
+def extract_stream_usage(payload):
+    """从上游 SSE 数据块中取出 usage（开启 stream_options.include_usage 时最后一块携带），没有时返回 None"""
+    if '"usage"' not in payload:
+        return None
+    try:
+        return json.loads(payload).get('usage')
+    except (ValueError, AttributeError):
+        return None
+
+class StreamRelay:
+    """转发上游模型的 SSE 响应：逐行转换为发给客户端的事件，同时拼接回复内容、记录首字时间和 usage
+
+    model_started 为发起模型请求的时间，用于计算首字时间和模型调用耗时。
+    """
+
+    def __init__(self, model_started):
+        self.model_started = model_started
+        self.chunks = []
+        self.ttft = None
+        self.usage = None
+        self.done = False
+
+    def feed(self, line):
+        """处理一行已解码的上游数据，返回要转发的事件；非 data 行返回 None，收到结束标记后 done 为 True"""
+        parsed = parse_stream_line(line)
+        if parsed is None:
+            return None
+        payload, content = parsed
+        if payload == STREAM_DONE:
+            self.done = True
+            return None
+        if content:
+            if self.ttft is None:
+                self.ttft = time.perf_counter() - self.model_started
+            self.chunks.append(content)
+        else:
+            self.usage = extract_stream_usage(payload) or self.usage
+        return sse_event(payload)
+
+    def finish(self):
+        """上游响应结束后记录模型调用指标，返回完整的回复内容"""
+        record_model_call(time.perf_counter() - self.model_started, self.usage, self.ttft)
+        return ''.join(self.chunks)
+
+def sse_event(data, event=None):
+    """构建一条 server-sent event"""
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    prefix = f'event: {event}\n' if event else ''
+    return f'{prefix}data: {payload}\n\n'
+
+def build_invoke_result(agent, conversation_id, output, request_data, context_stats=None, stream=False):
+    """构建 invoke 接口的响应结果，context_stats 为上下文截断统计（context_tokens、dropped_messages）"""
+    metadata = {
+        'agent_id': agent.id,
+        'agent_name': agent.name,
+        'model_name': agent.model_name,
+        'temperature': request_data['temperature'],
+        'max_tokens': request_data['max_tokens'],
+        'created_at': datetime.utcnow().isoformat()
+    }
+    if context_stats:
+        metadata.update(context_stats)
+    if stream:
+        metadata['stream'] = True
+
+    return {
+        'success': True,
+        'output': output,
+        'conversation_id': conversation_id,
+        'metadata': metadata
+    }
+
+def attach_timings(context_stats):
+    """把本次请求的耗时分解（数据库、模型调用、排队和其余处理时间）加入上下文统计"""
+    timings = timings_snapshot(context_stats.get('queue_wait', 0.0))
+    if timings:
+        context_stats['timings'] = timings
+    return context_stats
+
+def stream_done_events(agent, conversation_id, output, request_data, context_stats):
+    """流式调用结束时发送的事件：格式与非流式响应一致的最终结果，以及结束标记"""
+    result = build_invoke_result(agent, conversation_id, output, request_data, attach_timings(context_stats), stream=True)
+    return [sse_event(result, event='done'), sse_event(STREAM_DONE)]
+
+def stream_error_event(message):
+    """流式调用出错时发送的事件"""
+    return sse_event({'error': message}, event='error')
+
+# 批量调用
+
+def parse_invoke_batch(data):
+    """校验批量调用请求，返回 (输入列表, 并发数)，格式错误时抛出 InvalidBatch
+
+    inputs 中每项可以是字符串，或包含 input 及可选 conversation_id、temperature、max_tokens 的对象。
+    """
+    if not isinstance(data, dict):
+        raise InvalidBatch('Request body must be a JSON object')
+    inputs = data.get('inputs')
+    if not isinstance(inputs, list) or not inputs:
+        raise InvalidBatch('Inputs must be a non-empty list')
+    if len(inputs) > INVOKE_BATCH_MAX_SIZE:
+        raise InvalidBatch(f'Too many inputs (max {INVOKE_BATCH_MAX_SIZE})')
+
+    items = []
+    conversation_ids = set()
+    for index, item in enumerate(inputs):
+        if isinstance(item, str):
+            item = {'input': item}
+        if not isinstance(item, dict) or not isinstance(item.get('input'), str):
+            raise InvalidBatch(f'Input is required (item {index})')
+        conversation_id = item.get('conversation_id')
+        # 同一会话的多轮需要依次进行，不能在一个批次中并发
+        if conversation_id:
+            if conversation_id in conversation_ids:
+                raise InvalidBatch(f'Duplicate conversation_id "{conversation_id}" (item {index})')
+            conversation_ids.add(conversation_id)
+        items.append({
+            'input': item['input'],
+            'conversation_id': conversation_id,
+            'temperature': item.get('temperature'),
+            'max_tokens': item.get('max_tokens')
+        })
+
+    parallelism = data.get('parallelism') or INVOKE_BATCH_PARALLELISM
+    if not isinstance(parallelism, int) or parallelism < 1:
+        raise InvalidBatch('Parallelism must be a positive integer')
+    return items, min(parallelism, INVOKE_BATCH_MAX_PARALLELISM, len(items))
+
+def build_batch_error(index, conversation_id, error):
+    """构建批量调用中单项失败的结果"""
+    return {
+        'index': index,
+        'success': False,
+        'error': error,
+        'conversation_id': conversation_id
+    }
+
+def batch_failure(index, conversation_id, error, http_errors):
+    """把一项模型调用的异常转换为失败结果，http_errors 为模型客户端的 HTTP 异常类型；其他异常返回 None"""
+    if isinstance(error, ModelCallRejected):
+        return build_batch_error(index, conversation_id, str(error))
+    if isinstance(error, http_errors):
+        return build_batch_error(index, conversation_id, f'Model API error: {str(error)}')
+    if isinstance(error, (KeyError, IndexError, ValueError)):
+        return build_batch_error(index, conversation_id, f'Invalid model response: {str(error)}')
+    return None
+
+def batch_should_save(completed, done, pending):
+    """已完成的回复在没有更多立即可用的结果、所有调用都已结束或达到 INVOKE_BATCH_COMMIT_SIZE 时统一保存"""
+    return bool(completed) and (not done or not pending or len(completed) >= INVOKE_BATCH_COMMIT_SIZE)
+
+def batch_replies(agent, items, prepared, completed):
+    """把已完成的 (下标, 回复内容, 请求参数, 上下文统计) 转换为 save_turns 的参数"""
+    return [
+        (prepared[index][0], prepared[index][2], content, invoke_log_message(agent, items[index]['input'], 'batch'))
+        for index, content, _, _ in completed
+    ]
+
+def batch_results(agent, prepared, completed):
+    """保存成功后每项的结果（带 index）"""
+    results = []
+    for index, content, request_data, context_stats in completed:
+        result = build_invoke_result(agent, prepared[index][1], content, request_data, context_stats)
+        result['index'] = index
+        results.append(result)
+    return results
+
+def batch_save_errors(prepared, completed, error):
+    """保存失败时每项的失败结果"""
+    return [build_batch_error(index, prepared[index][1], str(error)) for index, _, _, _ in completed]
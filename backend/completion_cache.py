@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 模型补全缓存配置（只缓存开启了 completion_cache_enabled 且 temperature 为 0 的智能体的非流式调用）
+COMPLETION_CACHE_BACKEND = os.getenv('COMPLETION_CACHE_BACKEND', 'memory')  # memory 进程内缓存，sqlite 本地磁盘缓存
+COMPLETION_CACHE_PATH = os.getenv('COMPLETION_CACHE_PATH', os.path.join(os.path.dirname(__file__), 'completion_cache.sqlite3'))  # sqlite 缓存文件路径
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv('COMPLETION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))  # 缓存总大小上限（字节），0 表示关闭
+COMPLETION_CACHE_TTL = int(os.getenv('COMPLETION_CACHE_TTL', '86400'))  # 缓存过期时间（秒），0 表示不过期
+
+def completion_cache_key(agent, request_data):
+    """计算补全缓存键，不可缓存的请求返回 None
+
+    键为智能体ID、模型API地址、请求头（含 API Key）和完整请求参数的哈希，消息、采样参数、停止序列任一不同都不会命中。
+    缓存按智能体隔离：使用同一模型API的其他智能体不会拿到本智能体的回复，更换 API Key 后旧的缓存也不再命中。
+    """
+    if not agent.completion_cache_enabled or request_data.get('temperature') != 0 or request_data.get('stream'):
+        return None
+    raw = json.dumps([agent.id, agent.base_url, agent.headers, request_data], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class MemoryCompletionCache:
+    """进程内 LRU 补全缓存，按条目 JSON 大小限制总字节数"""
+
+    def __init__(self, max_bytes=COMPLETION_CACHE_MAX_BYTES, ttl=COMPLETION_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (响应数据, 字节数, 过期时间)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            response_data, size, expires_at = entry
+            if expires_at and expires_at < time.time():
+                del self._entries[key]
+                self.size -= size
+                return None
+            self._entries.move_to_end(key)
+            return response_data
+
+    def set(self, key, response_data):
+        size = len(json.dumps(response_data, ensure_ascii=False).encode())
+        if size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else 0
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (response_data, size, expires_at)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class SqliteCompletionCache:
+    """基于本地 SQLite 文件的补全缓存，进程重启后保留，多个工作进程可共享同一文件"""
+
+    def __init__(self, path=COMPLETION_CACHE_PATH, max_bytes=COMPLETION_CACHE_MAX_BYTES, ttl=COMPLETION_CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS completion_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS ix_completion_cache_accessed_at ON completion_cache (accessed_at)')
+
+    def _connect(self):
+        """每个线程使用自己的连接"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        connection = self._connect()
+        now = time.time()
+        row = connection.execute('SELECT value, expires_at FROM completion_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at and expires_at < now:
+            connection.execute('DELETE FROM completion_cache WHERE key = ?', (key,))
+            return None
+        connection.execute('UPDATE completion_cache SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key, response_data):
+        value = json.dumps(response_data, ensure_ascii=False)
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else 0
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                'INSERT OR REPLACE INTO completion_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, value, size, expires_at, now)
+            )
+            connection.execute('DELETE FROM completion_cache WHERE expires_at > 0 AND expires_at < ?', (now,))
+            # 超出总大小时按最近访问时间淘汰
+            total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM completion_cache').fetchone()[0]
+            if total > self.max_bytes:
+                evict_keys = []
+                for evict_key, evict_size in connection.execute('SELECT key, size FROM completion_cache ORDER BY accessed_at'):
+                    if total <= self.max_bytes:
+                        break
+                    evict_keys.append((evict_key,))
+                    total -= evict_size
+                connection.executemany('DELETE FROM completion_cache WHERE key = ?', evict_keys)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        self._connect().execute('DELETE FROM completion_cache')
+
+def create_completion_cache():
+    """根据配置创建补全缓存"""
+    if COMPLETION_CACHE_BACKEND == 'sqlite':
+        return SqliteCompletionCache()
+    return MemoryCompletionCache()
+
+# 进程内共享的补全缓存
+completion_cache = create_completion_cache()
@@ -0,0 +1,170 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from sqlalchemy import event, select
+from models import Message
+
+# 会话上下文缓存配置
+CONTEXT_CACHE_SIZE = int(os.getenv('CONTEXT_CACHE_SIZE', '1000'))  # 进程内最多缓存的会话数量，0 表示关闭
+CONTEXT_CACHE_URL = os.getenv('CONTEXT_CACHE_URL')  # 共享缓存地址（redis://...），不设置时使用进程内缓存
+CONTEXT_CACHE_TTL = int(os.getenv('CONTEXT_CACHE_TTL', '3600'))  # 共享缓存过期时间（秒）
+
+class ConversationContext:
+    """已构建好的会话消息数组及每条消息的 token 数，last_message_id 为已包含的最大消息ID"""
+
+    __slots__ = ('messages', 'token_counts', 'last_message_id')
+
+    def __init__(self, messages=None, token_counts=None, last_message_id=0):
+        self.messages = messages or []
+        self.token_counts = token_counts or []
+        self.last_message_id = last_message_id
+
+    def extend(self, rows):
+        """追加 (id, role, content, token_count) 消息行，返回新的上下文（原对象不变，可在线程间共享）"""
+        messages = list(self.messages)
+        token_counts = list(self.token_counts)
+        last_message_id = self.last_message_id
+        for message_id, role, content, token_count in rows:
+            messages.append({'role': role, 'content': content})
+            token_counts.append(token_count)
+            last_message_id = max(last_message_id, message_id)
+        return ConversationContext(messages, token_counts, last_message_id)
+
+    def has_system_message(self):
+        """会话中是否已有系统消息"""
+        return any(msg['role'] == 'system' for msg in self.messages)
+
+    def to_json(self):
+        return json.dumps({
+            'messages': self.messages,
+            'token_counts': self.token_counts,
+            'last_message_id': self.last_message_id
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        return cls(data['messages'], data['token_counts'], data['last_message_id'])
+
+class MemoryContextCache:
+    """进程内 LRU 会话上下文缓存"""
+
+    def __init__(self, max_size=CONTEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            context = self._entries.get(key)
+            if context is not None:
+                self._entries.move_to_end(key)
+            return context
+
+    def set(self, key, context):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = context
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def append(self, key, expected_last_id, rows):
+        """在缓存版本与 expected_last_id 一致时追加消息，否则说明有并发写入，直接失效"""
+        with self._lock:
+            context = self._entries.get(key)
+            if context is None:
+                return
+            if context.last_message_id != expected_last_id:
+                del self._entries[key]
+                return
+            self._entries[key] = context.extend(rows)
+            self._entries.move_to_end(key)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class RedisContextCache:
+    """基于 Redis 的共享会话上下文缓存（多进程/多实例共享）"""
+
+    def __init__(self, url, ttl=CONTEXT_CACHE_TTL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f'conversation_context:{key}'
+
+    def get(self, key):
+        raw = self.client.get(self._key(key))
+        return ConversationContext.from_json(raw) if raw else None
+
+    def set(self, key, context):
+        self.client.set(self._key(key), context.to_json(), ex=self.ttl)
+
+    def append(self, key, expected_last_id, rows):
+        """使用 WATCH 乐观锁追加消息，版本不一致或并发修改时直接失效"""
+        import redis
+        name = self._key(key)
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                raw = pipe.get(name)
+                if not raw:
+                    return
+                context = ConversationContext.from_json(raw)
+                pipe.multi()
+                if context.last_message_id != expected_last_id:
+                    pipe.delete(name)
+                else:
+                    pipe.set(name, context.extend(rows).to_json(), ex=self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                self.client.delete(name)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for name in self.client.scan_iter(self._key('*')):
+            self.client.delete(name)
+
+def create_context_cache():
+    """根据配置创建会话上下文缓存"""
+    if CONTEXT_CACHE_URL:
+        return RedisContextCache(CONTEXT_CACHE_URL)
+    return MemoryContextCache()
+
+# 进程内共享的会话上下文缓存，键为 Conversation 主键
+context_cache = create_context_cache()
+
+def context_rows_query(conversation_pk, context=None):
+    """构建加载会话消息行的查询：无缓存时加载全部历史，有缓存时只加载缓存之后的新消息（如其他进程写入的）"""
+    query = select(Message.id, Message.role, Message.content, Message.token_count).where(Message.conversation_id == conversation_pk)
+    if context is None:
+        return query.order_by(Message.created_at, Message.id)
+    return query.where(Message.id > context.last_message_id).order_by(Message.id)
+
+def merge_context(conversation_pk, context, rows):
+    """将查询到的消息行合并进上下文并写回缓存"""
+    if context is None:
+        context = ConversationContext().extend(rows)
+    elif rows:
+        context = context.extend(rows)
+    else:
+        return context
+    context_cache.set(conversation_pk, context)
+    return context
+
+@event.listens_for(Message, 'after_update')
+@event.listens_for(Message, 'after_delete')
+def invalidate_conversation_context(mapper, connection, target):
+    """消息被修改或删除时使对应会话的缓存失效（批量 query.delete() 不触发，需要手动调用 context_cache.delete）"""
+    context_cache.delete(target.conversation_id)
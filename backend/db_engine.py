@@ -0,0 +1,57 @@
+import os
+from sqlalchemy import event
+
+# SQLite 连接参数（每个新连接执行一次 PRAGMA）
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')  # 日志模式：WAL 允许读写并发，DELETE 为 SQLite 默认的回滚日志
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')  # 同步级别：WAL 模式下 NORMAL 不会损坏数据库，只可能在断电时丢失最近的事务
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000'))  # 数据库被锁定时的等待时间（毫秒）
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))  # 内存映射读取的大小（字节），0 表示关闭
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-65536'))  # 每个连接的页缓存，负数表示 KiB（-65536 即 64MB），正数表示页数
+
+# MySQL 连接池参数
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))  # 连接池保持的连接数
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))  # 超出连接池大小后最多额外创建的连接数
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))  # 等待可用连接的最长时间（秒）
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '3600'))  # 连接使用超过该时间（秒）后重建，应小于 MySQL 的 wait_timeout
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'  # 取出连接时先检查是否可用，避免使用已被服务端断开的连接
+
+def engine_options(db_type):
+    """数据库引擎参数（用于 SQLALCHEMY_ENGINE_OPTIONS 和异步引擎）"""
+    if db_type == 'mysql':
+        return {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING
+        }
+    # 驱动层的锁等待与 busy_timeout 一致
+    return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT / 1000}}
+
+def sqlite_pragmas():
+    """新连接上执行的 PRAGMA 语句"""
+    pragmas = []
+    if SQLITE_JOURNAL_MODE:
+        pragmas.append(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    if SQLITE_SYNCHRONOUS:
+        pragmas.append(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    pragmas.append(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    pragmas.append(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    pragmas.append(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    return pragmas
+
+def configure_engine(engine, pragmas=None):
+    """为 SQLite 引擎注册连接事件设置 PRAGMA（异步引擎传入 engine.sync_engine），须在建立第一个连接前调用"""
+    if engine.dialect.name != 'sqlite':
+        return
+    if pragmas is None:
+        pragmas = sqlite_pragmas()
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
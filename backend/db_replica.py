@@ -0,0 +1,213 @@
+import os
+import math
+import time
+import functools
+import threading
+from contextvars import ContextVar
+from flask_sqlalchemy.session import Session
+
+# 只读副本配置（仅 DB_TYPE=mysql 时生效）
+DB_REPLICA_HOSTS = os.getenv('DB_REPLICA_HOSTS', '')  # 逗号分隔的只读副本地址（host 或 host:port），为空时所有查询走主库
+DB_REPLICA_USER = os.getenv('DB_REPLICA_USER', '')  # 副本用户名，为空时使用 DB_USER
+DB_REPLICA_PASSWORD = os.getenv('DB_REPLICA_PASSWORD', '')  # 副本密码，为空时使用 DB_PASSWORD
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))  # 副本最大允许延迟（秒），超过时读取回到主库，0 表示不检查（检查需要 REPLICATION CLIENT 权限）
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))  # 检查副本延迟的间隔（秒）
+DB_READ_YOUR_WRITES_WINDOW = float(os.getenv('DB_READ_YOUR_WRITES_WINDOW', '10'))  # 会话被写入后该时间（秒）内读取其历史仍走主库
+
+# 读己之写的实际窗口：至少覆盖副本允许的最大延迟（延迟每 DB_REPLICA_CHECK_INTERVAL 秒才检查一次）
+READ_YOUR_WRITES_WINDOW = max(DB_READ_YOUR_WRITES_WINDOW, DB_REPLICA_MAX_LAG + DB_REPLICA_CHECK_INTERVAL if DB_REPLICA_MAX_LAG > 0 else 0)
+
+# 写入标记：写入会话的响应带上写入时间，客户端之后的请求带回该值时读取走主库（多进程部署时请求可能落到其他进程）
+WRITE_MARKER_HEADER = 'X-Last-Write'
+WRITE_MARKER_COOKIE = 'last_write'
+
+# 当前请求读副本的状态（由 read_replica 装饰的只读接口设置）：{'engine': 本请求固定使用的副本引擎}，None 表示使用主库
+_replica_request = ContextVar('read_replica_request', default=None)
+# 当前请求的写入记录：{'at': 最近一次写入会话的时间戳}
+_request_writes = ContextVar('request_writes', default=None)
+
+def replica_database_uris(user, password, name):
+    """根据 DB_REPLICA_HOSTS 构建副本连接串"""
+    uris = []
+    for host in DB_REPLICA_HOSTS.split(','):
+        host = host.strip()
+        if not host:
+            continue
+        if ':' not in host:
+            host += ':3306'
+        uris.append(f'mysql+pymysql://{DB_REPLICA_USER or user}:{DB_REPLICA_PASSWORD or password}@{host}/{name}')
+    return uris
+
+class _Replica:
+    __slots__ = ('engine', 'healthy', 'lag', 'checked_at', 'error')
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.lag = None
+        self.checked_at = 0.0
+        self.error = None
+
+class ReplicaRouter:
+    """在健康且延迟不超过上限的副本间轮流分配只读查询，没有可用副本时返回 None（使用主库）"""
+
+    def __init__(self, max_lag=DB_REPLICA_MAX_LAG, check_interval=DB_REPLICA_CHECK_INTERVAL):
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def init_engines(self, engines):
+        self.replicas = [_Replica(engine) for engine in engines]
+
+    def pick(self):
+        """选择一个可用副本的引擎"""
+        if not self.replicas:
+            return None
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            self._check(replica)
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def _check(self, replica):
+        """超过检查间隔时查询副本延迟（同一时刻只有一个线程检查）"""
+        if time.monotonic() - replica.checked_at < self.check_interval:
+            return
+        with self._lock:
+            if time.monotonic() - replica.checked_at < self.check_interval:
+                return
+            replica.checked_at = time.monotonic()
+        if self.max_lag <= 0:
+            return
+        try:
+            replica.lag = self.replication_lag(replica.engine)
+            replica.healthy = replica.lag is not None and replica.lag <= self.max_lag
+            replica.error = None if replica.healthy else f'Replication lag {replica.lag} exceeds {self.max_lag}s'
+        except Exception as e:
+            replica.healthy = False
+            replica.error = str(e)
+
+    @staticmethod
+    def replication_lag(engine):
+        """查询副本落后主库的秒数，复制中断时返回 None，不是副本（如经过代理）时返回 0"""
+        with engine.connect() as connection:
+            for statement, column in (('SHOW REPLICA STATUS', 'Seconds_Behind_Source'), ('SHOW SLAVE STATUS', 'Seconds_Behind_Master')):
+                try:
+                    row = connection.exec_driver_sql(statement).mappings().first()
+                except Exception:
+                    # MySQL 8.0.22 之前只支持 SHOW SLAVE STATUS
+                    connection.rollback()
+                    continue
+                if row is None:
+                    return 0
+                return row.get(column)
+        raise RuntimeError('Unable to read replication status')
+
+    def stats(self):
+        return [{
+            'url': replica.engine.url.render_as_string(hide_password=True),
+            'healthy': replica.healthy,
+            'lag': replica.lag,
+            'error': replica.error
+        } for replica in self.replicas]
+
+class RecentWrites:
+    """记录本进程最近写入的会话，写入后 window 秒内读取该会话历史仍走主库（读己之写）
+
+    只在本进程内有效；多进程部署时由写入标记（WRITE_MARKER_HEADER / WRITE_MARKER_COOKIE）保证跨进程的读己之写。
+    """
+
+    def __init__(self, window=READ_YOUR_WRITES_WINDOW, max_entries=10000):
+        self.window = window
+        self.max_entries = max_entries
+        self._conversations = {}  # (智能体ID, 会话ID) -> 会话主键
+        self._written_at = {}  # 会话主键 -> 最近写入时间
+        self._lock = threading.Lock()
+
+    def mark(self, conversation_pk, agent_id=None, conversation_id=None):
+        writes = _request_writes.get()
+        if writes is not None:
+            writes['at'] = time.time()
+        now = time.monotonic()
+        with self._lock:
+            if conversation_id is not None:
+                self._conversations[(agent_id, conversation_id)] = conversation_pk
+            self._written_at[conversation_pk] = now
+            if len(self._written_at) > self.max_entries:
+                self._prune(now)
+
+    def _prune(self, now):
+        expired = {pk for pk, written_at in self._written_at.items() if now - written_at >= self.window}
+        for pk in expired:
+            del self._written_at[pk]
+        self._conversations = {key: pk for key, pk in self._conversations.items() if pk in self._written_at}
+
+    def is_recent(self, agent_id, conversation_id):
+        conversation_pk = self._conversations.get((agent_id, conversation_id))
+        written_at = self._written_at.get(conversation_pk)
+        return written_at is not None and time.monotonic() - written_at < self.window
+
+# 进程内共享的副本路由和最近写入记录
+replica_router = ReplicaRouter()
+recent_writes = RecentWrites()
+
+class RoutingSession(Session):
+    """只读接口中的查询发往副本，其余（包括写入和 flush）使用主库"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        state = _replica_request.get()
+        if bind is None and state is not None and not self._flushing:
+            # 第一条查询时选定副本，同一请求的其余查询（如分页的 COUNT 和数据查询）使用同一个副本，
+            # 避免不同副本的延迟不同导致总数与当前页不一致或游标分页漏行、重复
+            if 'engine' not in state:
+                state['engine'] = replica_router.pick()
+            if state['engine'] is not None:
+                return state['engine']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def read_replica(func):
+    """标记只读接口方法：方法内的查询可以读副本（数据可能落后主库，最多 DB_REPLICA_MAX_LAG 秒）"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _replica_request.set({})
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _replica_request.reset(token)
+    return wrapper
+
+def use_primary():
+    """当前接口剩余的查询改走主库（如读取刚写入的会话）"""
+    _replica_request.set(None)
+
+def begin_request_writes():
+    """开始记录本请求中的会话写入（每个请求开始时调用）"""
+    _request_writes.set({})
+
+def apply_write_marker(response):
+    """本请求写入过会话时，在响应中带上写入时间（响应头和 Cookie，Flask 和 Starlette 的响应均可）"""
+    writes = _request_writes.get()
+    if writes and 'at' in writes:
+        value = f'{writes["at"]:.3f}'
+        response.headers[WRITE_MARKER_HEADER] = value
+        response.set_cookie(WRITE_MARKER_COOKIE, value, max_age=math.ceil(READ_YOUR_WRITES_WINDOW), httponly=True, samesite='Lax')
+    return response
+
+def client_wrote_recently(headers, cookies):
+    """客户端带回的写入时间是否在读己之写的窗口内（此时读取应走主库）"""
+    value = headers.get(WRITE_MARKER_HEADER) or cookies.get(WRITE_MARKER_COOKIE)
+    try:
+        return value is not None and time.time() - float(value) < READ_YOUR_WRITES_WINDOW
+    except ValueError:
+        return False
+
+def init_app(app):
+    """为 Flask 应用注册写入标记钩子"""
+    app.before_request(begin_request_writes)
+    app.after_request(apply_write_marker)
@@ -0,0 +1,42 @@
+import os
+import json
+from sqlalchemy import select
+from models import Message
+
+# 会话历史导出配置
+MESSAGE_EXPORT_CHUNK_SIZE = int(os.getenv('MESSAGE_EXPORT_CHUNK_SIZE', '500'))  # 流式导出时每次从数据库读取的消息条数
+MESSAGE_WINDOW_MAX_LIMIT = int(os.getenv('MESSAGE_WINDOW_MAX_LIMIT', '1000'))  # 分段获取时单次最多返回的消息条数
+
+# 导出时只读取需要的列，不构建 ORM 对象
+MESSAGE_COLUMNS = (Message.id, Message.conversation_id, Message.role, Message.content, Message.created_at)
+
+def message_row_to_dict(row):
+    """将消息列元组转换为与 Message.to_dict 相同的字典"""
+    message_id, conversation_id, role, content, created_at = row
+    return {
+        'id': message_id,
+        'conversation_id': conversation_id,
+        'role': role,
+        'content': content,
+        'created_at': created_at.isoformat()
+    }
+
+def message_window_query(conversation_pk, after_id=None, limit=None):
+    """构建按消息ID升序读取会话历史的查询，after_id 之后最多 limit 条"""
+    query = select(*MESSAGE_COLUMNS).where(Message.conversation_id == conversation_pk)
+    if after_id is not None:
+        query = query.where(Message.id > after_id)
+    query = query.order_by(Message.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+def iter_messages_ndjson(session, conversation_pk, after_id=None, limit=None, chunk_size=MESSAGE_EXPORT_CHUNK_SIZE):
+    """逐行生成会话历史的 NDJSON（after_id 之后最多 limit 条），使用服务端游标分块读取，内存占用与会话长度无关"""
+    query = message_window_query(conversation_pk, after_id, limit).execution_options(yield_per=chunk_size)
+    result = session.execute(query)
+    try:
+        for row in result:
+            yield json.dumps(message_row_to_dict(row), ensure_ascii=False) + '\n'
+    finally:
+        result.close()
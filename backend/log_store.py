@@ -0,0 +1,643 @@
+import os
+import re
+import gzip
+import json
+import math
+import time
+import heapq
+import atexit
+import threading
+from datetime import datetime, timedelta
+from flask import request, abort
+from sqlalchemy import MetaData, Table, Column, Index, Integer, SmallInteger, String, Text, DateTime
+from sqlalchemy import and_, or_, case, func, insert, literal, select, text, union_all
+from sqlalchemy.schema import CreateIndex, CreateTable
+from models import AgentLog
+from pagination import decode_cursor, encode_cursor, page_size, paginate_query
+from serializers import log_serializer
+
+# 日志分区配置
+LOG_PARTITIONING = os.getenv('LOG_PARTITIONING', 'false').lower() == 'true'  # 是否按月和保留期分区存储日志（MySQL 分区表，SQLite 滚动表）
+LOG_RETENTION = os.getenv('LOG_RETENTION', 'debug=7,info=90,warning=180,error=365')  # 各级别日志的保留天数，0 表示永久保留
+LOG_RETENTION_DEFAULT = int(os.getenv('LOG_RETENTION_DEFAULT', '365'))  # 未在 LOG_RETENTION 中列出的级别的保留天数
+LOG_PURGE_INTERVAL = float(os.getenv('LOG_PURGE_INTERVAL', '3600'))  # 检查过期分区和预建分区的间隔（秒）
+LOG_PARTITION_AHEAD = int(os.getenv('LOG_PARTITION_AHEAD', '1'))  # 预先创建的未来月份数
+LOG_PARTITION_LOCK_TIMEOUT = int(os.getenv('LOG_PARTITION_LOCK_TIMEOUT', '60'))  # python log_store.py partition 等待其他进程的维护结束的最长时间（秒）
+LOG_ARCHIVE_DIR = os.getenv('LOG_ARCHIVE_DIR', os.path.join(os.path.dirname(__file__), 'logs', 'archive'))  # 过期分区的归档目录（gzip 压缩的 NDJSON），为空时直接删除不归档
+
+LOG_TABLE = AgentLog.__tablename__
+MAX_RETENTION_DAYS = 4095
+TABLE_CACHE_TTL = 60  # SQLite 滚动表列表的缓存时间（秒），其他进程新建的表最多延迟该时间可见
+ARCHIVE_PATTERN = re.compile(rf'^{LOG_TABLE}_(\d{{6}})_r(\d+)\.ndjson\.gz$')
+SQLITE_TABLE_PATTERN = re.compile(rf'^{LOG_TABLE}_(\d{{6}})_r(\d+)$')
+MYSQL_PARTITION_PATTERN = re.compile(r'^p_r(\d+)_(\d{6}|max)$')
+MYSQL_MAINTENANCE_LOCK = 'agent_log_maintenance'  # 维护和分区转换共用的 MySQL 命名锁，多个进程中同时只有一个执行
+
+class InvalidArchiveMonth(ValueError):
+    """归档月份格式错误（应为 YYYY-MM）"""
+
+class MaintenanceLocked(RuntimeError):
+    """其他进程正在维护日志分区"""
+
+def parse_retention(spec, default=LOG_RETENTION_DEFAULT):
+    """解析 debug=7,info=90 形式的保留天数配置"""
+    retention = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        level, days = item.split('=', 1)
+        retention[level.strip()] = min(int(days), MAX_RETENTION_DAYS)
+    return retention, min(default, MAX_RETENTION_DAYS)
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def month_key(month):
+    return month.strftime('%Y%m')
+
+def parse_month_key(key):
+    return datetime.strptime(key, '%Y%m')
+
+def bucket_name(month, days):
+    """分桶名称（SQLite 表名和归档文件名）"""
+    return f'{LOG_TABLE}_{month_key(month)}_r{days}'
+
+def bucket_expired(month, days, now):
+    """整个月的日志都超过保留期时分桶过期"""
+    return days > 0 and next_month(month) + timedelta(days=days) <= now
+
+def base_id(month, days):
+    """SQLite 滚动表的起始ID：按月份和保留期错开，不同表的日志ID不重复且随月份递增"""
+    return max((((month.year - 2020) * 12 + month.month - 1) * (MAX_RETENTION_DAYS + 1) + days) << 32, 0)
+
+class LogStore:
+    """按时间分桶存储智能体日志
+
+    开启 LOG_PARTITIONING 后，日志按 (保留天数, 月份) 分桶：MySQL 使用 agent_log 表的
+    RANGE COLUMNS(retention_days, created_at) 分区，SQLite 使用 agent_log_YYYYMM_rN 滚动表。
+    后台线程定期预建未来月份的分桶，并把整桶过期的日志归档为压缩 NDJSON 后整体删除（DROP PARTITION / DROP TABLE）。
+    MySQL 上把已有的 agent_log 表改为分区表需要重建整表，不在后台线程中执行，由 python log_store.py partition 显式完成。
+    """
+
+    def __init__(self, enabled=LOG_PARTITIONING, retention=LOG_RETENTION, default_retention=LOG_RETENTION_DEFAULT,
+                 purge_interval=LOG_PURGE_INTERVAL, ahead=LOG_PARTITION_AHEAD, archive_dir=LOG_ARCHIVE_DIR):
+        self.enabled = enabled
+        self.retention, self.default_retention = parse_retention(retention, default_retention)
+        self.purge_interval = purge_interval
+        self.ahead = ahead
+        self.archive_dir = archive_dir
+        self.engine = None
+        self.archived = 0
+        self.dropped = 0
+        self._metadata = MetaData()
+        self._tables = {}  # SQLite 表名 -> Table
+        self._created = set()  # 本进程确认存在的 SQLite 表
+        self._listed = (0.0, [])  # (列出时间, [(月份, 保留天数, 表名)])
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._unpartitioned_warned = False
+
+    @property
+    def dialect(self):
+        return self.engine.dialect.name if self.engine is not None else None
+
+    @property
+    def rolling_tables(self):
+        """是否使用 SQLite 滚动表（读取和写入都不再使用 agent_log 表）"""
+        return self.enabled and self.dialect == 'sqlite'
+
+    def init_engine(self, engine):
+        """设置数据库引擎并启动后台维护线程（启动后先预建分桶）"""
+        self.engine = engine
+        if self.enabled and self.dialect in ('sqlite', 'mysql'):
+            self._ensure_started()
+
+    def retention_days(self, level):
+        """该级别日志的保留天数"""
+        return self.retention.get(level, self.default_retention)
+
+    def retention_classes(self):
+        return sorted(set(self.retention.values()) | {self.default_retention})
+
+    def months_ahead(self, now):
+        """当前月份和预建的未来月份"""
+        months = [month_start(now)]
+        for _ in range(self.ahead):
+            months.append(next_month(months[-1]))
+        return months
+
+    # 写入
+
+    def insert(self, connection, records):
+        """在调用方的事务中插入一批日志记录（补充 retention_days，滚动表模式下按分桶写入对应的表）"""
+        for record in records:
+            record.setdefault('retention_days', self.retention_days(record['level']))
+        if not self.rolling_tables:
+            connection.execute(insert(AgentLog.__table__), records)
+            return
+        groups = {}
+        for record in records:
+            groups.setdefault(bucket_name(month_start(record['created_at']), record['retention_days']), []).append(record)
+        try:
+            for name, group in groups.items():
+                connection.execute(insert(self._ensure_table(connection, name)), group)
+        except Exception:
+            # 事务回滚后建表也被撤销，下次写入时重新确认
+            self._created.difference_update(groups)
+            raise
+
+    def _bucket_table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(name)
+                if table is None:
+                    table = Table(
+                        name, self._metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('agent_id', Integer, nullable=False),
+                        Column('level', String(20), nullable=False),
+                        Column('message', Text, nullable=False),
+                        Column('created_at', DateTime, nullable=False),
+                        Column('retention_days', SmallInteger),
+                        Index(f'ix_{name}_agent_created', 'agent_id', 'created_at'),
+                        Index(f'ix_{name}_created_at', 'created_at'),
+                        sqlite_autoincrement=True
+                    )
+                    self._tables[name] = table
+        return table
+
+    def _ensure_table(self, connection, name):
+        """创建 SQLite 滚动表（已存在时跳过），新表的自增ID从该分桶的起始ID开始"""
+        table = self._bucket_table(name)
+        if name in self._created:
+            return table
+        # 多个进程或线程可能同时创建同一个表
+        connection.execute(CreateTable(table, if_not_exists=True))
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+        month, days = SQLITE_TABLE_PATTERN.match(name).groups()
+        connection.execute(
+            text('INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'),
+            {'name': name, 'seq': base_id(parse_month_key(month), int(days))}
+        )
+        self._created.add(name)
+        return table
+
+    # 读取
+
+    def _list_tables(self, connection=None, refresh=False):
+        """SQLite 滚动表，按月份从新到旧排列"""
+        listed_at, tables = self._listed
+        if not refresh and time.monotonic() - listed_at < TABLE_CACHE_TTL:
+            return tables
+        statement = text("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :prefix")
+        if connection is None:
+            with self.engine.connect() as connection:
+                names = connection.execute(statement, {'prefix': f'{LOG_TABLE}_%'}).scalars().all()
+        else:
+            names = connection.execute(statement, {'prefix': f'{LOG_TABLE}_%'}).scalars().all()
+        tables = []
+        for name in names:
+            match = SQLITE_TABLE_PATTERN.match(name)
+            if match:
+                tables.append((parse_month_key(match.group(1)), int(match.group(2)), name))
+        tables.sort(reverse=True)
+        self._listed = (time.monotonic(), tables)
+        return tables
+
+    def _month_groups(self, session):
+        """按月份分组的滚动表，从新到旧：[(月份, [Table])]"""
+        groups = []
+        for month, _, name in self._list_tables(session.connection()):
+            if not groups or groups[-1][0] != month:
+                groups.append((month, []))
+            groups[-1][1].append(self._bucket_table(name))
+        return groups
+
+    @staticmethod
+    def _filtered(table, agent_id, cursor=None, column_names=('id', 'created_at')):
+        query = select(*(table.c[name] for name in column_names))
+        if agent_id is not None:
+            query = query.where(table.c.agent_id == agent_id)
+        if cursor is not None:
+            created_at, item_id = cursor
+            query = query.where(or_(
+                table.c.created_at < created_at,
+                and_(table.c.created_at == created_at, table.c.id < item_id)
+            ))
+        return query
+
+    def _fetch_month(self, session, tables, agent_id, cursor, limit, offset=0, column_names=('id', 'created_at')):
+        """读取一个月的日志（各保留期的表分别排序截取后合并）"""
+        branches = [
+            select(self._filtered(table, agent_id, cursor, column_names).order_by(table.c.created_at.desc(), table.c.id.desc()).limit(limit + offset).subquery())
+            for table in tables
+        ]
+        merged = union_all(*branches).subquery()
+        return session.execute(
+            select(merged).order_by(merged.c.created_at.desc(), merged.c.id.desc()).limit(limit).offset(offset)
+        ).all()
+
+    def _count_month(self, session, tables, agent_id):
+        return sum(
+            session.execute(select(func.count()).select_from(self._filtered(table, agent_id).subquery())).scalar()
+            for table in tables
+        )
+
+    def paginate(self, session, agent_id=None, key='logs', default_per_page=20, serializer=None):
+        """按请求参数分页读取日志，响应格式与 paginate_query 相同，serializer 为 log_serializer 编译的序列化器（选定字段）"""
+        serializer = serializer or log_serializer.compile()
+        if not self.rolling_tables:
+            query = AgentLog.query if agent_id is None else AgentLog.query.filter_by(agent_id=agent_id)
+            return paginate_query(query, AgentLog, key, serializer, default_per_page=default_per_page)
+
+        per_page = page_size(default_per_page)
+        months = self._month_groups(session)
+
+        if 'cursor' in request.args:
+            cursor = decode_cursor(request.args['cursor']) if request.args['cursor'] else None
+            items = []
+            for month, tables in months:
+                # 整个月都比游标新的分桶不需要读取
+                if cursor is not None and cursor[0] < month:
+                    continue
+                items.extend(self._fetch_month(session, tables, agent_id, cursor, per_page + 1 - len(items), column_names=serializer.column_names))
+                if len(items) > per_page:
+                    break
+            next_cursor = None
+            if len(items) > per_page:
+                items = items[:per_page]
+                next_cursor = encode_cursor(items[-1].created_at, items[-1].id)
+            response = {key: serializer(items), 'next_cursor': next_cursor, 'per_page': per_page}
+            if request.args.get('with_total', 'false').lower() == 'true':
+                response['total'] = sum(self._count_month(session, tables, agent_id) for _, tables in months)
+            return response
+
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404)
+        counts = [self._count_month(session, tables, agent_id) for _, tables in months]
+        offset = (page - 1) * per_page
+        items = []
+        for (_, tables), count in zip(months, counts):
+            if offset >= count:
+                offset -= count
+                continue
+            items.extend(self._fetch_month(session, tables, agent_id, None, per_page - len(items), offset, serializer.column_names))
+            offset = 0
+            if len(items) >= per_page:
+                break
+        if page > 1 and not items:
+            abort(404)
+        total = sum(counts)
+        return {
+            key: serializer(items),
+            'total': total,
+            'pages': math.ceil(total / per_page),
+            'current_page': page,
+            'per_page': per_page
+        }
+
+    # 归档
+
+    def archives(self, month=None):
+        """归档文件列表：[(月份, 保留天数, 路径)]，按月份从新到旧"""
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return []
+        archives = []
+        for filename in os.listdir(self.archive_dir):
+            match = ARCHIVE_PATTERN.match(filename)
+            if match and (month is None or match.group(1) == month_key(month)):
+                archives.append((parse_month_key(match.group(1)), int(match.group(2)), os.path.join(self.archive_dir, filename)))
+        archives.sort(reverse=True)
+        return archives
+
+    def _iter_archive(self, month, agent_id):
+        for _, _, path in self.archives(month):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    item = json.loads(line)
+                    if agent_id is None or item['agent_id'] == agent_id:
+                        yield item
+
+    def paginate_archive(self, month, agent_id=None, key='logs', default_per_page=20, serializer=None):
+        """分页读取某个月的归档日志（month 为 YYYY-MM），响应格式与 paginate_query 相同"""
+        serializer = serializer or log_serializer.compile()
+        try:
+            month = datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            raise InvalidArchiveMonth(month)
+        per_page = page_size(default_per_page)
+
+        def sort_key(item):
+            return (item['created_at'], item['id'])
+
+        if 'cursor' in request.args:
+            cursor = decode_cursor(request.args['cursor']) if request.args['cursor'] else None
+            total = 0
+            candidates = []
+            for item in self._iter_archive(month, agent_id):
+                total += 1
+                if cursor is None or (datetime.fromisoformat(item['created_at']), item['id']) < cursor:
+                    candidates.append(item)
+            items = heapq.nlargest(per_page + 1, candidates, key=sort_key)
+            next_cursor = None
+            if len(items) > per_page:
+                items = items[:per_page]
+                next_cursor = encode_cursor(datetime.fromisoformat(items[-1]['created_at']), items[-1]['id'])
+            response = {key: serializer.pick(items), 'next_cursor': next_cursor, 'per_page': per_page}
+            if request.args.get('with_total', 'false').lower() == 'true':
+                response['total'] = total
+            return response
+
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404)
+        items = list(self._iter_archive(month, agent_id))
+        total = len(items)
+        items = heapq.nlargest(page * per_page, items, key=sort_key)[(page - 1) * per_page:]
+        if page > 1 and not items:
+            abort(404)
+        return {
+            key: serializer.pick(items),
+            'total': total,
+            'pages': math.ceil(total / per_page),
+            'current_page': page,
+            'per_page': per_page
+        }
+
+    def _write_archive(self, name, rows):
+        """把一个分桶的日志写入压缩 NDJSON（先写临时文件再改名，空分桶不生成文件），返回条数"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f'{name}.ndjson.gz')
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        count = 0
+        with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(AgentLog.to_dict(row), ensure_ascii=False) + '\n')
+                count += 1
+        if count:
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+        return count
+
+    # 维护
+
+    def maintain(self, now=None):
+        """预建当前和未来月份的分桶，归档并删除过期分桶，返回删除的分桶名称"""
+        now = now or datetime.utcnow()
+        if self.dialect == 'sqlite':
+            return self._maintain_sqlite(now)
+        if self.dialect == 'mysql':
+            return self._maintain_mysql(now)
+        return []
+
+    def _maintain_sqlite(self, now):
+        with self.engine.begin() as connection:
+            self._migrate_sqlite_legacy(connection)
+            for month in self.months_ahead(now):
+                for days in self.retention_classes():
+                    self._ensure_table(connection, bucket_name(month, days))
+
+        dropped = []
+        for month, days, name in self._list_tables(refresh=True):
+            if not bucket_expired(month, days, now):
+                continue
+            table = self._bucket_table(name)
+            if self.archive_dir:
+                with self.engine.connect() as connection:
+                    rows = connection.execute(select(table), execution_options={'stream_results': True})
+                    self.archived += self._write_archive(name, rows)
+            with self.engine.begin() as connection:
+                table.drop(connection, checkfirst=True)
+            with self._lock:
+                self._created.discard(name)
+                self._tables.pop(name, None)
+                self._metadata.remove(table)
+            dropped.append(name)
+        self.dropped += len(dropped)
+        self._list_tables(refresh=True)
+        return dropped
+
+    def _migrate_sqlite_legacy(self, connection):
+        """把开启分区前写入 agent_log 表的日志按分桶移动到滚动表（保留原ID）"""
+        legacy = AgentLog.__table__
+        month_expression = func.strftime('%Y%m', legacy.c.created_at)
+        groups = {}
+        for key, level in connection.execute(select(month_expression, legacy.c.level).distinct()):
+            groups.setdefault((key, self.retention_days(level)), []).append(level)
+        if not groups:
+            return
+        for (key, days), levels in groups.items():
+            table = self._ensure_table(connection, bucket_name(parse_month_key(key), days))
+            connection.execute(insert(table).from_select(
+                ['id', 'agent_id', 'level', 'message', 'created_at', 'retention_days'],
+                select(legacy.c.id, legacy.c.agent_id, legacy.c.level, legacy.c.message, legacy.c.created_at, literal(days))
+                .where(month_expression == key, legacy.c.level.in_(levels))
+            ))
+        connection.execute(legacy.delete())
+
+    def _maintain_mysql(self, now):
+        dropped = []
+        with self.engine.connect() as connection:
+            # 多个进程同时维护时只有一个执行
+            if not connection.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': MYSQL_MAINTENANCE_LOCK}).scalar():
+                return dropped
+            try:
+                names = self._mysql_partitions(connection)
+                if not names:
+                    # 未分区的表照常写入和读取，只是不能按分区删除过期日志
+                    if not self._unpartitioned_warned:
+                        self._unpartitioned_warned = True
+                        print(f'{LOG_TABLE} 表尚未分区，过期日志不会删除；请在维护窗口执行 python log_store.py partition')
+                    return dropped
+                self._add_mysql_partitions(connection, names, now)
+                for name in self._mysql_partitions(connection):
+                    match = MYSQL_PARTITION_PATTERN.match(name)
+                    if not match or match.group(2) == 'max':
+                        continue
+                    month, days = parse_month_key(match.group(2)), int(match.group(1))
+                    if not bucket_expired(month, days, now):
+                        continue
+                    if self.archive_dir:
+                        rows = connection.execute(
+                            text(f'SELECT id, agent_id, level, message, created_at FROM {LOG_TABLE} PARTITION ({name})'),
+                            execution_options={'stream_results': True})
+                        self.archived += self._write_archive(bucket_name(month, days), rows)
+                    connection.exec_driver_sql(f'ALTER TABLE {LOG_TABLE} DROP PARTITION {name}')
+                    dropped.append(name)
+            finally:
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MYSQL_MAINTENANCE_LOCK})
+                connection.commit()
+        self.dropped += len(dropped)
+        return dropped
+
+    def partition_table(self, now=None, lock_timeout=LOG_PARTITION_LOCK_TIMEOUT):
+        """把未分区的 MySQL agent_log 表改为分区表（一次性的管理操作），已分区时返回 False
+
+        持有与后台维护相同的命名锁，其他进程正在维护或转换时最多等待 lock_timeout 秒，仍未拿到锁时抛出 MaintenanceLocked。
+        """
+        if self.dialect != 'mysql':
+            raise RuntimeError('Only MySQL uses a partitioned agent_log table')
+        now = now or datetime.utcnow()
+        with self.engine.connect() as connection:
+            if not connection.execute(text('SELECT GET_LOCK(:name, :timeout)'), {'name': MYSQL_MAINTENANCE_LOCK, 'timeout': lock_timeout}).scalar():
+                raise MaintenanceLocked(MYSQL_MAINTENANCE_LOCK)
+            try:
+                # 拿到锁后再检查，避免与另一个转换命令重复执行
+                if self._mysql_partitions(connection):
+                    return False
+                self._partition_mysql_table(connection, now)
+                return True
+            finally:
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MYSQL_MAINTENANCE_LOCK})
+                connection.commit()
+
+    @staticmethod
+    def _mysql_partitions(connection):
+        """agent_log 表的分区名称（按分区顺序），未分区时返回空列表"""
+        names = connection.execute(text(
+            'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table ORDER BY PARTITION_ORDINAL_POSITION'
+        ), {'table': LOG_TABLE}).scalars().all()
+        return [name for name in names if name]
+
+    @staticmethod
+    def _mysql_partition_definition(name):
+        if name == 'p_max':
+            return f'PARTITION {name} VALUES LESS THAN (MAXVALUE, MAXVALUE)'
+        days, key = MYSQL_PARTITION_PATTERN.match(name).groups()
+        if key == 'max':
+            return f'PARTITION {name} VALUES LESS THAN ({days}, MAXVALUE)'
+        return f"PARTITION {name} VALUES LESS THAN ({days}, '{next_month(parse_month_key(key)):%Y-%m-%d}')"
+
+    def _mysql_class_partitions(self, days, months):
+        return [f'p_r{days}_{month_key(month)}' for month in months] + [f'p_r{days}_max']
+
+    def _partition_mysql_table(self, connection, now):
+        """把未分区的 agent_log 表改为按 (保留天数, 月份) 分区（重建整表，期间阻塞写入，只由 partition_table 调用）"""
+        legacy = AgentLog.__table__
+        retention_expression = case(self.retention, value=legacy.c.level, else_=self.default_retention) if self.retention else self.default_retention
+        connection.execute(legacy.update().where(legacy.c.retention_days.is_(None)).values(retention_days=retention_expression))
+        connection.commit()
+
+        # 分区表不支持外键，且主键必须包含分区列
+        foreign_keys = connection.execute(text(
+            'SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND REFERENCED_TABLE_NAME IS NOT NULL'
+        ), {'table': LOG_TABLE}).scalars().all()
+        alterations = [f'DROP FOREIGN KEY {name}' for name in foreign_keys] + [
+            f'MODIFY retention_days SMALLINT NOT NULL DEFAULT {self.default_retention}',
+            'DROP PRIMARY KEY',
+            'ADD PRIMARY KEY (id, retention_days, created_at)'
+        ]
+        connection.exec_driver_sql(f'ALTER TABLE {LOG_TABLE} ' + ', '.join(alterations))
+
+        # 已有日志从最早的月份开始分区
+        oldest = dict(connection.execute(select(legacy.c.retention_days, func.min(legacy.c.created_at)).group_by(legacy.c.retention_days)).all())
+        current = self.months_ahead(now)
+        partitions = []
+        for days in sorted(set(self.retention_classes()) | set(oldest)):
+            months = []
+            month = month_start(oldest[days]) if oldest.get(days) else current[0]
+            while month <= current[-1]:
+                months.append(month)
+                month = next_month(month)
+            partitions.extend(self._mysql_class_partitions(days, months))
+        partitions.append('p_max')
+        connection.exec_driver_sql(
+            f'ALTER TABLE {LOG_TABLE} PARTITION BY RANGE COLUMNS(retention_days, created_at) ('
+            + ', '.join(self._mysql_partition_definition(name) for name in partitions) + ')'
+        )
+
+    def _add_mysql_partitions(self, connection, names, now):
+        """为每个保留期预建当前和未来月份的分区（拆分该保留期的 max 分区）"""
+        months = self.months_ahead(now)
+        for days in self.retention_classes():
+            existing = [MYSQL_PARTITION_PATTERN.match(name) for name in names]
+            class_months = [parse_month_key(match.group(2)) for match in existing
+                            if match and int(match.group(1)) == days and match.group(2) != 'max']
+            if f'p_r{days}_max' not in names:
+                # 新增的保留期：拆分排在它后面的第一个分区
+                following = next(name for name, match in zip(names, existing) if match is None or int(match.group(1)) > days)
+                new = self._mysql_class_partitions(days, months) + [following]
+                reorganized = following
+            else:
+                last = max(class_months) if class_months else None
+                new_months = [month for month in months if last is None or month > last]
+                if not new_months:
+                    continue
+                new = self._mysql_class_partitions(days, new_months)
+                reorganized = f'p_r{days}_max'
+            connection.exec_driver_sql(
+                f'ALTER TABLE {LOG_TABLE} REORGANIZE PARTITION {reorganized} INTO ('
+                + ', '.join(self._mysql_partition_definition(name) for name in new) + ')'
+            )
+            names = self._mysql_partitions(connection)
+
+    # 后台线程
+
+    def _ensure_started(self):
+        """按需启动后台线程（fork 出的工作进程中重新启动）"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='agent-log-maintenance', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """后台线程：启动后立即维护一次，之后每隔 purge_interval 维护"""
+        while not self._stopping.is_set():
+            try:
+                dropped = self.maintain()
+                if dropped:
+                    print(f'已归档并删除过期日志分桶: {", ".join(dropped)}')
+            except Exception as e:
+                print(f'日志分桶维护失败: {e}')
+            self._stopping.wait(self.purge_interval)
+
+    def stop(self):
+        """停止后台线程"""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'retention': dict(self.retention, default=self.default_retention),
+            'archived': self.archived,
+            'dropped': self.dropped
+        }
+
+# 进程内共享的日志存储
+log_store = LogStore()
+atexit.register(log_store.stop)
+
+if __name__ == '__main__':
+    # python log_store.py            在当前进程中执行一次维护（预建分桶、归档并删除过期分桶）
+    # python log_store.py partition  把 MySQL 上未分区的 agent_log 表改为分区表（在维护窗口执行）
+    import sys
+    from app import app
+    log_store.stop()
+    if sys.argv[1:] == ['partition']:
+        if log_store.dialect != 'mysql':
+            sys.exit(f'只有 MySQL 需要把 {LOG_TABLE} 表改为分区表（SQLite 使用滚动表，由后台维护创建）')
+        try:
+            partitioned = log_store.partition_table()
+        except MaintenanceLocked:
+            sys.exit(f'其他进程正在维护 {LOG_TABLE} 表，{LOG_PARTITION_LOCK_TIMEOUT} 秒内未拿到锁，请稍后重试')
+        print(f'{LOG_TABLE} 表已改为分区表' if partitioned else f'{LOG_TABLE} 表已经是分区表')
+    else:
+        print(f'已删除的过期分桶: {log_store.maintain() or "无"}')
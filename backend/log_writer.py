@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from log_store import log_store
+
+# 日志写入配置
+LOG_ASYNC_ENABLED = os.getenv('LOG_ASYNC_ENABLED', 'true').lower() == 'true'  # 是否异步批量写入日志
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '100'))  # 每批最多写入的日志条数
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '1.0'))  # 最长刷新间隔（秒）
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # 队列容量
+LOG_QUEUE_POLICY = os.getenv('LOG_QUEUE_POLICY', 'drop')  # 队列满时的策略：drop 丢弃，block 等待
+LOG_QUEUE_BLOCK_TIMEOUT = float(os.getenv('LOG_QUEUE_BLOCK_TIMEOUT', '1.0'))  # block 策略下最长等待时间（秒），超时后丢弃
+LOG_WRITE_RETRIES = int(os.getenv('LOG_WRITE_RETRIES', '3'))  # 批量写入失败（如 SQLite database is locked）后的重试次数，仍失败时逐条写入
+LOG_WRITE_RETRY_BACKOFF = float(os.getenv('LOG_WRITE_RETRY_BACKOFF', '0.1'))  # 第一次重试前的等待时间（秒），之后每次翻倍
+
+class AgentLogWriter:
+    """智能体日志写入器：请求只把日志放入有界队列，由后台线程按数量或时间阈值批量插入"""
+
+    def __init__(self, enabled=LOG_ASYNC_ENABLED, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 queue_size=LOG_QUEUE_SIZE, policy=LOG_QUEUE_POLICY, block_timeout=LOG_QUEUE_BLOCK_TIMEOUT,
+                 retries=LOG_WRITE_RETRIES, retry_backoff=LOG_WRITE_RETRY_BACKOFF):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.dropped = 0
+        self.engine = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+
+    def init_engine(self, engine):
+        """设置写入使用的数据库引擎"""
+        self.engine = engine
+
+    def _ensure_started(self):
+        """按需启动后台线程（fork 出的工作进程中重新启动）"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid is not None and self._pid != os.getpid():
+                # 子进程不能复用父进程的连接
+                self.engine.dispose(close=False)
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='agent-log-writer', daemon=True)
+            self._thread.start()
+
+    def write(self, agent_id, level, message):
+        """记录一条智能体日志"""
+        record = {
+            'agent_id': agent_id,
+            'level': level,
+            'message': message,
+            'created_at': datetime.utcnow()
+        }
+        if not self.enabled:
+            self._insert([record])
+            return
+
+        self._ensure_started()
+        try:
+            if self.policy == 'block':
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self._count_dropped(1)
+
+    def _count_dropped(self, count):
+        # 请求线程（队列满）和后台线程都会更新丢弃数量
+        with self._lock:
+            self.dropped += count
+
+    def _insert(self, records):
+        """批量插入日志"""
+        with self.engine.begin() as connection:
+            log_store.insert(connection, records)
+
+    def _drain(self):
+        """从队列中取出最多一批日志（不等待）"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        """后台线程：凑满一批或到达刷新间隔时写入"""
+        while not self._stopping.is_set():
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+
+            # 在刷新间隔内继续收集，直到凑满一批
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and not self._stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        """写入一批日志：失败时按退避时间重试，仍失败时逐条写入，只丢弃写入失败的日志"""
+        for attempt in range(self.retries + 1):
+            try:
+                self._insert(batch)
+                return
+            except Exception as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.retry_backoff * 2 ** attempt)
+        print(f'批量写入智能体日志失败，改为逐条写入 {len(batch)} 条: {error}')
+
+        failed = 0
+        for record in batch:
+            try:
+                self._insert([record])
+            except Exception as e:
+                failed += 1
+                error = e
+        if failed:
+            self._count_dropped(failed)
+            print(f'写入智能体日志失败，丢弃 {failed} 条: {error}')
+
+    def flush(self):
+        """把队列中剩余的日志全部写入（在调用线程中执行）"""
+        while True:
+            batch = self._drain()
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def stop(self):
+        """停止后台线程并写入剩余日志"""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval * 2 + 5)
+        if self.engine is not None:
+            self.flush()
+
+# 进程内共享的日志写入器
+log_writer = AgentLogWriter()
+atexit.register(log_writer.stop)
@@ -0,0 +1,279 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+from query_profiler import query_profiler
+
+# 请求指标配置
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'  # 是否记录请求耗时分解和 /metrics 指标
+METRICS_STREAM_USAGE = os.getenv('METRICS_STREAM_USAGE', 'true').lower() == 'true'  # 流式调用是否请求上游在最后返回 usage（stream_options.include_usage）
+METRICS_PATH_PREFIXES = ('/agents', '/conversations', '/logs', '/users', '/roles')  # 记录指标的接口路径前缀
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+LABEL_NAMES = ('endpoint', 'agent', 'provider')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Prometheus 计数器"""
+
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, labels)} {_format_number(value)}')
+        return lines
+
+class Histogram:
+    """Prometheus 直方图，每组标签记录各桶计数、总和与次数"""
+
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._values = {}  # 标签 -> [各桶计数（非累计）, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(float(bound))}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_number(float(total))}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {count}')
+        return lines
+
+class MetricsRegistry:
+    """进程内指标集合，按 Prometheus 文本格式输出"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = MetricsRegistry()
+requests_total = registry.register(Counter(
+    'agent_platform_requests_total', 'Total API requests', ('endpoint', 'method', 'status', 'agent', 'provider')))
+request_duration = registry.register(Histogram(
+    'agent_platform_request_duration_seconds', 'Total API request latency', LABEL_NAMES, LATENCY_BUCKETS))
+db_queries = registry.register(Histogram(
+    'agent_platform_request_db_queries', 'Database queries per API request', LABEL_NAMES, QUERY_COUNT_BUCKETS))
+db_duration = registry.register(Histogram(
+    'agent_platform_request_db_duration_seconds', 'Database time per API request', LABEL_NAMES, LATENCY_BUCKETS))
+model_call_duration = registry.register(Histogram(
+    'agent_platform_model_call_duration_seconds', 'Upstream model call latency', LABEL_NAMES, LATENCY_BUCKETS))
+time_to_first_token = registry.register(Histogram(
+    'agent_platform_model_time_to_first_token_seconds', 'Time to first streamed token from the upstream model', LABEL_NAMES, LATENCY_BUCKETS))
+prompt_tokens = registry.register(Histogram(
+    'agent_platform_model_prompt_tokens', 'Prompt tokens per model call (upstream usage)', LABEL_NAMES, TOKEN_BUCKETS))
+completion_tokens = registry.register(Histogram(
+    'agent_platform_model_completion_tokens', 'Completion tokens per model call (upstream usage)', LABEL_NAMES, TOKEN_BUCKETS))
+
+class RequestTimings:
+    """一次请求的耗时分解，批量调用的工作线程共享同一个对象"""
+
+    __slots__ = ('endpoint', 'method', 'agent', 'provider', 'status', 'started', 'db_queries', 'db_time',
+                 'model_calls', 'model_time', 'ttft', 'profile', '_lock')
+
+    def __init__(self, endpoint, method, agent=''):
+        self.endpoint = endpoint
+        self.method = method
+        self.agent = agent
+        self.provider = ''
+        self.status = 500
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.model_calls = 0
+        self.model_time = 0.0
+        self.ttft = None
+        self.profile = query_profiler.sample()  # 被查询分析器抽中时记录每条语句
+        self._lock = threading.Lock()
+
+    @property
+    def labels(self):
+        return (self.endpoint, self.agent, self.provider)
+
+    def to_dict(self, queue_wait=0.0):
+        """耗时分解（秒），other 为扣除数据库、模型调用和排队后的应用处理时间（含序列化）"""
+        total = time.perf_counter() - self.started
+        timings = {
+            'total': round(total, 4),
+            'db': round(self.db_time, 4),
+            'db_queries': self.db_queries,
+            'model': round(self.model_time, 4),
+            'model_calls': self.model_calls,
+            'other': round(max(total - self.db_time - self.model_time - queue_wait, 0.0), 4)
+        }
+        if self.ttft is not None:
+            timings['ttft'] = round(self.ttft, 4)
+        return timings
+
+_current = ContextVar('request_timings', default=None)
+
+def current_timings():
+    """当前请求的耗时记录，不在被记录的请求中时返回 None"""
+    return _current.get()
+
+def start_request(endpoint, method, agent=''):
+    """开始记录一次请求，返回 (记录, 上下文令牌)"""
+    if not METRICS_ENABLED and not query_profiler.enabled:
+        return None, None
+    timings = RequestTimings(endpoint, method, str(agent) if agent is not None else '')
+    return timings, _current.set(timings)
+
+def timings_snapshot(queue_wait=0.0):
+    """当前请求到目前为止的耗时分解，用于 invoke 响应的 metadata.timings，不在被记录的请求中时返回 None"""
+    timings = _current.get()
+    return timings.to_dict(queue_wait) if timings is not None else None
+
+def finish_request(timings, token=None):
+    """请求结束时写入指标"""
+    if timings is None:
+        return
+    if token is not None:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # 流式响应可能在另一个上下文中结束
+            pass
+    elapsed = time.perf_counter() - timings.started
+    if timings.profile is not None:
+        query_profiler.finish(timings.endpoint, timings.method, timings.status, elapsed, timings.profile)
+    if not METRICS_ENABLED:
+        return
+    labels = timings.labels
+    requests_total.inc((timings.endpoint, timings.method, str(timings.status), timings.agent, timings.provider))
+    request_duration.observe(labels, elapsed)
+    db_queries.observe(labels, timings.db_queries)
+    db_duration.observe(labels, timings.db_time)
+
+def bind_agent(agent):
+    """把当前请求标记为属于该智能体（用于 agent、provider 标签）"""
+    timings = _current.get()
+    if timings is not None:
+        timings.agent = str(agent.id)
+        timings.provider = agent.model_provider or ''
+
+def record_model_call(elapsed, usage=None, ttft=None):
+    """记录一次模型调用的耗时、首字时间和上游 usage 中的 token 数"""
+    timings = _current.get()
+    if timings is None:
+        return
+    with timings._lock:
+        timings.model_calls += 1
+        timings.model_time += elapsed
+        if ttft is not None and timings.ttft is None:
+            timings.ttft = ttft
+    labels = timings.labels
+    model_call_duration.observe(labels, elapsed)
+    if ttft is not None:
+        time_to_first_token.observe(labels, ttft)
+    if usage:
+        if usage.get('prompt_tokens') is not None:
+            prompt_tokens.observe(labels, usage['prompt_tokens'])
+        if usage.get('completion_tokens') is not None:
+            completion_tokens.observe(labels, usage['completion_tokens'])
+
+def instrument_engine(engine):
+    """统计当前请求执行的数据库语句数和耗时（后台线程的语句不计入任何请求）"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None and _current.get() is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, '_metrics_started', None)
+        timings = _current.get()
+        if started is None or timings is None:
+            return
+        elapsed = time.perf_counter() - started
+        with timings._lock:
+            timings.db_queries += 1
+            timings.db_time += elapsed
+        if timings.profile is not None:
+            timings.profile.add(statement, parameters, elapsed, executemany)
+
+def instrumented_endpoint(path):
+    """是否记录该路径的请求指标"""
+    return (METRICS_ENABLED or query_profiler.enabled) and path.startswith(METRICS_PATH_PREFIXES)
+
+def init_app(app):
+    """为 Flask 应用注册请求计时钩子，接口标签使用路由规则（如 /agents/<int:agent_id>/invoke）"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timings():
+        if request.url_rule is None or not instrumented_endpoint(request.path):
+            return
+        agent = (request.view_args or {}).get('agent_id', '')
+        g.request_timings, g.request_timings_token = start_request(request.url_rule.rule, request.method, agent)
+
+    @app.after_request
+    def record_response_status(response):
+        timings = g.get('request_timings')
+        if timings is not None:
+            timings.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_timings(exc):
+        # 流式响应在生成结束后才执行 teardown，总耗时包含整个流
+        timings = g.pop('request_timings', None)
+        if timings is not None:
+            finish_request(timings, g.pop('request_timings_token', None))
@@ -0,0 +1,39 @@
+from sqlalchemy import inspect, text
+
+# 在已有数据库上需要补充的列：(表名, 列名, 列定义)
+# db.create_all() 只会创建缺失的表，不会修改已存在的表
+ADDED_COLUMNS = [
+    ('message', 'token_count', 'INTEGER'),
+    ('agent', 'max_concurrency', 'INTEGER'),
+    ('agent', 'completion_cache_enabled', 'BOOLEAN NOT NULL DEFAULT 0'),
+    ('agent', 'config_version', 'INTEGER NOT NULL DEFAULT 0'),
+    ('agent', 'warmup_status', "VARCHAR(20) NOT NULL DEFAULT 'cold'"),
+    ('agent', 'warmup_error', 'TEXT'),
+    ('agent', 'warmed_at', 'DATETIME'),
+    ('agent_log', 'retention_days', 'SMALLINT'),
+]
+
+def upgrade_schema(engine, metadata):
+    """为已有数据库补充新版本增加的列和模型中声明的索引"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table, column, definition in ADDED_COLUMNS:
+            if not inspector.has_table(table):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table)}
+            if column not in existing:
+                connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {definition}'))
+
+        # 创建缺失的索引（大表上建索引可能耗时较长，建议在维护窗口执行 python migrations.py）
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+
+if __name__ == '__main__':
+    # 导入 app 时会执行 create_all 和 upgrade_schema
+    from app import app
+    print(f'数据库结构已更新: {app.config["SQLALCHEMY_DATABASE_URI"].split("@")[-1]}')
@@ -0,0 +1,169 @@
+import os
+import asyncio
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 模型调用配置
+MODEL_POOL_SIZE = int(os.getenv('MODEL_POOL_SIZE', '10'))  # 每个模型地址的连接池大小
+MODEL_CONNECT_TIMEOUT = float(os.getenv('MODEL_CONNECT_TIMEOUT', '5'))  # 连接超时（秒）
+MODEL_READ_TIMEOUT = float(os.getenv('MODEL_READ_TIMEOUT', '120'))  # 读取超时（秒）
+MODEL_MAX_RETRIES = int(os.getenv('MODEL_MAX_RETRIES', '2'))  # 最大重试次数
+MODEL_RETRY_BACKOFF = float(os.getenv('MODEL_RETRY_BACKOFF', '0.5'))  # 重试退避因子（秒）
+
+# 需要重试的上游状态码
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def build_headers(agent):
+    """构建模型API请求头"""
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    if agent.model_provider == 'openai' and agent.model_api_key:
+        headers['Authorization'] = f'Bearer {agent.model_api_key}'
+    return headers
+
+class ModelClient:
+    """模型服务客户端，每个模型API地址共享一个长连接池"""
+
+    def __init__(self, pool_size=MODEL_POOL_SIZE, connect_timeout=MODEL_CONNECT_TIMEOUT,
+                 read_timeout=MODEL_READ_TIMEOUT, max_retries=MODEL_MAX_RETRIES,
+                 backoff_factor=MODEL_RETRY_BACKOFF):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        """创建带连接池和重试策略的会话"""
+        # 生成结果不是幂等的，读取超时不重试，只重试连接失败和限流/服务端错误
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=self.max_retries,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(['GET', 'POST']),
+            backoff_factor=self.backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get_session(self, base_url):
+        """获取指定模型API地址的会话"""
+        key = base_url.rstrip('/')
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._create_session()
+                    self._sessions[key] = session
+        return session
+
+    def chat_completions(self, agent, request_data, stream=False):
+        """调用 chat/completions 接口，agent 为 AgentConfig，返回上游响应（状态码异常时抛出 HTTPError）"""
+        response = self.get_session(agent.base_url).post(
+            f'{agent.base_url}/chat/completions',
+            json=request_data,
+            headers=agent.headers,
+            timeout=self.timeout,
+            stream=stream
+        )
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # 流式响应需要显式关闭，才能把连接归还到连接池
+            response.close()
+            raise
+        return response
+
+    def close(self):
+        """关闭所有连接池"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+class AsyncModelClient:
+    """异步模型服务客户端（ASGI 服务使用），每个模型API地址共享一个 httpx 连接池"""
+
+    def __init__(self, pool_size=MODEL_POOL_SIZE, connect_timeout=MODEL_CONNECT_TIMEOUT,
+                 read_timeout=MODEL_READ_TIMEOUT, max_retries=MODEL_MAX_RETRIES,
+                 backoff_factor=MODEL_RETRY_BACKOFF):
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._clients = {}
+
+    def get_client(self, base_url):
+        """获取指定模型API地址的异步客户端"""
+        key = base_url.rstrip('/')
+        client = self._clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                # 连接失败由传输层重试，限流/服务端错误在 chat_completions 中按退避策略重试
+                transport=httpx.AsyncHTTPTransport(retries=self.max_retries)
+            )
+            self._clients[key] = client
+        return client
+
+    def _retry_delay(self, response, attempt):
+        """计算重试等待时间，优先使用上游的 Retry-After"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_factor * (2 ** attempt)
+
+    async def chat_completions(self, agent, request_data, stream=False):
+        """调用 chat/completions 接口，agent 为 AgentConfig，返回上游响应（状态码异常时抛出 HTTPStatusError）
+
+        stream=True 时调用方负责在读取完成后调用 response.aclose()。
+        """
+        client = self.get_client(agent.base_url)
+        attempt = 0
+        while True:
+            request = client.build_request(
+                'POST',
+                f'{agent.base_url}/chat/completions',
+                json=request_data,
+                headers=agent.headers
+            )
+            response = await client.send(request, stream=stream)
+            if response.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                await response.aclose()
+                await asyncio.sleep(self._retry_delay(response, attempt))
+                attempt += 1
+                continue
+
+            if response.is_error:
+                if stream:
+                    await response.aread()
+                    await response.aclose()
+                response.raise_for_status()
+            return response
+
+    async def aclose(self):
+        """关闭所有连接池"""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+# 进程内共享的模型客户端
+model_client = ModelClient()
+async_model_client = AsyncModelClient()
@@ -0,0 +1,260 @@
+import os
+import time
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from model_client import MODEL_POOL_SIZE
+
+# 模型调用调度配置
+MODEL_PROVIDER_CONCURRENCY = int(os.getenv('MODEL_PROVIDER_CONCURRENCY', str(MODEL_POOL_SIZE)))  # 每个模型API地址最多同时进行的调用数，0 表示不限制
+MODEL_AGENT_CONCURRENCY = int(os.getenv('MODEL_AGENT_CONCURRENCY', '0'))  # 每个智能体默认最多同时进行的调用数（可被 Agent.max_concurrency 覆盖），0 表示不限制
+MODEL_QUEUE_SIZE = int(os.getenv('MODEL_QUEUE_SIZE', '100'))  # 每个地址/智能体最多排队等待的调用数
+MODEL_QUEUE_TIMEOUT = float(os.getenv('MODEL_QUEUE_TIMEOUT', '30'))  # 排队最长等待时间（秒）
+AGENT_REQUIRE_RUNNING = os.getenv('AGENT_REQUIRE_RUNNING', 'true').lower() == 'true'  # 是否只允许调用运行中的智能体
+
+class ModelCallRejected(Exception):
+    """模型调用被调度器拒绝"""
+    status_code = 503
+
+class AgentNotRunning(ModelCallRejected):
+    """智能体不是运行状态"""
+    status_code = 409
+
+class ModelQueueFull(ModelCallRejected):
+    """等待队列已满"""
+    status_code = 429
+
+class ModelQueueTimeout(ModelCallRejected):
+    """排队等待超时"""
+    status_code = 503
+
+class _Gate:
+    """一个模型API地址或智能体的并发名额和先进先出等待队列"""
+
+    __slots__ = ('limit', 'in_flight', 'waiters', 'admitted', 'rejected', 'timed_out', 'total_wait', 'max_wait')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, waited):
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def to_dict(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'queue_depth': len(self.waiters),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait': round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+            'max_wait': round(self.max_wait, 3)
+        }
+
+class _BaseScheduler(ABC):
+    """按模型API地址和智能体限制同时进行的模型调用，超出名额的调用按到达顺序排队"""
+
+    def __init__(self, provider_limit=MODEL_PROVIDER_CONCURRENCY, agent_limit=MODEL_AGENT_CONCURRENCY,
+                 queue_size=MODEL_QUEUE_SIZE, queue_timeout=MODEL_QUEUE_TIMEOUT, require_running=AGENT_REQUIRE_RUNNING):
+        self.provider_limit = provider_limit
+        self.agent_limit = agent_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.require_running = require_running
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    def _gate_keys(self, agent):
+        """检查智能体状态，返回本次调用需要占用的 (名额键, 并发上限)"""
+        if self.require_running and agent.status != 'running':
+            raise AgentNotRunning(f'Agent "{agent.name}" is not running (status: {agent.status})')
+        agent_limit = self.agent_limit if agent.max_concurrency is None else agent.max_concurrency
+        # 先占智能体名额再占地址名额，所有调用顺序一致，不会互相等待
+        return [
+            (('agent', agent.id), agent_limit),
+            (('provider', agent.base_url), self.provider_limit)
+        ]
+
+    def _try_enter(self, key, limit, waiter_factory):
+        """在锁内尝试占用名额，成功返回 (gate, None)，需要排队时返回 (gate, waiter)"""
+        gate = self._gates.get(key)
+        if gate is None:
+            gate = self._gates[key] = _Gate(limit)
+        gate.limit = limit
+        if gate.limit <= 0 or (gate.in_flight < gate.limit and not gate.waiters):
+            gate.in_flight += 1
+            gate.record_wait(0.0)
+            return gate, None
+        if len(gate.waiters) >= self.queue_size:
+            gate.rejected += 1
+            raise ModelQueueFull(f'Too many queued model calls for {key[0]} "{key[1]}"')
+        waiter = waiter_factory()
+        gate.waiters.append(waiter)
+        return gate, waiter
+
+    def _leave(self, gate):
+        """释放名额：有排队的调用时直接转交给队首，否则减少占用数"""
+        with self._lock:
+            while gate.waiters:
+                if self._wake(gate.waiters.popleft()):
+                    return
+            gate.in_flight -= 1
+
+    @abstractmethod
+    def _wake(self, waiter):
+        """把名额转交给排队的调用，调用已超时或取消时返回 False"""
+
+    def stats(self):
+        """各模型API地址和智能体的占用数、队列深度及等待时间"""
+        with self._lock:
+            providers = {key[1]: gate.to_dict() for key, gate in self._gates.items() if key[0] == 'provider'}
+            agents = {str(key[1]): gate.to_dict() for key, gate in self._gates.items() if key[0] == 'agent'}
+        return {'providers': providers, 'agents': agents}
+
+class ModelCallSlot:
+    """一轮对话的模型调用名额，with 代码块结束时释放，释放后可再次占用（如先生成摘要再请求回复）
+
+    wait_time 为累计排队时间（秒）。
+    """
+
+    def __init__(self, scheduler, gate_keys):
+        self.scheduler = scheduler
+        self.gate_keys = gate_keys
+        self.wait_time = 0.0
+        self._held = []
+        self._detached = False
+
+    def acquire(self):
+        """按顺序占用所有名额，排队总时长不超过 queue_timeout"""
+        start = time.monotonic()
+        deadline = start + self.scheduler.queue_timeout
+        try:
+            for key, limit in self.gate_keys:
+                self._held.append(self.scheduler._enter(key, limit, deadline))
+        except ModelCallRejected:
+            self.release()
+            raise
+        self.wait_time += time.monotonic() - start
+        return self
+
+    def release(self):
+        """释放已占用的名额（可重复调用）"""
+        held, self._held = self._held, []
+        for gate in reversed(held):
+            self.scheduler._leave(gate)
+
+    def detach(self):
+        """名额改由调用方稍后释放（如流式响应结束时），返回释放函数"""
+        self._detached = True
+        return self.release
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._detached:
+            self.release()
+
+class ModelScheduler(_BaseScheduler):
+    """多线程（WSGI）服务使用的模型调用调度器"""
+
+    def slot(self, agent):
+        """检查智能体状态并创建调用名额（尚未占用），智能体不是运行状态时抛出 AgentNotRunning"""
+        return ModelCallSlot(self, self._gate_keys(agent))
+
+    def _enter(self, key, limit, deadline):
+        start = time.monotonic()
+        with self._lock:
+            gate, waiter = self._try_enter(key, limit, threading.Event)
+        if waiter is None:
+            return gate
+
+        woken = waiter.wait(max(deadline - time.monotonic(), 0))
+        with self._lock:
+            # 超时的同时名额可能刚好被转交过来
+            if not woken and not waiter.is_set():
+                gate.waiters.remove(waiter)
+                gate.timed_out += 1
+                raise ModelQueueTimeout(f'Timed out waiting for {key[0]} "{key[1]}"')
+            gate.record_wait(time.monotonic() - start)
+        return gate
+
+    def _wake(self, waiter):
+        waiter.set()
+        return True
+
+class AsyncModelCallSlot(ModelCallSlot):
+    """异步服务中一轮对话的模型调用名额，async with 代码块结束时释放"""
+
+    async def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.scheduler.queue_timeout
+        try:
+            for key, limit in self.gate_keys:
+                self._held.append(await self.scheduler._enter(key, limit, deadline))
+        except (ModelCallRejected, asyncio.CancelledError):
+            self.release()
+            raise
+        self.wait_time += time.monotonic() - start
+        return self
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self._detached:
+            self.release()
+
+class AsyncModelScheduler(_BaseScheduler):
+    """异步（ASGI）服务使用的模型调用调度器，只在事件循环线程中使用"""
+
+    def slot(self, agent):
+        """检查智能体状态并创建调用名额（尚未占用），智能体不是运行状态时抛出 AgentNotRunning"""
+        return AsyncModelCallSlot(self, self._gate_keys(agent))
+
+    async def _enter(self, key, limit, deadline):
+        start = time.monotonic()
+        with self._lock:
+            gate, waiter = self._try_enter(key, limit, asyncio.get_running_loop().create_future)
+        if waiter is None:
+            return gate
+
+        try:
+            await asyncio.wait_for(waiter, max(deadline - time.monotonic(), 0))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if waiter in gate.waiters:
+                    gate.waiters.remove(waiter)
+                handed_over = waiter.done() and not waiter.cancelled()
+            if handed_over:
+                # 名额已转交但调用被取消，归还名额
+                self._leave(gate)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            with self._lock:
+                gate.timed_out += 1
+            raise ModelQueueTimeout(f'Timed out waiting for {key[0]} "{key[1]}"')
+        with self._lock:
+            gate.record_wait(time.monotonic() - start)
+        return gate
+
+    def _wake(self, waiter):
+        # 已取消（超时或请求中断）的等待者跳过
+        if waiter.done():
+            return False
+        waiter.set_result(None)
+        return True
+
+# 进程内共享的模型调用调度器
+model_scheduler = ModelScheduler()
+async_model_scheduler = AsyncModelScheduler()
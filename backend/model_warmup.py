@@ -0,0 +1,227 @@
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import event, inspect, select, update
+from sqlalchemy.orm import Session, object_session
+from models import Agent
+from agent_config import AgentConfig
+from model_client import model_client
+
+# 模型预热配置
+MODEL_WARMUP_ENABLED = os.getenv('MODEL_WARMUP_ENABLED', 'true').lower() == 'true'  # 智能体切换为 running 时是否在后台预热模型
+MODEL_KEEP_ALIVE = os.getenv('MODEL_KEEP_ALIVE', '-1')  # 运行中的智能体在 Ollama 中的 keep_alive（秒数或 30m 这样的时长，负数表示一直驻留）
+MODEL_KEEPALIVE_INTERVAL = float(os.getenv('MODEL_KEEPALIVE_INTERVAL', '240'))  # 重新发送 keep_alive 的间隔（秒），应小于 Ollama 默认的 5 分钟过期时间，0 表示不刷新
+MODEL_WARMUP_TIMEOUT = float(os.getenv('MODEL_WARMUP_TIMEOUT', '300'))  # 加载模型的最长等待时间（秒）
+
+# 预热状态：cold 未加载（或已释放），warming 加载中，ready 已加载，failed 加载失败（原因见 warmup_error）
+WARMUP_STATUSES = ('cold', 'warming', 'ready', 'failed')
+
+def parse_keep_alive(value):
+    """Ollama 的 keep_alive 可以是秒数或时长字符串"""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def ollama_root(base_url):
+    """Ollama 原生接口地址（去掉 OpenAI 兼容接口的 /v1 后缀）"""
+    return base_url[:-3] if base_url.endswith('/v1') else base_url
+
+class ModelWarmup:
+    """模型预热和驻留：智能体切换为 running 后在后台加载模型，运行期间定期刷新 keep_alive，暂停或停止时释放
+
+    Ollama 通过原生 /api/generate 接口加载（不带 prompt）和释放（keep_alive=0）模型；
+    其他提供商只预先建立到模型地址的连接（GET /models）。
+    """
+
+    def __init__(self, enabled=MODEL_WARMUP_ENABLED, keep_alive=MODEL_KEEP_ALIVE,
+                 keepalive_interval=MODEL_KEEPALIVE_INTERVAL, timeout=MODEL_WARMUP_TIMEOUT):
+        self.enabled = enabled
+        self.keep_alive = parse_keep_alive(keep_alive)
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+        self.engine = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+
+    def init_engine(self, engine):
+        """设置记录预热状态使用的数据库引擎，并启动后台线程（启动后先预热所有运行中的智能体）"""
+        self.engine = engine
+        if self.enabled:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        """按需启动后台线程（fork 出的工作进程中重新启动）"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='model-warmup', daemon=True)
+            self._thread.start()
+
+    def schedule(self, action, config):
+        """排队一次预热（warm）或释放（release），config 为 AgentConfig"""
+        if not self.enabled or self.engine is None:
+            return
+        self._ensure_started()
+        self._queue.put((action, config))
+
+    def _run(self):
+        """后台线程：处理排队的预热和释放，每隔 keepalive_interval 刷新运行中智能体的模型"""
+        # 启动后立即刷新一次，预热进程启动前已处于 running 的智能体
+        next_refresh = time.monotonic()
+        while not self._stopping.is_set():
+            timeout = max(next_refresh - time.monotonic(), 0) if next_refresh is not None else None
+            try:
+                action, config = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f'刷新模型驻留失败: {e}')
+                next_refresh = time.monotonic() + self.keepalive_interval if self.keepalive_interval > 0 else None
+                continue
+            if action is None:
+                break
+            try:
+                if action == 'warm':
+                    self.warm(config)
+                else:
+                    self.release(config)
+            except Exception as e:
+                print(f'模型预热任务失败（智能体 {config.id}）: {e}')
+
+    def _load(self, config, keep_alive):
+        """加载（或以 keep_alive=0 释放）模型"""
+        if config.model_provider == 'ollama':
+            response = model_client.get_session(config.base_url).post(
+                f'{ollama_root(config.base_url)}/api/generate',
+                json={'model': config.model_name, 'keep_alive': keep_alive},
+                timeout=(model_client.timeout[0], self.timeout)
+            )
+        else:
+            response = model_client.get_session(config.base_url).get(
+                f'{config.base_url}/models',
+                headers=config.headers,
+                timeout=model_client.timeout
+            )
+        response.raise_for_status()
+
+    def warm(self, config):
+        """加载模型并记录预热状态"""
+        try:
+            self._load(config, self.keep_alive)
+        except Exception as e:
+            self._set_state(config.id, 'failed', str(e))
+            return False
+        self._set_state(config.id, 'ready')
+        return True
+
+    def release(self, config):
+        """释放模型（仍有其他运行中的智能体使用同一个模型时保留）"""
+        if config.model_provider != 'ollama':
+            return
+        with self.engine.connect() as connection:
+            shared = connection.execute(select(Agent.id).where(
+                Agent.id != config.id,
+                Agent.status == 'running',
+                Agent.model_api_url.in_([config.base_url, config.base_url + '/']),
+                Agent.model_name == config.model_name
+            ).limit(1)).first()
+        if shared is None:
+            self._load(config, 0)
+
+    def refresh(self):
+        """重新发送运行中智能体的 keep_alive（同一个模型只发送一次），被驱逐的模型会重新加载"""
+        with self.engine.connect() as connection:
+            agents = [AgentConfig(row) for row in connection.execute(select(Agent.__table__).where(Agent.status == 'running'))]
+        loaded = {}
+        for config in agents:
+            key = (config.model_provider, config.base_url, config.model_name)
+            if key not in loaded:
+                loaded[key] = self.warm(config)
+            else:
+                self._set_state(config.id, 'ready' if loaded[key] else 'failed')
+
+    def _set_state(self, agent_id, status, error=None):
+        """记录预热状态（不修改 updated_at 和配置版本号，智能体已不在运行时不记录）"""
+        values = {'warmup_status': status, 'warmup_error': error, 'updated_at': Agent.updated_at}
+        if status == 'ready':
+            values['warmed_at'] = datetime.utcnow()
+        with self.engine.begin() as connection:
+            connection.execute(
+                update(Agent.__table__)
+                .where(Agent.id == agent_id, Agent.status == 'running')
+                .values(**values)
+            )
+
+    def stop(self):
+        """停止后台线程"""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put((None, None))
+            self._thread.join(timeout=5)
+
+# 进程内共享的模型预热器
+model_warmup = ModelWarmup()
+atexit.register(model_warmup.stop)
+
+def _pending(target):
+    session = object_session(target)
+    return session.info.setdefault('model_warmup', []) if session is not None else None
+
+@event.listens_for(Agent, 'before_insert')
+@event.listens_for(Agent, 'before_update')
+def track_agent_status(mapper, connection, target):
+    """智能体切换为 running 时标记为预热中，离开 running 时标记为未加载，提交后再排队预热或释放"""
+    if not model_warmup.enabled:
+        return
+    history = inspect(target).attrs.status.history
+    if not history.added:
+        return
+    old_status = history.deleted[0] if history.deleted else None
+    if target.status == 'running' and old_status != 'running':
+        target.warmup_status = 'warming'
+        target.warmup_error = None
+        action = 'warm'
+    elif old_status == 'running' and target.status != 'running':
+        target.warmup_status = 'cold'
+        action = 'release'
+    else:
+        return
+    pending = _pending(target)
+    if pending is not None:
+        pending.append((action, target))
+
+@event.listens_for(Agent, 'before_delete')
+def release_deleted_agent(mapper, connection, target):
+    """删除运行中的智能体时释放模型"""
+    if model_warmup.enabled and target.status == 'running':
+        pending = _pending(target)
+        if pending is not None:
+            pending.append(('release', target))
+
+@event.listens_for(Session, 'after_flush')
+def snapshot_pending_warmups(session, flush_context):
+    """flush 后（配置版本号已更新）生成配置快照，提交后排队"""
+    pending = session.info.get('model_warmup')
+    if pending:
+        session.info['model_warmup'] = [(action, AgentConfig(target) if isinstance(target, Agent) else target) for action, target in pending]
+
+@event.listens_for(Session, 'after_commit')
+def schedule_pending_warmups(session):
+    for action, config in session.info.pop('model_warmup', None) or ():
+        model_warmup.schedule(action, config)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_pending_warmups(session):
+    session.info.pop('model_warmup', None)
@@ -1,9 +1,10 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from password_hasher import password_hasher
+from db_replica import RoutingSession
 
-# 初始化 SQLAlchemy 实例
-db = SQLAlchemy()
+# 初始化 SQLAlchemy 实例（只读接口的查询可路由到副本，见 db_replica.py）
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 # 用户角色关联表
 user_roles = db.Table('user_roles',
@@ -13,6 +14,10 @@ user_roles = db.Table('user_roles',
 
 class User(db.Model):
     """用户数据模型"""
+    __table_args__ = (
+        db.Index('ix_user_created_at', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), nullable=False, unique=True)
     email = db.Column(db.String(100), nullable=False, unique=True)
@@ -24,20 +29,21 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # 建立与角色的多对多关系
-    roles = db.relationship('Role', secondary=user_roles, lazy='subquery',
+    # 建立与角色的多对多关系（按页用一条 IN 查询批量加载角色）
+    roles = db.relationship('Role', secondary=user_roles, lazy='selectin',
         backref=db.backref('users', lazy=True))
     
     def set_password(self, password):
-        """设置密码哈希"""
-        self.password_hash = generate_password_hash(password)
+        """设置密码哈希（在进程池中计算，见 password_hasher.py）"""
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        """验证密码"""
-        return check_password_hash(self.password_hash, password)
+        """验证密码（在进程池中计算）"""
+        return password_hasher.check(self.password_hash, password)
     
     def to_dict(self):
         """将模型转换为字典格式"""
+        roles = self.roles
         return {
             'id': self.id,
             'username': self.username,
@@ -46,8 +52,8 @@ class User(db.Model):
             'phone': self.phone,
             'is_active': self.is_active,
             'is_admin': self.is_admin,
-            'role_ids': [role.id for role in self.roles],
-            'role_names': [role.name for role in self.roles],
+            'role_ids': [role.id for role in roles],
+            'role_names': [role.name for role in roles],
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -60,19 +66,41 @@ class Role(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    def to_dict(self):
-        """将模型转换为字典格式"""
+    @staticmethod
+    def count_users(role_ids):
+        """按角色分组统计用户数量，返回 {role_id: user_count}"""
+        if not role_ids:
+            return {}
+        rows = db.session.query(user_roles.c.role_id, db.func.count()).filter(
+            user_roles.c.role_id.in_(role_ids)
+        ).group_by(user_roles.c.role_id).all()
+        return dict(rows)
+    
+    def has_users(self):
+        """角色下是否有用户（不加载用户对象）"""
+        return db.session.query(
+            db.exists().where(user_roles.c.role_id == self.id)
+        ).scalar()
+    
+    def to_dict(self, user_count=None):
+        """将模型转换为字典格式，user_count 可由列表接口批量统计后传入"""
+        if user_count is None:
+            user_count = Role.count_users([self.id]).get(self.id, 0)
         return {
             'id': self.id,
             'name': self.name,
             'description': self.description,
-            'user_count': len(self.users),
+            'user_count': user_count,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
 
 class Agent(db.Model):
     """智能体数据模型"""
+    __table_args__ = (
+        db.Index('ix_agent_created_at', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text, nullable=True)
@@ -92,12 +120,18 @@ class Agent(db.Model):
     model_stop_sequences = db.Column(db.Text, nullable=True)  # 停止序列（用逗号分隔）
     model_context_window = db.Column(db.Integer, nullable=False, default=4096)  # 上下文窗口大小
     model_system_prompt = db.Column(db.Text, nullable=True)  # 系统提示词
+    max_concurrency = db.Column(db.Integer, nullable=True)  # 最多同时进行的模型调用数（为空时使用 MODEL_AGENT_CONCURRENCY，0 表示不限制）
+    completion_cache_enabled = db.Column(db.Boolean, nullable=False, default=False)  # temperature 为 0 时是否缓存模型补全结果
+    config_version = db.Column(db.Integer, nullable=False, default=0)  # 配置版本号，每次修改时递增（用于各进程的配置缓存失效）
+    warmup_status = db.Column(db.String(20), nullable=False, default='cold')  # 模型预热状态：cold, warming, ready, failed
+    warmup_error = db.Column(db.Text, nullable=True)  # 最近一次预热失败的原因
+    warmed_at = db.Column(db.DateTime, nullable=True)  # 最近一次成功加载或刷新模型的时间
     
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # 建立与日志的一对多关系
-    logs = db.relationship('AgentLog', backref='agent', lazy=True)
+    # 建立与日志的一对多关系（删除智能体时不加载日志，日志按保留期清理）
+    logs = db.relationship('AgentLog', backref='agent', lazy=True, passive_deletes='all')
     # 建立与会话的一对多关系
     conversations = db.relationship('Conversation', backref='agent', lazy=True)
     
@@ -121,12 +155,21 @@ class Agent(db.Model):
             'model_stop_sequences': self.model_stop_sequences.split(',') if self.model_stop_sequences else [],
             'model_context_window': self.model_context_window,
             'model_system_prompt': self.model_system_prompt,
+            'max_concurrency': self.max_concurrency,
+            'completion_cache_enabled': self.completion_cache_enabled,
+            'warmup_status': self.warmup_status,
+            'warmup_error': self.warmup_error,
+            'warmed_at': self.warmed_at.isoformat() if self.warmed_at else None,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
 
 class Conversation(db.Model):
     """会话数据模型"""
+    __table_args__ = (
+        db.Index('ix_conversation_agent_id', 'agent_id'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'), nullable=False)
     conversation_id = db.Column(db.String(100), nullable=False, unique=True)
@@ -148,10 +191,16 @@ class Conversation(db.Model):
 
 class Message(db.Model):
     """消息数据模型"""
+    __table_args__ = (
+        # 会话历史按时间排序查询
+        db.Index('ix_message_conversation_created', 'conversation_id', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # user, assistant, system
     content = db.Column(db.Text, nullable=False)
+    token_count = db.Column(db.Integer, nullable=True)  # 估算的 token 数（用于上下文截断）
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     
     def to_dict(self):
@@ -166,11 +215,18 @@ class Message(db.Model):
 
 class AgentLog(db.Model):
     """智能体日志数据模型"""
+    __table_args__ = (
+        # 单个智能体日志和全部日志都按时间倒序分页
+        db.Index('ix_agent_log_agent_created', 'agent_id', 'created_at'),
+        db.Index('ix_agent_log_created_at', 'created_at'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('agent.id'), nullable=False)
     level = db.Column(db.String(20), nullable=False)  # info, warning, error, debug
     message = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    retention_days = db.Column(db.SmallInteger, nullable=True)  # 保留天数（按级别配置，见 log_store.py），0 表示永久保留
     
     def to_dict(self):
         """将模型转换为字典格式"""
@@ -0,0 +1,83 @@
+import os
+import json
+import base64
+from datetime import datetime
+from flask import request
+from sqlalchemy import and_, or_
+from serializers import CompiledSerializer
+
+# 分页配置
+PAGINATION_MAX_PER_PAGE = int(os.getenv('PAGINATION_MAX_PER_PAGE', '100'))  # 列表接口每页最多返回的条数，per_page 超出时按该值返回
+
+class InvalidCursor(ValueError):
+    """分页游标格式错误"""
+
+def encode_cursor(created_at, item_id):
+    """将 (created_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([created_at.isoformat(), item_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """解析分页游标，返回 (created_at, id)"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, item_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), int(item_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+def page_size(default_per_page):
+    """读取请求中的 per_page 参数，限制在 1 到 PAGINATION_MAX_PER_PAGE 之间"""
+    per_page = request.args.get('per_page', default_per_page, type=int)
+    return min(max(per_page, 1), PAGINATION_MAX_PER_PAGE)
+
+def keyset_page(query, model, cursor, per_page):
+    """按 (created_at, id) 倒序的游标分页，不执行 COUNT 和 OFFSET，返回 (当前页数据, 下一页游标)"""
+    if cursor:
+        created_at, item_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            model.created_at < created_at,
+            and_(model.created_at == created_at, model.id < item_id)
+        ))
+
+    # 多取一条用于判断是否还有下一页
+    items = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    if len(items) <= per_page:
+        return items, None
+    items = items[:per_page]
+    return items, encode_cursor(items[-1].created_at, items[-1].id)
+
+def paginate_query(query, model, key, serialize, default_per_page=10):
+    """按请求参数分页并构建响应
+
+    默认使用 page/per_page 页码分页；请求中带 cursor 参数（首页传空值）时改用游标分页，
+    此时只在 with_total=true 时返回总数。serialize 为逐条转换的函数，或 serializers 中编译的序列化器
+    （只查询需要的列，整页一起转换）。
+    """
+    per_page = page_size(default_per_page)
+    if isinstance(serialize, CompiledSerializer):
+        query = query.with_entities(*serialize.columns)
+        serialize_page = serialize
+    else:
+        serialize_page = lambda items: [serialize(item) for item in items]
+
+    if 'cursor' in request.args:
+        items, next_cursor = keyset_page(query, model, request.args.get('cursor'), per_page)
+        response = {
+            key: serialize_page(items),
+            'next_cursor': next_cursor,
+            'per_page': per_page
+        }
+        if request.args.get('with_total', 'false').lower() == 'true':
+            response['total'] = query.order_by(None).count()
+        return response
+
+    page = request.args.get('page', 1, type=int)
+    pagination = query.order_by(model.created_at.desc(), model.id.desc()).paginate(page=page, per_page=per_page)
+    return {
+        key: serialize_page(pagination.items),
+        'total': pagination.total,
+        'pages': pagination.pages,
+        'current_page': pagination.page,
+        'per_page': pagination.per_page
+    }
@@ -0,0 +1,103 @@
+import os
+import atexit
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# 密码哈希配置
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '') or os.cpu_count() or 1)  # 计算密码哈希的进程数，默认为CPU核数，0 表示在请求线程中计算
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', '')  # 密码哈希算法（如 scrypt、pbkdf2:sha256:600000），为空时使用 Werkzeug 默认值
+# 进程池在已有后台线程（日志写入、模型预热等）的进程中按需创建，fork 多线程进程可能使子进程死锁，因此默认使用 forkserver
+PASSWORD_HASH_START_METHOD = os.getenv('PASSWORD_HASH_START_METHOD', 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')  # 进程池的启动方式
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '30'))  # 等待单个密码哈希的最长时间（秒）
+
+def _hash(password, method):
+    if method:
+        return generate_password_hash(password, method=method)
+    return generate_password_hash(password)
+
+def _check(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+class PasswordHasher:
+    """在进程池中计算和校验密码哈希
+
+    密码哈希有意设计得很耗 CPU，在请求线程中计算会占住 GIL，拖慢同一进程中的其他请求；
+    放到进程池后请求线程只等待结果。进程池在首次使用时创建（fork 出的工作进程中重新创建）。
+    """
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, method=PASSWORD_HASH_METHOD,
+                 start_method=PASSWORD_HASH_START_METHOD, timeout=PASSWORD_HASH_TIMEOUT):
+        self.workers = workers
+        self.method = method
+        self.start_method = start_method
+        self.timeout = timeout
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        """按需创建进程池，workers 为 0 时返回 None"""
+        if self.workers <= 0:
+            return None
+        if self._executor is not None and self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method)
+                )
+            return self._executor
+
+    def _reset(self, executor):
+        """进程池中的进程异常退出后丢弃进程池，下次使用时重新创建"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, func, *args):
+        executor = self._get_executor()
+        if executor is None:
+            return func(*args)
+        try:
+            return executor.submit(func, *args).result(timeout=self.timeout)
+        except BrokenProcessPool:
+            self._reset(executor)
+            return func(*args)
+
+    def hash(self, password):
+        """计算单个密码的哈希"""
+        return self._call(_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        """校验密码"""
+        return self._call(_check, pwhash, password)
+
+    def hash_many(self, passwords):
+        """批量计算密码哈希，结果与 passwords 顺序相同"""
+        passwords = list(passwords)
+        executor = self._get_executor()
+        if executor is None or len(passwords) <= 1:
+            return [self.hash(password) for password in passwords]
+        # 每个进程分到几块任务，减少进程间通信的次数
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        try:
+            return list(executor.map(_hash, passwords, [self.method] * len(passwords), chunksize=chunksize))
+        except BrokenProcessPool:
+            self._reset(executor)
+            return [_hash(password, self.method) for password in passwords]
+
+    def stop(self):
+        """关闭进程池"""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+# 进程内共享的密码哈希进程池
+password_hasher = PasswordHasher()
+atexit.register(password_hasher.stop)
@@ -0,0 +1,268 @@
+import os
+import heapq
+import queue
+import random
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+# 查询分析配置（默认关闭，按比例抽样请求记录每条语句）
+QUERY_PROFILER_ENABLED = os.getenv('QUERY_PROFILER_ENABLED', 'false').lower() == 'true'  # 是否开启查询分析
+QUERY_PROFILER_SAMPLE_RATE = float(os.getenv('QUERY_PROFILER_SAMPLE_RATE', '0.1'))  # 抽样比例（0-1），未抽中的请求只多一次随机数判断
+QUERY_PROFILER_SLOW_REQUEST_MS = float(os.getenv('QUERY_PROFILER_SLOW_REQUEST_MS', '500'))  # 请求总耗时超过该值（毫秒）时写入慢请求日志
+QUERY_PROFILER_SLOW_QUERY_COUNT = int(os.getenv('QUERY_PROFILER_SLOW_QUERY_COUNT', '50'))  # 单个请求语句数超过该值时也写入慢请求日志（发现 N+1），0 表示不检查
+QUERY_PROFILER_TOP_STATEMENTS = int(os.getenv('QUERY_PROFILER_TOP_STATEMENTS', '5'))  # 每个请求保留的最慢语句条数
+QUERY_PROFILER_MAX_STATEMENTS = int(os.getenv('QUERY_PROFILER_MAX_STATEMENTS', '500'))  # 汇总统计最多保留的不同语句数
+QUERY_PROFILER_EXPLAIN = os.getenv('QUERY_PROFILER_EXPLAIN', 'true').lower() == 'true'  # 慢请求日志是否附带最慢 SELECT 语句的执行计划
+QUERY_PROFILER_LOG_PARAMS = os.getenv('QUERY_PROFILER_LOG_PARAMS', 'false').lower() == 'true'  # 慢请求日志是否记录语句参数（参数包含密码哈希和对话内容等敏感数据，只在排查问题时临时开启）
+QUERY_PROFILER_LOG_PATH = os.getenv('QUERY_PROFILER_LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs', 'slow_requests.log'))  # 慢请求日志路径
+QUERY_PROFILER_LOG_MAX_BYTES = int(os.getenv('QUERY_PROFILER_LOG_MAX_BYTES', str(10 * 1024 * 1024)))  # 单个日志文件大小上限（字节）
+QUERY_PROFILER_LOG_BACKUP_COUNT = int(os.getenv('QUERY_PROFILER_LOG_BACKUP_COUNT', '5'))  # 保留的历史日志文件数
+
+class QueryProfile:
+    """一个被抽样请求执行的语句：按语句文本汇总次数和耗时，并保留最慢的几次执行及其参数"""
+
+    __slots__ = ('count', 'total_time', 'statements', 'slowest', '_lock')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = {}  # 语句 -> [次数, 总耗时, 最大耗时]
+        self.slowest = []  # 最小堆 (耗时, 序号, 语句, 参数, 是否 executemany)
+        self._lock = threading.Lock()
+
+    def add(self, statement, parameters, elapsed, executemany):
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            entry = self.statements.get(statement)
+            if entry is None:
+                entry = self.statements[statement] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            item = (elapsed, self.count, statement, parameters, executemany)
+            if len(self.slowest) < QUERY_PROFILER_TOP_STATEMENTS:
+                heapq.heappush(self.slowest, item)
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+class QueryProfiler:
+    """抽样记录请求的数据库语句，汇总各接口和语句的耗时，慢请求连同执行计划写入滚动日志
+
+    慢请求日志和 EXPLAIN 在后台线程中完成，不增加请求本身的耗时。
+    """
+
+    def __init__(self, enabled=QUERY_PROFILER_ENABLED, sample_rate=QUERY_PROFILER_SAMPLE_RATE,
+                 slow_request_ms=QUERY_PROFILER_SLOW_REQUEST_MS, slow_query_count=QUERY_PROFILER_SLOW_QUERY_COUNT,
+                 max_statements=QUERY_PROFILER_MAX_STATEMENTS, explain=QUERY_PROFILER_EXPLAIN, log_path=QUERY_PROFILER_LOG_PATH):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_request_ms = slow_request_ms
+        self.slow_query_count = slow_query_count
+        self.max_statements = max_statements
+        self.explain = explain
+        self.log_path = log_path
+        self.engine = None
+        self.dropped = 0
+        self._endpoints = {}
+        self._statements = {}
+        self._recent_slow = deque(maxlen=50)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=100)
+        self._thread = None
+        self._pid = None
+        self._logger = None
+
+    def init_engine(self, engine):
+        """设置执行 EXPLAIN 使用的同步数据库引擎"""
+        self.engine = engine
+
+    def sample(self):
+        """决定是否分析本次请求，抽中时返回新的 QueryProfile"""
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        return QueryProfile()
+
+    def finish(self, endpoint, method, status, elapsed, profile):
+        """被抽样的请求结束时汇总统计，慢请求交给后台线程写日志"""
+        elapsed_ms = elapsed * 1000
+        slow = elapsed_ms >= self.slow_request_ms or (self.slow_query_count and profile.count > self.slow_query_count)
+        with profile._lock:
+            statements = list(profile.statements.items())
+            slowest = sorted(profile.slowest, reverse=True)
+
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    'requests': 0, 'slow_requests': 0, 'total_time': 0.0, 'max_time': 0.0,
+                    'queries': 0, 'max_queries': 0, 'db_time': 0.0, 'max_db_time': 0.0
+                }
+            stats['requests'] += 1
+            stats['slow_requests'] += 1 if slow else 0
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['queries'] += profile.count
+            stats['max_queries'] = max(stats['max_queries'], profile.count)
+            stats['db_time'] += profile.total_time
+            stats['max_db_time'] = max(stats['max_db_time'], profile.total_time)
+
+            for statement, (count, total_time, max_time) in statements:
+                entry = self._statements.get(statement)
+                if entry is None:
+                    if len(self._statements) >= self.max_statements:
+                        # 淘汰总耗时最少的语句
+                        del self._statements[min(self._statements, key=lambda key: self._statements[key]['total_time'])]
+                    entry = self._statements[statement] = {
+                        'executions': 0, 'requests': 0, 'total_time': 0.0, 'max_time': 0.0, 'max_per_request': 0, 'endpoints': set()
+                    }
+                entry['executions'] += count
+                entry['requests'] += 1
+                entry['total_time'] += total_time
+                entry['max_time'] = max(entry['max_time'], max_time)
+                entry['max_per_request'] = max(entry['max_per_request'], count)
+                entry['endpoints'].add(endpoint)
+
+            if slow:
+                self._recent_slow.append({
+                    'endpoint': endpoint,
+                    'method': method,
+                    'status': status,
+                    'time': round(elapsed, 4),
+                    'queries': profile.count,
+                    'db_time': round(profile.total_time, 4),
+                    'slowest_statement': slowest[0][2] if slowest else None,
+                    'created_at': datetime.utcnow().isoformat()
+                })
+
+        if slow:
+            self._enqueue((endpoint, method, status, elapsed, profile.count, profile.total_time, statements, slowest))
+
+    def _enqueue(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        """按需启动后台线程（fork 出的工作进程中重新启动）"""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='query-profiler', daemon=True)
+            self._thread.start()
+
+    def _get_logger(self):
+        if self._logger is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            logger = logging.getLogger('query_profiler')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(self.log_path, maxBytes=QUERY_PROFILER_LOG_MAX_BYTES,
+                                          backupCount=QUERY_PROFILER_LOG_BACKUP_COUNT, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._get_logger().info(self._format(*record))
+            except Exception as e:
+                print(f'写入慢请求日志失败: {e}')
+
+    def _format(self, endpoint, method, status, elapsed, count, db_time, statements, slowest):
+        """格式化一条慢请求日志：按总耗时列出语句，附最慢几次执行的参数和执行计划"""
+        lines = [f'SLOW REQUEST {method} {endpoint} status={status} total={elapsed * 1000:.1f}ms db={db_time * 1000:.1f}ms queries={count}']
+        for statement, (executions, total_time, max_time) in sorted(statements, key=lambda item: item[1][1], reverse=True):
+            lines.append(f'  [{executions}x total={total_time * 1000:.1f}ms max={max_time * 1000:.1f}ms] {" ".join(statement.split())}')
+        for elapsed_one, _, statement, parameters, executemany in slowest:
+            lines.append(f'  SLOWEST {elapsed_one * 1000:.1f}ms: {" ".join(statement.split())}')
+            if QUERY_PROFILER_LOG_PARAMS:
+                lines.append(f'    params: {parameters!r}'[:2000])
+            if self.explain and not executemany:
+                for plan in self.explain_statement(statement, parameters):
+                    lines.append(f'    EXPLAIN: {plan}')
+        return '\n'.join(lines)
+
+    def explain_statement(self, statement, parameters):
+        """获取 SELECT 语句的执行计划（SQLite 使用 EXPLAIN QUERY PLAN），失败时返回错误说明"""
+        if self.engine is None or not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            return []
+        prefix = 'EXPLAIN QUERY PLAN ' if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        try:
+            with self.engine.connect() as connection:
+                result = connection.exec_driver_sql(prefix + statement, parameters)
+                keys = list(result.keys())
+                rows = result.fetchall()
+        except Exception as e:
+            return [f'failed: {e}']
+        if self.engine.dialect.name == 'sqlite':
+            return [row[-1] for row in rows]
+        return [', '.join(f'{key}={value}' for key, value in zip(keys, row) if value is not None) for row in rows]
+
+    def report(self, sort='db_time', limit=20):
+        """最差的接口和语句：接口按平均数据库耗时/平均语句数/最大耗时排序，语句按总耗时排序"""
+        with self._lock:
+            endpoints = []
+            for endpoint, stats in self._endpoints.items():
+                requests = stats['requests']
+                endpoints.append({
+                    'endpoint': endpoint,
+                    'requests': requests,
+                    'slow_requests': stats['slow_requests'],
+                    'avg_time': round(stats['total_time'] / requests, 4),
+                    'max_time': round(stats['max_time'], 4),
+                    'avg_queries': round(stats['queries'] / requests, 2),
+                    'max_queries': stats['max_queries'],
+                    'avg_db_time': round(stats['db_time'] / requests, 4),
+                    'max_db_time': round(stats['max_db_time'], 4)
+                })
+            statements = [{
+                'statement': statement,
+                'executions': entry['executions'],
+                'requests': entry['requests'],
+                'avg_per_request': round(entry['executions'] / entry['requests'], 2),
+                'max_per_request': entry['max_per_request'],
+                'total_time': round(entry['total_time'], 4),
+                'avg_time': round(entry['total_time'] / entry['executions'], 6),
+                'max_time': round(entry['max_time'], 4),
+                'endpoints': sorted(entry['endpoints'])
+            } for statement, entry in self._statements.items()]
+            recent_slow = list(self._recent_slow)
+
+        sort_keys = {
+            'db_time': 'avg_db_time',
+            'queries': 'avg_queries',
+            'time': 'max_time'
+        }
+        endpoints.sort(key=lambda item: item[sort_keys.get(sort, 'avg_db_time')], reverse=True)
+        statements.sort(key=lambda item: item['total_time'], reverse=True)
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'slow_request_ms': self.slow_request_ms,
+            'log_path': self.log_path,
+            'dropped': self.dropped,
+            'endpoints': endpoints[:limit],
+            'statements': statements[:limit],
+            'recent_slow_requests': recent_slow[-limit:][::-1]
+        }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self._statements.clear()
+            self._recent_slow.clear()
+
+# 进程内共享的查询分析器
+query_profiler = QueryProfiler()
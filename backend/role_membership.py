@@ -0,0 +1,81 @@
+import os
+from sqlalchemy import and_, delete, exists, insert, select, true
+from models import User, Role, user_roles
+
+# 角色成员批量修改配置
+ROLE_MEMBERSHIP_CHUNK_SIZE = int(os.getenv('ROLE_MEMBERSHIP_CHUNK_SIZE', '1000'))  # 每条 INSERT ... SELECT / DELETE 语句处理的ID数量（受数据库绑定参数数量限制）
+
+class InvalidIds(ValueError):
+    """ID 列表格式错误"""
+
+def parse_ids(values):
+    """把请求中的ID列表转换为去重后的整数列表（保持原顺序）"""
+    if not isinstance(values, list):
+        raise InvalidIds(values)
+    try:
+        return list(dict.fromkeys(int(value) for value in values))
+    except (TypeError, ValueError):
+        raise InvalidIds(values)
+
+def chunked(ids, size=ROLE_MEMBERSHIP_CHUNK_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+def _insert_members(session, user_ids, role_ids):
+    """INSERT ... SELECT 写入 (用户, 角色) 关联：只写入存在的用户和角色，已有的关联跳过，返回写入条数"""
+    membership = exists().where(and_(user_roles.c.user_id == User.id, user_roles.c.role_id == Role.id))
+    query = select(User.id, Role.id).join(Role, true()).where(User.id.in_(user_ids), Role.id.in_(role_ids), ~membership)
+    return session.execute(insert(user_roles).from_select(['user_id', 'role_id'], query)).rowcount
+
+def role_member_ids(session, role_id, user_ids=None):
+    """角色下的用户ID集合（传入 user_ids 时只查询其中的用户）"""
+    query = select(user_roles.c.user_id).where(user_roles.c.role_id == role_id)
+    if user_ids is None:
+        return set(session.execute(query).scalars())
+    members = set()
+    for chunk in chunked(user_ids):
+        members.update(session.execute(query.where(user_roles.c.user_id.in_(chunk))).scalars())
+    return members
+
+def add_role_users(session, role_id, user_ids):
+    """把用户加入角色（不提交），返回 {'added', 'unchanged', 'not_found'}"""
+    members = role_member_ids(session, role_id, user_ids)
+    to_add = [user_id for user_id in user_ids if user_id not in members]
+    added = sum(_insert_members(session, chunk, [role_id]) for chunk in chunked(to_add))
+    return {'added': added, 'unchanged': len(members), 'not_found': len(to_add) - added}
+
+def remove_role_users(session, role_id, user_ids):
+    """把用户移出角色（不提交），返回 {'removed', 'unchanged'}"""
+    removed = 0
+    for chunk in chunked(user_ids):
+        removed += session.execute(
+            delete(user_roles).where(user_roles.c.role_id == role_id, user_roles.c.user_id.in_(chunk))
+        ).rowcount
+    return {'removed': removed, 'unchanged': len(user_ids) - removed}
+
+def sync_role_users(session, role_id, user_ids):
+    """把角色的用户替换为 user_ids（不提交），只写入新增和删除的差异，返回 {'added', 'removed', 'unchanged', 'not_found'}"""
+    members = role_member_ids(session, role_id)
+    desired = set(user_ids)
+    to_add = [user_id for user_id in user_ids if user_id not in members]
+    result = add_role_users(session, role_id, to_add) if to_add else {'added': 0, 'not_found': 0}
+    removed = remove_role_users(session, role_id, sorted(members - desired))['removed']
+    return {
+        'added': result['added'],
+        'removed': removed,
+        'unchanged': len(members & desired),
+        'not_found': result['not_found']
+    }
+
+def set_user_roles(session, user, role_ids):
+    """把用户的角色替换为 role_ids（不提交），只写入差异，并使 user.roles 重新加载"""
+    current = set(session.execute(select(user_roles.c.role_id).where(user_roles.c.user_id == user.id)).scalars())
+    desired = set(role_ids)
+    to_add = sorted(desired - current)
+    to_remove = sorted(current - desired)
+    if to_add:
+        _insert_members(session, [user.id], to_add)
+    if to_remove:
+        session.execute(delete(user_roles).where(user_roles.c.user_id == user.id, user_roles.c.role_id.in_(to_remove)))
+    session.expire(user, ['roles'])
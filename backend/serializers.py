@@ -0,0 +1,184 @@
+import json
+import threading
+from operator import itemgetter
+from flask import Response, request
+from sqlalchemy import select
+from models import db, User, Role, Agent, AgentLog, user_roles
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class InvalidFields(ValueError):
+    """fields 参数中有不存在的字段"""
+
+def _default(value):
+    # datetime 按 isoformat 输出，与各模型 to_dict 一致
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(data):
+    """把响应数据编码为 JSON 字节串（安装 orjson 时使用 orjson，datetime 直接输出为 isoformat 格式）"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_default).encode()
+
+def json_response(data, status=200):
+    """直接返回编码好的 JSON 响应，不再经过 flask_restx 的序列化"""
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+class Computed:
+    """由一列转换得到的字段"""
+
+    def __init__(self, name, convert):
+        self.name = name
+        self.convert = convert
+
+class Related:
+    """按页批量加载的关联字段：load(ids) 返回 {id: 各字段值的元组}，缺少的ID使用 default"""
+
+    def __init__(self, names, load, default):
+        self.names = names
+        self.load = load
+        self.default = default
+
+class CompiledSerializer:
+    """选定字段的序列化器：只查询需要的列，行元组直接转换为字典
+
+    columns 为需要查询的列（总是包含 id 和 created_at，用于关联字段和游标分页），
+    调用时传入按 columns 顺序的行元组列表，返回与模型 to_dict 相同结构（只包含选定字段）的字典列表。
+    """
+
+    def __init__(self, model, spec, keys):
+        self.model = model
+        self.keys = keys
+        selected = set(keys)
+        self.column_names = ['id', 'created_at']
+        plain_keys, plain_indexes, self.computed, self.related = [], [], [], []
+        for entry in spec:
+            if isinstance(entry, Related):
+                if selected & set(entry.names):
+                    self.related.append(entry)
+                continue
+            name = entry.name if isinstance(entry, Computed) else entry
+            if name not in selected:
+                continue
+            if name not in self.column_names:
+                self.column_names.append(name)
+            plain_keys.append(name)
+            plain_indexes.append(self.column_names.index(name))
+            if isinstance(entry, Computed):
+                self.computed.append((name, entry.convert))
+        self.columns = [getattr(model, name) for name in self.column_names]
+        self._plain_keys = plain_keys
+        # itemgetter 只取一个下标时返回单个值而不是元组
+        if len(plain_indexes) == 1:
+            index = plain_indexes[0]
+            self._getter = lambda row: (row[index],)
+        else:
+            self._getter = itemgetter(*plain_indexes) if plain_indexes else (lambda row: ())
+        # 关联字段在列字段之后添加，与 to_dict 的字段顺序不同（或只选了关联字段中的一部分）时按 keys 重新排列
+        self._reorder = plain_keys + [name for entry in self.related for name in entry.names] != keys
+
+    def __call__(self, rows):
+        keys, getter = self._plain_keys, self._getter
+        items = [dict(zip(keys, getter(row))) for row in rows]
+        for name, convert in self.computed:
+            for item in items:
+                item[name] = convert(item[name])
+        if self.related and items:
+            ids = [row[0] for row in rows]
+            for entry in self.related:
+                loaded = entry.load(ids)
+                for item, item_id in zip(items, ids):
+                    item.update(zip(entry.names, loaded.get(item_id, entry.default)))
+            if self._reorder:
+                items = [{key: item[key] for key in self.keys} for item in items]
+        return items
+
+    def one(self, item_id):
+        """按ID查询并转换一条记录，不存在时返回 None"""
+        row = db.session.execute(select(*self.columns).where(self.model.id == item_id)).first()
+        return self([row])[0] if row is not None else None
+
+    def pick(self, items):
+        """从已经是完整字典的记录（如归档日志）中取出选定字段"""
+        if not items or len(self.keys) == len(items[0]):
+            return items
+        return [{key: item[key] for key in self.keys} for item in items]
+
+class ModelSerializer:
+    """按模型定义字段，按请求的字段组合编译并缓存 CompiledSerializer"""
+
+    def __init__(self, model, spec):
+        self.model = model
+        self.spec = spec
+        self.fields = [name for entry in spec for name in (entry.names if isinstance(entry, Related) else
+                                                          [entry.name if isinstance(entry, Computed) else entry])]
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def compile(self, keys=None):
+        keys = tuple(keys) if keys else tuple(self.fields)
+        compiled = self._compiled.get(keys)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.setdefault(keys, CompiledSerializer(self.model, self.spec, list(keys)))
+        return compiled
+
+    def from_request(self):
+        """按请求中的 fields 参数（逗号分隔的字段名，不传时返回全部字段）编译序列化器"""
+        value = request.args.get('fields', '')
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise InvalidFields(', '.join(unknown))
+        # 按模型字段的顺序输出，同一组字段只编译一次
+        return self.compile([name for name in self.fields if name in names])
+
+def load_user_roles(user_ids):
+    """一条查询加载一页用户的角色，返回 {user_id: (角色ID列表, 角色名称列表)}"""
+    roles = {}
+    rows = db.session.execute(
+        select(user_roles.c.user_id, Role.id, Role.name)
+        .join(Role, Role.id == user_roles.c.role_id)
+        .where(user_roles.c.user_id.in_(user_ids))
+        .order_by(user_roles.c.user_id, Role.id)
+    )
+    for user_id, role_id, role_name in rows:
+        role_ids, role_names = roles.setdefault(user_id, ([], []))
+        role_ids.append(role_id)
+        role_names.append(role_name)
+    return roles
+
+def load_role_user_counts(role_ids):
+    """一条分组查询统计一页角色的用户数量，返回 {role_id: (user_count,)}"""
+    return {role_id: (count,) for role_id, count in Role.count_users(role_ids).items()}
+
+def split_stop_sequences(value):
+    return value.split(',') if value else []
+
+# 各模型的字段（顺序与 to_dict 相同）
+user_serializer = ModelSerializer(User, [
+    'id', 'username', 'email', 'full_name', 'phone', 'is_active', 'is_admin',
+    Related(('role_ids', 'role_names'), load_user_roles, ([], [])),
+    'created_at', 'updated_at'
+])
+
+role_serializer = ModelSerializer(Role, [
+    'id', 'name', 'description',
+    Related(('user_count',), load_role_user_counts, (0,)),
+    'created_at', 'updated_at'
+])
+
+agent_serializer = ModelSerializer(Agent, [
+    'id', 'name', 'description', 'status', 'model_name', 'model_provider', 'model_api_url', 'model_api_key',
+    'model_temperature', 'model_max_tokens', 'model_top_p', 'model_top_k', 'model_presence_penalty',
+    'model_frequency_penalty', Computed('model_stop_sequences', split_stop_sequences), 'model_context_window',
+    'model_system_prompt', 'max_concurrency', 'completion_cache_enabled', 'warmup_status', 'warmup_error',
+    'warmed_at', 'created_at', 'updated_at'
+])
+
+log_serializer = ModelSerializer(AgentLog, ['id', 'agent_id', 'level', 'message', 'created_at'])
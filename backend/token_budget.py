@@ -0,0 +1,97 @@
+import os
+import math
+from context_cache import MemoryContextCache
+
+# 上下文截断配置
+CONTEXT_SUMMARY_ENABLED = os.getenv('CONTEXT_SUMMARY_ENABLED', 'false').lower() == 'true'  # 是否对截断的历史生成摘要
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv('CONTEXT_SUMMARY_MAX_TOKENS', '256'))  # 摘要最大 tokens
+CONTEXT_SUMMARY_CHUNK = int(os.getenv('CONTEXT_SUMMARY_CHUNK', '8'))  # 截断按多少条消息对齐，使摘要可以在多轮之间复用
+
+# 每条消息的格式开销（role、分隔符等）
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# 已生成的历史摘要，键为 (会话主键, 被截断的消息数量)
+summary_cache = MemoryContextCache(max_size=int(os.getenv('CONTEXT_SUMMARY_CACHE_SIZE', '1000')))
+
+def count_tokens(text):
+    """估算文本的 token 数：CJK 字符按 1 个 token，其余字符按 4 个字符 1 个 token"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uac00' <= ch <= '\ud7af' or '\uff00' <= ch <= '\uffef')
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def count_message_tokens(content):
+    """估算单条消息的 token 数（含格式开销），保存到 Message.token_count"""
+    return count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+def fill_token_counts(rows):
+    """补全缺少 token 数的 (id, role, content, token_count) 消息行，返回补全后的行和需要回写的记录"""
+    filled = []
+    backfill = []
+    for message_id, role, content, token_count in rows:
+        if token_count is None:
+            token_count = count_message_tokens(content)
+            backfill.append({'id': message_id, 'token_count': token_count})
+        filled.append((message_id, role, content, token_count))
+    return filled, backfill
+
+def context_budget(agent, max_tokens=None):
+    """可用于历史消息的 token 预算：上下文窗口减去为回复预留的 tokens"""
+    reserved = agent.model_max_tokens if max_tokens is None else max_tokens
+    return agent.model_context_window - reserved
+
+def select_context(messages, token_counts, budget, summarize=False):
+    """在预算内保留系统消息和最新的若干条消息
+
+    返回 (保留的消息, 被截断的消息, 保留消息的 token 总数)。预算不足时至少保留最新一条消息；
+    summarize=True 时为摘要预留 tokens，并把截断位置按 CONTEXT_SUMMARY_CHUNK 对齐。
+    """
+    if budget <= 0 or sum(token_counts) <= budget:
+        return messages, [], sum(token_counts)
+
+    system_indexes = [i for i, msg in enumerate(messages) if msg['role'] == 'system']
+    used = sum(token_counts[i] for i in system_indexes)
+    if summarize:
+        used += CONTEXT_SUMMARY_MAX_TOKENS + MESSAGE_TOKEN_OVERHEAD
+
+    # 从最新的消息开始向前累加，直到超出预算
+    others = [i for i in range(len(messages)) if messages[i]['role'] != 'system']
+    keep_from = len(others)
+    for position in range(len(others) - 1, -1, -1):
+        count = token_counts[others[position]]
+        if used + count > budget and position < len(others) - 1:
+            break
+        used += count
+        keep_from = position
+
+    if summarize and keep_from > 0:
+        # 对齐截断位置，使同一段历史的摘要可以复用
+        aligned = math.ceil(keep_from / CONTEXT_SUMMARY_CHUNK) * CONTEXT_SUMMARY_CHUNK
+        keep_from = min(aligned, len(others) - 1)
+
+    kept_indexes = set(system_indexes) | set(others[keep_from:])
+    kept = [msg for i, msg in enumerate(messages) if i in kept_indexes]
+    dropped = [messages[i] for i in others[:keep_from]]
+    tokens = sum(token_counts[i] for i in kept_indexes)
+    return kept, dropped, tokens
+
+def build_summary_request(agent, dropped):
+    """构建对截断历史生成摘要的请求参数"""
+    transcript = '\n'.join(f'{msg["role"]}: {msg["content"]}' for msg in dropped)
+    return {
+        'model': agent.model_name,
+        'messages': [
+            {'role': 'system', 'content': 'Summarize the following conversation concisely, keeping facts, decisions and open questions.'},
+            {'role': 'user', 'content': transcript}
+        ],
+        'temperature': 0,
+        'max_tokens': CONTEXT_SUMMARY_MAX_TOKENS
+    }
+
+def insert_summary(messages, summary):
+    """将摘要作为系统消息插入到系统提示词之后"""
+    summary_message = {'role': 'system', 'content': f'Summary of earlier conversation: {summary}'}
+    position = 0
+    while position < len(messages) and messages[position]['role'] == 'system':
+        position += 1
+    return messages[:position] + [summary_message] + messages[position:]
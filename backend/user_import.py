@@ -0,0 +1,194 @@
+import io
+import os
+import csv
+import json
+from datetime import datetime
+from sqlalchemy import insert, or_, select
+from models import User, Role, user_roles
+from password_hasher import password_hasher
+from role_membership import chunked
+
+# 批量导入用户配置
+USER_IMPORT_MAX_ROWS = int(os.getenv('USER_IMPORT_MAX_ROWS', '10000'))  # 单次导入最多的用户数量
+USER_IMPORT_BATCH_SIZE = int(os.getenv('USER_IMPORT_BATCH_SIZE', '500'))  # 每条 INSERT 语句写入的用户数量，也是查询已有用户名和邮箱时每批的数量
+
+# 请求的 Content-Type 对应的导入格式
+IMPORT_FORMATS = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+    'application/jsonl': 'ndjson'
+}
+
+# 字符串字段及其最大长度（与数据库列定义一致）
+STRING_FIELDS = {name: User.__table__.c[name].type.length for name in ('username', 'email', 'full_name', 'phone')}
+REQUIRED_FIELDS = ('username', 'email', 'password')
+
+class InvalidImport(ValueError):
+    """导入请求格式错误"""
+
+def import_format(content_type, requested=None):
+    """根据 format 参数或 Content-Type 确定导入格式（csv 或 ndjson）"""
+    if requested:
+        if requested not in ('csv', 'ndjson'):
+            raise InvalidImport(f'Unsupported format "{requested}" (csv or ndjson)')
+        return requested
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+    if mimetype not in IMPORT_FORMATS:
+        raise InvalidImport('Content-Type must be text/csv or application/x-ndjson')
+    return IMPORT_FORMATS[mimetype]
+
+def parse_import(text, fmt):
+    """解析导入内容，返回 [(行号, 行数据)]
+
+    CSV 第一行为列名，role_ids 列中的多个角色ID用分号或空格分隔；NDJSON 每行一个 JSON 对象，空行被忽略。
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+        rows = ((reader.line_num, row) for row in reader)
+    else:
+        rows = ((number, _parse_json_line(number, line)) for number, line in enumerate(text.splitlines(), 1) if line.strip())
+    parsed = []
+    for row in rows:
+        parsed.append(row)
+        if len(parsed) > USER_IMPORT_MAX_ROWS:
+            raise InvalidImport(f'Too many users (max {USER_IMPORT_MAX_ROWS})')
+    if not parsed:
+        raise InvalidImport('No users to import')
+    return parsed
+
+def _parse_json_line(number, line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        raise InvalidImport(f'Invalid JSON (line {number})')
+
+def _parse_bool(value, default):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('true', '1', 'yes'):
+        return True
+    if value in ('false', '0', 'no'):
+        return False
+    raise ValueError(f'Invalid boolean "{value}"')
+
+def _parse_role_ids(value):
+    if value is None or value == '':
+        return []
+    if isinstance(value, str):
+        value = value.replace(';', ' ').replace(',', ' ').split()
+    if not isinstance(value, list):
+        raise ValueError('Role IDs must be a list of integers')
+    try:
+        return list(dict.fromkeys(int(role_id) for role_id in value))
+    except (TypeError, ValueError):
+        raise ValueError('Role IDs must be a list of integers')
+
+def normalize_row(row):
+    """校验一行导入数据并转换为用户字段，格式错误时抛出 ValueError"""
+    if not isinstance(row, dict):
+        raise ValueError('Row must be an object')
+    for name in REQUIRED_FIELDS:
+        value = row.get(name)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('Username, email and password are required')
+    user = {}
+    for name, length in STRING_FIELDS.items():
+        value = row.get(name)
+        value = '' if value is None else str(value).strip()
+        if len(value) > length:
+            raise ValueError(f'{name} is too long (max {length})')
+        user[name] = value
+    user['password'] = row['password']
+    user['is_active'] = _parse_bool(row.get('is_active'), True)
+    user['is_admin'] = _parse_bool(row.get('is_admin'), False)
+    user['role_ids'] = _parse_role_ids(row.get('role_ids'))
+    return user
+
+def existing_users(session, usernames, emails):
+    """按批查询已存在的用户名和邮箱，返回 (用户名集合, 邮箱集合)"""
+    found_usernames, found_emails = set(), set()
+    usernames, emails = list(usernames), list(emails)
+    for start in range(0, max(len(usernames), len(emails)), USER_IMPORT_BATCH_SIZE):
+        username_chunk = usernames[start:start + USER_IMPORT_BATCH_SIZE]
+        email_chunk = emails[start:start + USER_IMPORT_BATCH_SIZE]
+        query = select(User.username, User.email).where(or_(User.username.in_(username_chunk), User.email.in_(email_chunk)))
+        for username, email in session.execute(query):
+            found_usernames.add(username)
+            found_emails.add(email)
+    return found_usernames, found_emails
+
+def validate_import(session, rows):
+    """校验导入的用户，返回 (可导入的 [(行号, 用户)], 错误列表)
+
+    用户名和邮箱在导入内容中不能重复，也不能与已有用户重复（按批用 IN 查询，不逐个查询）。
+    """
+    valid, errors = [], []
+    usernames, emails = set(), set()
+    for line, row in rows:
+        try:
+            user = normalize_row(row)
+        except ValueError as e:
+            errors.append({'line': line, 'username': row.get('username') if isinstance(row, dict) else None, 'error': str(e)})
+            continue
+        if user['username'] in usernames or user['email'] in emails:
+            errors.append({'line': line, 'username': user['username'], 'error': 'Duplicate username or email in import'})
+            continue
+        usernames.add(user['username'])
+        emails.add(user['email'])
+        valid.append((line, user))
+
+    found_usernames, found_emails = existing_users(session, usernames, emails)
+    if found_usernames or found_emails:
+        remaining = []
+        for line, user in valid:
+            if user['username'] in found_usernames or user['email'] in found_emails:
+                errors.append({'line': line, 'username': user['username'], 'error': 'User already exists'})
+            else:
+                remaining.append((line, user))
+        valid = remaining
+    errors.sort(key=lambda error: error['line'])
+    return valid, errors
+
+def insert_users(session, users):
+    """在进程池中计算密码哈希，按批写入用户和角色关联（不提交），返回写入的用户数
+
+    不存在的角色被忽略，与创建单个用户时一致。
+    """
+    role_ids = {role_id for user in users for role_id in user['role_ids']}
+    existing_roles = set()
+    for chunk in chunked(sorted(role_ids)):
+        existing_roles.update(session.execute(select(Role.id).where(Role.id.in_(chunk))).scalars())
+
+    hashes = password_hasher.hash_many(user['password'] for user in users)
+    now = datetime.utcnow()
+    for start in range(0, len(users), USER_IMPORT_BATCH_SIZE):
+        batch = users[start:start + USER_IMPORT_BATCH_SIZE]
+        session.execute(insert(User.__table__), [{
+            'username': user['username'],
+            'email': user['email'],
+            'password_hash': password_hash,
+            'full_name': user['full_name'],
+            'phone': user['phone'],
+            'is_active': user['is_active'],
+            'is_admin': user['is_admin'],
+            'created_at': now,
+            'updated_at': now
+        } for user, password_hash in zip(batch, hashes[start:start + USER_IMPORT_BATCH_SIZE])])
+
+        # 按用户名取回新用户的ID（MySQL 不支持 INSERT ... RETURNING），再写入角色关联
+        roles_by_username = {user['username']: [role_id for role_id in user['role_ids'] if role_id in existing_roles] for user in batch}
+        if any(roles_by_username.values()):
+            user_ids = session.execute(
+                select(User.username, User.id).where(User.username.in_([username for username, roles in roles_by_username.items() if roles]))
+            ).all()
+            session.execute(insert(user_roles), [
+                {'user_id': user_id, 'role_id': role_id}
+                for username, user_id in user_ids
+                for role_id in roles_by_username[username]
+            ])
+    return len(users)